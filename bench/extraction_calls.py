@@ -0,0 +1,96 @@
+"""Counts yt-dlp extractor invocations per download_media_ytdlp call.
+
+Serves a small file over a local HTTP server (handled by yt-dlp's generic
+extractor) and wraps InfoExtractor.extract with a counter. "cold" drops the
+info cache entry before every download, so it shows the extractions done by
+a single download; "warm" keeps the cache, as repeated requests would.
+
+    python bench/extraction_calls.py [downloads]
+"""
+
+import functools
+import http.server
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import yt_dlp  # noqa: E402
+from yt_dlp.extractor.common import InfoExtractor  # noqa: E402
+
+import main  # noqa: E402
+
+MEDIA_BYTES = 512 * 1024
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class _QuietServer(http.server.ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # The generic extractor closes its probe request early.
+        pass
+
+
+def _serve(directory: str) -> http.server.ThreadingHTTPServer:
+    handler = functools.partial(_QuietHandler, directory=directory)
+    server = _QuietServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _run(url: str, downloads: int, cold: bool, calls: list) -> None:
+    calls.clear()
+    started = time.perf_counter()
+    for _ in range(downloads):
+        if cold:
+            main.INFO_CACHE.drop(url)
+        success, message, path, _ = main.download_media_ytdlp(url, "video")
+        if not success:
+            raise SystemExit(f"Download failed: {message}")
+        main.remove_downloaded_file(path)
+    elapsed = time.perf_counter() - started
+    label = "cold" if cold else "warm"
+    print(
+        f"{label}: {len(calls)} extractor calls for {downloads} downloads "
+        f"({len(calls) / downloads:.2f} per download, "
+        f"{elapsed / downloads * 1000:.0f} ms per download)"
+    )
+
+
+def main_bench() -> None:
+    downloads = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    calls: list = []
+    original_extract = InfoExtractor.extract
+
+    def counting_extract(self, url):
+        calls.append(self.ie_key())
+        return original_extract(self, url)
+
+    InfoExtractor.extract = counting_extract
+    with tempfile.TemporaryDirectory() as workdir:
+        serve_dir = os.path.join(workdir, "serve")
+        os.makedirs(serve_dir)
+        with open(os.path.join(serve_dir, "clip.mp4"), "wb") as f:
+            f.write(os.urandom(MEDIA_BYTES))
+        # Downloads land in main.DOWNLOAD_DIR, relative to the working directory.
+        os.chdir(workdir)
+        os.makedirs(main.DOWNLOAD_DIR, exist_ok=True)
+        server = _serve(serve_dir)
+        url = f"http://127.0.0.1:{server.server_address[1]}/clip.mp4"
+        try:
+            _run(url, downloads, cold=True, calls=calls)
+            _run(url, downloads, cold=False, calls=calls)
+        finally:
+            server.shutdown()
+            InfoExtractor.extract = original_extract
+    print(f"yt-dlp {yt_dlp.version.__version__}")
+
+
+if __name__ == "__main__":
+    main_bench()
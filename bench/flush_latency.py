@@ -0,0 +1,86 @@
+"""Flush latency against user count: PicklePersistence vs SQLitePersistence.
+
+Each store is seeded with synthetic user records, then one user is touched
+and the change is written out, repeatedly; the median write time is reported.
+The pickle store is configured as the bot used it (on_flush=False), so every
+update rewrites the whole file.
+
+    python bench/flush_latency.py [user counts...]   (default: 1000 10000 100000)
+"""
+
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram.ext import PicklePersistence  # noqa: E402
+
+import main  # noqa: E402
+
+FLUSHES = 10
+
+
+def _user_record(user_id: int) -> dict:
+    return {
+        "_id": user_id,
+        "is_premium": user_id % 10 == 0,
+        "premium_expiry_timestamp": None,
+        "premium_tier": None,
+        "last_download_date": "2026-01-01",
+        "daily_downloads_count": user_id % 5,
+    }
+
+
+async def _time_flushes(persistence, users: int) -> float:
+    timings = []
+    for i in range(FLUSHES):
+        user_id = i % users
+        record = dict(_user_record(user_id), daily_downloads_count=100 + i)
+        started = time.perf_counter()
+        await persistence.update_user_data(user_id, record)
+        await persistence.flush()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+
+async def _bench_pickle(workdir: str, users: int) -> float:
+    filepath = os.path.join(workdir, f"{users}.pickle")
+    seed = PicklePersistence(filepath=filepath, on_flush=True)
+    await seed.get_user_data()
+    for user_id in range(users):
+        await seed.update_user_data(user_id, _user_record(user_id))
+    await seed.flush()
+    persistence = PicklePersistence(filepath=filepath)
+    await persistence.get_user_data()
+    return await _time_flushes(persistence, users)
+
+
+async def _bench_sqlite(workdir: str, users: int) -> float:
+    persistence = main.SQLitePersistence(
+        os.path.join(workdir, f"{users}.sqlite3"),
+        user_registry=main.UserRegistry(),
+    )
+    await persistence.get_user_data()
+    for user_id in range(users):
+        persistence.user_data[user_id] = _user_record(user_id)
+    await persistence.flush()
+    return await _time_flushes(persistence, users)
+
+
+async def main_bench(user_counts) -> None:
+    print(f"Median of {FLUSHES} writes after touching one user:")
+    print(f"{'users':>8} {'pickle':>10} {'sqlite':>10}")
+    for users in user_counts:
+        with tempfile.TemporaryDirectory() as workdir:
+            pickle_ms = await _bench_pickle(workdir, users)
+            sqlite_ms = await _bench_sqlite(workdir, users)
+        print(f"{users:>8} {pickle_ms:>8.2f}ms {sqlite_ms:>8.2f}ms")
+
+
+if __name__ == "__main__":
+    counts = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000]
+    asyncio.run(main_bench(counts))
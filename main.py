@@ -5,10 +5,28 @@ import subprocess
 import asyncio
 import datetime
 import traceback
-from typing import Dict, Any, Tuple, Optional, List
+import functools
+import bisect
+import heapq
+import time
+import copy
+import pickle
+import sqlite3
+import shutil
+import json
+import hashlib
+import hmac
+import threading
+from collections import deque, OrderedDict
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Dict, Any, Tuple, Optional, List, Callable, Awaitable
 from uuid import uuid4
-from urllib.parse import urlparse
+from pathlib import Path
+from urllib.parse import urlparse, urlunparse, parse_qs, urlencode
+import signal
 import aiohttp
+from aiohttp import web
 import yt_dlp
 
 from telegram import (
@@ -17,7 +35,10 @@ from telegram import (
     InlineKeyboardMarkup,
     BotCommand,
     LabeledPrice,
+    InputMediaVideo,
+    InputMediaAudio,
     constants,
+    Message,
     User,
 )
 from telegram.ext import (
@@ -29,14 +50,25 @@ from telegram.ext import (
     CallbackQueryHandler,
     PreCheckoutQueryHandler,
     PicklePersistence,
+    BasePersistence,
     Defaults,
 )
-from telegram.error import TelegramError, Forbidden
+from telegram.error import TelegramError, Forbidden, RetryAfter, BadRequest
 
 
 # --- Configuration & Constants ---
 BOT_TOKEN = "BOT_TOKEN_HERE"
 
+# Update Delivery (long polling by default, or webhook behind HTTPS)
+WEBHOOK_ENABLED = False
+WEBHOOK_URL = "https://your.domain.example"  # Public HTTPS base URL Telegram will call
+WEBHOOK_PATH = "/telegram-webhook"
+WEBHOOK_LISTEN = "0.0.0.0"
+WEBHOOK_PORT = 8080
+WEBHOOK_SECRET_TOKEN = ""  # 1-256 chars of A-Z, a-z, 0-9, _ and -
+WEBHOOK_MAX_CONNECTIONS = 40
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY, Update.PRE_CHECKOUT_QUERY]
+
 # Owner and Admin IDs
 OWNER_ID = 123456789  # Replace with your actual Telegram user ID
 ADMIN_IDS = [123456789, 987654321]  # Replace with actual admin user IDs
@@ -44,218 +76,2885 @@ ADMIN_IDS = [123456789, 987654321]  # Replace with actual admin user IDs
 # Bot Settings
 SUPPORT_CONTACT = "@FairyRoot"
 DOWNLOAD_DIR = "bot_downloads"
+# Byte budget for DOWNLOAD_DIR. Each download reserves its estimated size
+# before writing; when the budget (or the disk) is full, new downloads wait up
+# to DOWNLOAD_RESERVATION_WAIT_SECONDS for space and are refused after that.
+DOWNLOAD_DIR_QUOTA_BYTES = 10 * 1024 * 1024 * 1024
+DOWNLOAD_MIN_FREE_DISK_BYTES = 1024 * 1024 * 1024
+DOWNLOAD_RESERVATION_DEFAULT_BYTES = 200 * 1024 * 1024  # when the size is unknown
+DOWNLOAD_RESERVATION_WAIT_SECONDS = 120
+# Files nobody is tracking (left by a crash, yt-dlp .part/.ytdl fragments,
+# unmerged .fNNN streams) are removed on startup and, once older than
+# DOWNLOAD_ORPHAN_MAX_AGE_SECONDS, by a periodic sweep.
+DOWNLOAD_ORPHAN_MAX_AGE_SECONDS = 3600
+DOWNLOAD_SWEEP_INTERVAL_SECONDS = 900
+# Optional tmpfs directory (e.g. "/dev/shm/bot_downloads") for media estimated
+# at or below TMPFS_MAX_MEDIA_BYTES. Empty disables it.
+TMPFS_DOWNLOAD_DIR = ""
+TMPFS_QUOTA_BYTES = 512 * 1024 * 1024
+TMPFS_MAX_MEDIA_BYTES = 30 * 1024 * 1024
 
 # User Roles
 ROLE_ADMIN = "admin"
 ROLE_PREMIUM = "premium"
 ROLE_STANDARD = "standard"
 ROLE_BANNED = "banned"
+# /viewusers pages through the user registry with these role filters.
+VIEW_USERS_PAGE_SIZE = 50
+VIEW_USERS_ROLE_FILTERS = {
+    "all": None,
+    "admin": ROLE_ADMIN,
+    "premium": ROLE_PREMIUM,
+    "standard": ROLE_STANDARD,
+    "banned": ROLE_BANNED,
+}
+# premium_tier values that do not count as "previously had premium" in /stats.
+PREMIUM_HISTORY_EXCLUDED_TIERS = (
+    "admin_revoked",
+    "revoked_banned",
+    "expired_or_unknown",
+    "expired_or_cleaned",
+)
 
 # Download & File Size Limits
 STANDARD_USER_DAILY_DOWNLOADS = 5
 STANDARD_USER_FILE_SIZE_LIMIT_MB = 25.0
 PREMIUM_ADMIN_DIRECT_SEND_LIMIT_MB = 49.5
+MAX_BATCH_URLS = 10  # Links handled from one message; also Telegram's album size
+# Links waiting for a format choice are kept in memory under a short token
+# carried in the keyboard's callback_data.
+PENDING_REQUEST_TTL_SECONDS = 3600
+PENDING_REQUEST_MAX_ENTRIES = 20000
+PENDING_REQUEST_TOKEN_LENGTH = 12
+# Playlist mode (premium/admin only). Entries are enumerated lazily and at most
+# PLAYLIST_PREFETCH_ITEMS of them are pending at any time.
+PLAYLIST_MAX_ITEMS = {ROLE_ADMIN: 200, ROLE_PREMIUM: 50}
+PLAYLIST_PREFETCH_ITEMS = 4
+# Each running playlist holds one enumeration thread; playlists beyond
+# PLAYLIST_MAX_CONCURRENT wait for a free thread.
+PLAYLIST_MAX_CONCURRENT = 4
+PLAYLIST_MAX_ACTIVE_PER_USER = 1
+PLAYLIST_EXTRACTOR_SUFFIXES = (
+    "Playlist",
+    "Tab",
+    "Channel",
+    "User",
+    "Album",
+    "Collection",
+    "Series",
+)
+
+# Local Bot API Server (optional). A self-hosted telegram-bot-api running with
+# --local on the same filesystem accepts uploads by file path up to 2000MB.
+LOCAL_BOT_API_BASE_URL = ""  # e.g. "http://localhost:8081/bot"
+LOCAL_BOT_API_BASE_FILE_URL = ""  # e.g. "http://localhost:8081/file/bot"
+LOCAL_BOT_API_UPLOAD_LIMIT_MB = 2000.0
+
+
+# Premium Tiers (Telegram Stars)
+PREMIUM_PRICES = {
+    "3_days": {
+        "stars": 50,
+        "days": 3,
+        "title": "Premium (3 Days)",
+        "description": "3 days of unlimited downloads",
+    },
+    "30_days": {
+        "stars": 250,
+        "days": 30,
+        "title": "Premium (30 Days)",
+        "description": "30 days of unlimited downloads",
+    },
+    "365_days": {
+        "stars": 1500,
+        "days": 365,
+        "title": "Premium (1 Year)",
+        "description": "1 year of unlimited downloads",
+    },
+}
+
+# Persistence Keys
+CHANNEL_SUBSCRIPTION_CONFIG_KEY = "channel_subscription_config"
+BANNED_USERS_KEY = "banned_user_ids"
+SENT_MEDIA_CACHE_KEY = "sent_media_file_ids"  # legacy, moved to its own table
+BROADCAST_STATE_KEY = "broadcast_state"  # legacy, moved to its own table
+UNREACHABLE_USERS_KEY = "unreachable_user_ids"  # legacy, moved to its own table
+# Runtime objects kept in bot_data but never persisted.
+HTTP_SESSION_KEY = "http_session"
+RUNTIME_BOT_DATA_KEYS = frozenset({HTTP_SESSION_KEY})
+
+# Outbound HTTP (one pooled aiohttp session for the whole app)
+HTTP_POOL_LIMIT = 100
+HTTP_POOL_LIMIT_PER_HOST = 10
+HTTP_DNS_CACHE_TTL_SECONDS = 300
+HTTP_KEEPALIVE_TIMEOUT_SECONDS = 30
+HTTP_DEFAULT_TIMEOUT_SECONDS = 30
+
+# yt-dlp Constants
+MAX_RETRIES_YTDLP = 3
+RETRY_DELAY_YTDLP = 5
+USER_AGENT_YTDLP = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+
+# Info Dict Cache. Extractor results are reused across requests; format URLs
+# are signed by most sites, so they expire earlier than the metadata.
+INFO_CACHE_MAX_ENTRIES = 2000
+INFO_CACHE_TTL_SECONDS = 6 * 60 * 60
+INFO_CACHE_FORMATS_DEFAULT_TTL_SECONDS = 20 * 60
+INFO_CACHE_URL_EXPIRY_MARGIN_SECONDS = 120
+INFO_CACHE_DIR = ""  # e.g. "info_cache" to keep entries across restarts
+EXTRACTOR_MATCH_CACHE_SIZE = 4096
+
+# Progress Reporting
+PROGRESS_EDIT_INTERVAL_SECONDS = 4.0
+PROGRESS_MIN_PERCENT_STEP = 5.0
+PROGRESS_HOOK_MIN_INTERVAL_SECONDS = 0.5
+
+# Streaming Upload (opt-in). Single-stream formats that need no FFmpeg merge are
+# piped from the source straight into the Telegram upload, skipping DOWNLOAD_DIR.
+STREAMING_UPLOAD_ENABLED = False
+STREAMING_UPLOAD_CHUNK_SIZE = 256 * 1024
+STREAMING_UPLOAD_BUFFER_CHUNKS = 16
+
+# Post-processing. Video+audio merges run in their own pool, sized to the
+# core count, so an FFmpeg mux never holds a download slot.
+MAX_CONCURRENT_MERGES = max(1, (os.cpu_count() or 2) // 2)
+FFMPEG_MERGE_TIMEOUT_SECONDS = 900
+
+# Download Scheduler
+MAX_CONCURRENT_DOWNLOADS = 4
+MAX_CONCURRENT_DOWNLOADS_PER_USER = {
+    ROLE_ADMIN: 3,
+    ROLE_PREMIUM: 2,
+    ROLE_STANDARD: 1,
+}
+QUEUE_POSITION_REFRESH_SECONDS = 3
+
+# Broadcast
+BROADCAST_MAX_MESSAGES_PER_SECOND = 25.0
+BROADCAST_MIN_MESSAGES_PER_SECOND = 5.0
+BROADCAST_CONCURRENCY = 8
+BROADCAST_MAX_ATTEMPTS_PER_USER = 3
+BROADCAST_CHECKPOINT_EVERY = 200
+BROADCAST_STATUS_UPDATE_SECONDS = 10
+
+# Channel Membership Cache
+CHANNEL_MEMBERSHIP_POSITIVE_TTL_SECONDS = 600
+CHANNEL_MEMBERSHIP_NEGATIVE_TTL_SECONDS = 30
+CHANNEL_MEMBERSHIP_CACHE_MAX_ENTRIES = 50000
+
+# Sent Media Cache (Telegram file_id reuse)
+SENT_MEDIA_CACHE_TTL_SECONDS = 7 * 24 * 3600
+SENT_MEDIA_CACHE_MAX_ENTRIES = 5000
+
+# Other Constants
+URL_REGEX = r"(?:(?:https?|ftp):\/\/)?(?:\S+(?::\S*)?@)?(?:(?!10(?:\.\d{1,3}){3})(?!127(?:\.\d{1,3}){3})(?!169\.254(?:\.\d{1,3}){2})(?!192\.168(?:\.\d{1,3}){2})(?!172\.(?:1[6-9]|2\d|3[0-1])(?:\.\d{1,3}){2})(?:[1-9]\d?|1\d\d|2[01]\d|22[0-3])(?:\.(?:1?\d{1,2}|2[0-4]\d|25[0-5])){2}(?:\.(?:[1-9]\d?|1\d\d|2[0-4]\d|25[0-4]))|(?:(?:[a-z\u00a1-\uffff0-9]+-?)*[a-z\u00a1-\uffff0-9]+)(?:\.(?:[a-z\u00a1-\uffff0-9]+-?)*[a-z\u00a1-\uffff0-9]+)*(?:\.(?:[a-z\u00a1-\uffff]{2,})))(?::\d{2,5})?(?:\/[^\s]*)?"
+TIKTOK_HOSTNAMES = [
+    "tiktok.com",
+    "www.tiktok.com",
+    "m.tiktok.com",
+    "vm.tiktok.com",
+    "vt.tiktok.com",
+]
+
+# URL Canonicalization
+# Mirror hosts collapse onto one host so every cache sees one key per item.
+CANONICAL_HOSTS = {
+    "youtube.com": "www.youtube.com",
+    "m.youtube.com": "www.youtube.com",
+    "tiktok.com": "www.tiktok.com",
+    "m.tiktok.com": "www.tiktok.com",
+    "instagram.com": "www.instagram.com",
+    "m.instagram.com": "www.instagram.com",
+    "facebook.com": "www.facebook.com",
+    "m.facebook.com": "www.facebook.com",
+    "twitter.com": "x.com",
+    "www.twitter.com": "x.com",
+    "mobile.twitter.com": "x.com",
+    "www.x.com": "x.com",
+}
+# Hosts listed here keep only these query parameters; elsewhere the tracking
+# parameters below are removed and the rest kept.
+CANONICAL_QUERY_ALLOWLIST = {
+    "www.youtube.com": {"v", "list"},
+    "www.tiktok.com": set(),
+    "www.instagram.com": set(),
+    "x.com": set(),
+}
+TRACKING_QUERY_PARAMS = {
+    "fbclid",
+    "gclid",
+    "igsh",
+    "igshid",
+    "si",
+    "feature",
+    "is_from_webapp",
+    "sender_device",
+    "_r",
+    "_t",
+    "ref",
+    "ref_src",
+}
+TRACKING_QUERY_PREFIXES = ("utm_", "share_")
+SHORT_LINK_HOSTS = {
+    "vm.tiktok.com",
+    "vt.tiktok.com",
+    "t.co",
+    "bit.ly",
+    "tinyurl.com",
+    "fb.watch",
+    "pin.it",
+}
+SHORT_LINK_CACHE_TTL_SECONDS = 24 * 3600
+SHORT_LINK_CACHE_MAX_ENTRIES = 10000
+SHORT_LINK_RESOLVE_TIMEOUT_SECONDS = 10
+
+# Premium expiry scheduler: wakes at the next expiry, and at least this often
+# so wall clock adjustments are picked up.
+PREMIUM_EXPIRY_MAX_SLEEP_SECONDS = 3600
+
+# Persistence Setup
+PERSISTENCE_DB_PATH = "bot_persistence.sqlite3"
+LEGACY_PICKLE_PERSISTENCE_PATH = "bot_persistence.pickle"
+PERSISTENCE_FLUSH_DELAY_SECONDS = 2.0
+PERSISTENCE_FLUSH_MAX_PENDING = 50
+# Download job journal (a table in PERSISTENCE_DB_PATH). Interrupted jobs are
+# replayed on startup unless they are too old or were already retried.
+DOWNLOAD_JOB_REPLAY_MAX_AGE_SECONDS = 6 * 3600
+DOWNLOAD_JOB_MAX_ATTEMPTS = 3
+DOWNLOAD_JOB_HISTORY_SECONDS = 7 * 24 * 3600
+
+
+# --- User Registry ---
+class UserRegistry:
+    # Role index over the persisted user records. The user data store reports
+    # every write here, so /stats and /viewusers read counters and sorted id
+    # lists instead of walking the whole user base.
+    def __init__(self):
+        # Called with (user_id, expiry_ts) whenever a premium expiry is indexed.
+        self.expiry_listener: Optional[Callable[[int, float], None]] = None
+        self._reset()
+
+    def _reset(self):
+        self._records: Optional[Dict[int, Dict[str, Any]]] = None
+        self._banned: set = set()
+        self._state: Dict[int, Tuple[str, Optional[float], bool]] = {}
+        self._all_ids: List[int] = []
+        self._ids_by_role: Dict[str, List[int]] = {
+            ROLE_ADMIN: [],
+            ROLE_PREMIUM: [],
+            ROLE_STANDARD: [],
+            ROLE_BANNED: [],
+        }
+        # (expiry_ts, user_id) for every indexed premium user, oldest first.
+        self._premium_expiries: List[Tuple[float, int]] = []
+        self._had_premium_standard = 0
+
+    def rebuild(self, records: Dict[int, Dict[str, Any]], banned_ids):
+        self._reset()
+        self._records = records
+        self._banned = set(banned_ids or ())
+        for user_id in records:
+            self.refresh(user_id)
+
+    def _classify(self, user_id: int) -> Optional[Tuple[str, Optional[float], bool]]:
+        record = self._records.get(user_id)
+        if record is None:
+            return None
+        expiry = (
+            record.get("premium_expiry_timestamp") if record.get("is_premium") else None
+        )
+        tier = record.get("premium_tier")
+        had_premium = bool(tier) and tier not in PREMIUM_HISTORY_EXCLUDED_TIERS
+        if user_id in self._banned:
+            return ROLE_BANNED, None, False
+        if user_id in ADMIN_IDS:
+            return ROLE_ADMIN, expiry, False
+        if expiry:
+            return ROLE_PREMIUM, expiry, had_premium
+        return ROLE_STANDARD, None, had_premium
+
+    def refresh(self, user_id: int):
+        if self._records is None:
+            return
+        new_state = self._classify(user_id)
+        old_state = self._state.get(user_id)
+        if new_state == old_state:
+            return
+        if old_state is not None:
+            self._unindex(user_id, old_state)
+        if new_state is not None:
+            self._index(user_id, new_state)
+
+    def _index(self, user_id: int, state: Tuple[str, Optional[float], bool]):
+        role, expiry, had_premium = state
+        self._state[user_id] = state
+        bisect.insort(self._all_ids, user_id)
+        bisect.insort(self._ids_by_role[role], user_id)
+        if role == ROLE_PREMIUM:
+            bisect.insort(self._premium_expiries, (expiry, user_id))
+        elif role == ROLE_STANDARD and had_premium:
+            self._had_premium_standard += 1
+        if expiry and self.expiry_listener is not None:
+            self.expiry_listener(user_id, expiry)
+
+    def _unindex(self, user_id: int, state: Tuple[str, Optional[float], bool]):
+        role, expiry, had_premium = state
+        del self._state[user_id]
+        _remove_sorted(self._all_ids, user_id)
+        _remove_sorted(self._ids_by_role[role], user_id)
+        if role == ROLE_PREMIUM:
+            _remove_sorted(self._premium_expiries, (expiry, user_id))
+        elif role == ROLE_STANDARD and had_premium:
+            self._had_premium_standard -= 1
+
+    def set_banned(self, user_id: int, banned: bool):
+        if banned:
+            self._banned.add(user_id)
+        else:
+            self._banned.discard(user_id)
+        self.refresh(user_id)
+
+    def role_of(self, user_id: int) -> str:
+        state = self._state.get(user_id)
+        if state is not None:
+            role, expiry, _ = state
+            # Safety net for when the expiry scheduler is late or not running.
+            if role == ROLE_PREMIUM and expiry <= datetime.datetime.now().timestamp():
+                return ROLE_STANDARD
+            return role
+        if user_id in self._banned:
+            return ROLE_BANNED
+        return ROLE_ADMIN if user_id in ADMIN_IDS else ROLE_STANDARD
+
+    def premium_expiry(self, user_id: int) -> Optional[float]:
+        state = self._state.get(user_id)
+        return state[1] if state is not None else None
+
+    def _expired_premium_count(self, now: float) -> int:
+        return bisect.bisect_right(self._premium_expiries, (now, float("inf")))
+
+    def counts(self) -> Dict[str, int]:
+        # Premium users whose expiry has passed but whose record was not
+        # cleaned up yet are reported as standard, like get_user_role does.
+        now = datetime.datetime.now().timestamp()
+        expired_premium = self._expired_premium_count(now)
+        admin_premium = sum(
+            1
+            for user_id in self._ids_by_role[ROLE_ADMIN]
+            if (self._state[user_id][1] or 0) > now
+        )
+        return {
+            "total": len(self._all_ids),
+            ROLE_ADMIN: len(self._ids_by_role[ROLE_ADMIN]) - admin_premium,
+            "admin_premium": admin_premium,
+            ROLE_PREMIUM: len(self._ids_by_role[ROLE_PREMIUM]) - expired_premium,
+            ROLE_STANDARD: len(self._ids_by_role[ROLE_STANDARD]) + expired_premium,
+            ROLE_BANNED: len(self._banned),
+            "had_premium": self._had_premium_standard + expired_premium,
+            "admins_interacted": len(self._ids_by_role[ROLE_ADMIN]),
+        }
+
+    def next_premium_expiry(self) -> Optional[Tuple[float, int]]:
+        return self._premium_expiries[0] if self._premium_expiries else None
+
+    def user_ids_after(self, after_user_id: int) -> List[int]:
+        return self._all_ids[bisect.bisect_right(self._all_ids, after_user_id) :]
+
+    def page(
+        self, role: Optional[str], after_user_id: Optional[int], limit: int
+    ) -> Tuple[List[int], Optional[int]]:
+        # Cursor pagination in ascending user id order. Returns the page and
+        # the cursor for the next one (None on the last page).
+        now = datetime.datetime.now().timestamp()
+        if role is None:
+            sources = [self._all_ids]
+        elif role == ROLE_STANDARD:
+            sources = [self._ids_by_role[ROLE_STANDARD], self._ids_by_role[ROLE_PREMIUM]]
+        else:
+            sources = [self._ids_by_role[role]]
+        start = -float("inf") if after_user_id is None else after_user_id
+        candidates = heapq.merge(*(_iter_sorted_after(ids, start) for ids in sources))
+        page: List[int] = []
+        for user_id in candidates:
+            if role in (ROLE_PREMIUM, ROLE_STANDARD):
+                premium_state = self._state[user_id]
+                still_premium = premium_state[0] == ROLE_PREMIUM and premium_state[1] > now
+                if still_premium != (role == ROLE_PREMIUM):
+                    continue
+            if len(page) == limit:
+                return page, page[-1]
+            page.append(user_id)
+        return page, None
+
+
+def _iter_sorted_after(items: list, value):
+    for index in range(bisect.bisect_right(items, value), len(items)):
+        yield items[index]
+
+
+def _remove_sorted(items: list, value):
+    index = bisect.bisect_left(items, value)
+    if index < len(items) and items[index] == value:
+        del items[index]
+
+
+USER_REGISTRY = UserRegistry()
+
+
+# --- Persistence ---
+class BotData(dict):
+    # bot_data that leaves runtime objects (RUNTIME_BOT_DATA_KEYS) out of the
+    # deep copies and pickles handed to persistence.
+    def _persistent_items(self) -> Dict[Any, Any]:
+        return {k: v for k, v in self.items() if k not in RUNTIME_BOT_DATA_KEYS}
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(self._persistent_items(), memo)
+
+    def __reduce__(self):
+        return (dict, (self._persistent_items(),))
+
+
+class _TrackedUserData(dict):
+    # A user_data entry that reports in-place modifications, so only changed
+    # users are written back to the store.
+    __slots__ = ("_mark_dirty",)
+
+    def __init__(self, data: Dict[str, Any], mark_dirty: Callable[[], None]):
+        super().__init__(data)
+        self._mark_dirty = mark_dirty
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+    def __setitem__(self, key, value):
+        if key in self and dict.__getitem__(self, key) == value:
+            return
+        super().__setitem__(key, value)
+        self._mark_dirty()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._mark_dirty()
+
+    def pop(self, key, *default):
+        if key not in self:
+            return super().pop(key, *default)
+        value = super().pop(key)
+        self._mark_dirty()
+        return value
+
+    def popitem(self):
+        item = super().popitem()
+        self._mark_dirty()
+        return item
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        had_items = bool(self)
+        super().clear()
+        if had_items:
+            self._mark_dirty()
+
+
+class _UserDataStore(dict):
+    def __init__(
+        self, dirty_user_ids: set, registry: Optional[UserRegistry] = None
+    ):
+        super().__init__()
+        self._dirty_user_ids = dirty_user_ids
+        self._registry = registry
+
+    def load(self, user_id: int, data: Dict[str, Any]):
+        dict.__setitem__(self, user_id, self._track(user_id, data))
+
+    def _track(self, user_id: int, data: Dict[str, Any]) -> _TrackedUserData:
+        if isinstance(data, _TrackedUserData):
+            return data
+        return _TrackedUserData(data or {}, functools.partial(self._touch, user_id))
+
+    def _touch(self, user_id: int):
+        self._dirty_user_ids.add(user_id)
+        if self._registry is not None:
+            self._registry.refresh(user_id)
+
+    def __setitem__(self, user_id, data):
+        super().__setitem__(user_id, self._track(user_id, data))
+        self._touch(user_id)
+
+    def setdefault(self, user_id, default=None):
+        if user_id not in self:
+            self[user_id] = default
+        return dict.__getitem__(self, user_id)
+
+    def __delitem__(self, user_id):
+        super().__delitem__(user_id)
+        self._touch(user_id)
+
+    def pop(self, user_id, *default):
+        if user_id not in self:
+            return super().pop(user_id, *default)
+        data = super().pop(user_id)
+        self._touch(user_id)
+        return data
+
+
+class SQLitePersistence(BasePersistence):
+    # Rows are pickled per user/chat; only entries that changed since the last
+    # write are touched, so write cost follows activity instead of user count.
+    _KV_BOT_DATA = "bot_data"
+    _KV_CALLBACK_DATA = "callback_data"
+    _KV_CONVERSATIONS = "conversations"
+    _KV_MIGRATED_FROM = "migrated_from_pickle"
+
+    def __init__(
+        self,
+        filepath: str,
+        legacy_pickle_path: Optional[str] = None,
+        update_interval: float = 60,
+        flush_delay: float = 2.0,
+        flush_max_pending: int = 50,
+        user_registry: Optional[UserRegistry] = None,
+    ):
+        super().__init__(update_interval=update_interval)
+        self.filepath = filepath
+        self.user_registry = user_registry
+        self.legacy_pickle_path = legacy_pickle_path
+        self.flush_delay = flush_delay
+        self.flush_max_pending = flush_max_pending
+        self._flush_task: Optional[asyncio.Future] = None
+        self._eager_flush_task: Optional[asyncio.Future] = None
+        self._write_lock: Optional[asyncio.Lock] = None
+        self._dirty_user_ids: set = set()
+        self._dirty_chat_ids: set = set()
+        self._dirty_kv_keys: set = set()
+        self.user_data: Optional[_UserDataStore] = None
+        self.chat_data: Optional[Dict[int, Dict[Any, Any]]] = None
+        self.bot_data: Optional[Dict[Any, Any]] = None
+        self.callback_data: Optional[Any] = None
+        self.conversations: Optional[Dict[str, Dict[Any, Any]]] = None
+        self._connection: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.filepath, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.executescript(
+                "CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data BLOB NOT NULL);"
+                "CREATE TABLE IF NOT EXISTS chat_data (chat_id INTEGER PRIMARY KEY, data BLOB NOT NULL);"
+                "CREATE TABLE IF NOT EXISTS kv_data (key TEXT PRIMARY KEY, data BLOB NOT NULL);"
+            )
+        return self._connection
+
+    def _read_kv(self, key: str, default: Any = None) -> Any:
+        row = (
+            self._connect()
+            .execute("SELECT data FROM kv_data WHERE key = ?", (key,))
+            .fetchone()
+        )
+        return pickle.loads(row[0]) if row else default
+
+    async def _ensure_loaded(self):
+        if self.user_data is not None:
+            return
+        connection = self._connect()
+        self.user_data = _UserDataStore(self._dirty_user_ids, self.user_registry)
+        for user_id, blob in connection.execute("SELECT user_id, data FROM user_data"):
+            self.user_data.load(user_id, pickle.loads(blob))
+        self.chat_data = {
+            chat_id: pickle.loads(blob)
+            for chat_id, blob in connection.execute("SELECT chat_id, data FROM chat_data")
+        }
+        self.bot_data = self._read_kv(self._KV_BOT_DATA, {})
+        self.callback_data = self._read_kv(self._KV_CALLBACK_DATA)
+        self.conversations = self._read_kv(self._KV_CONVERSATIONS, {})
+        if (
+            self.legacy_pickle_path
+            and os.path.exists(self.legacy_pickle_path)
+            and self._read_kv(self._KV_MIGRATED_FROM) is None
+            and not self.user_data
+            and not self.bot_data
+        ):
+            await self._migrate_from_pickle()
+        if self.user_registry is not None:
+            self.user_registry.rebuild(
+                self.user_data, self.bot_data.get(BANNED_USERS_KEY, set())
+            )
+
+    async def _migrate_from_pickle(self):
+        legacy = PicklePersistence(filepath=self.legacy_pickle_path)
+        legacy.set_bot(self.bot)
+        for user_id, data in ((await legacy.get_user_data()) or {}).items():
+            self.user_data[user_id] = data
+        for chat_id, data in ((await legacy.get_chat_data()) or {}).items():
+            self.chat_data[chat_id] = data
+            self._dirty_chat_ids.add(chat_id)
+        self.bot_data = (await legacy.get_bot_data()) or {}
+        self.callback_data = await legacy.get_callback_data()
+        self.conversations = legacy.conversations or {}
+        self._dirty_kv_keys.update(
+            {self._KV_BOT_DATA, self._KV_CALLBACK_DATA, self._KV_CONVERSATIONS}
+        )
+        self._write_dirty(
+            extra_kv={self._KV_MIGRATED_FROM: self.legacy_pickle_path}
+        )
+        print(
+            f"Migrated {len(self.user_data)} users from {self.legacy_pickle_path} to {self.filepath}."
+        )
+
+    def _collect_dirty(
+        self, extra_kv: Optional[Dict[str, Any]] = None
+    ) -> Optional[Dict[str, list]]:
+        if self.user_data is None:
+            return None
+        rows = {"user_rows": [], "user_deletes": [], "chat_rows": [], "chat_deletes": []}
+        for user_id in self._dirty_user_ids:
+            if user_id in self.user_data:
+                rows["user_rows"].append(
+                    (user_id, pickle.dumps(dict(self.user_data[user_id])))
+                )
+            else:
+                rows["user_deletes"].append((user_id,))
+        for chat_id in self._dirty_chat_ids:
+            if chat_id in self.chat_data:
+                rows["chat_rows"].append((chat_id, pickle.dumps(self.chat_data[chat_id])))
+            else:
+                rows["chat_deletes"].append((chat_id,))
+        kv_values = {
+            self._KV_BOT_DATA: self.bot_data,
+            self._KV_CALLBACK_DATA: self.callback_data,
+            self._KV_CONVERSATIONS: self.conversations,
+        }
+        rows["kv_rows"] = [
+            (key, pickle.dumps(kv_values[key])) for key in self._dirty_kv_keys
+        ]
+        rows["kv_rows"].extend(
+            (key, pickle.dumps(value)) for key, value in (extra_kv or {}).items()
+        )
+        self._dirty_user_ids.clear()
+        self._dirty_chat_ids.clear()
+        self._dirty_kv_keys.clear()
+        return rows if any(rows.values()) else None
+
+    def _commit_rows(self, rows: Dict[str, list]):
+        connection = self._connect()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)",
+                rows["user_rows"],
+            )
+            connection.executemany(
+                "DELETE FROM user_data WHERE user_id = ?", rows["user_deletes"]
+            )
+            connection.executemany(
+                "INSERT OR REPLACE INTO chat_data (chat_id, data) VALUES (?, ?)",
+                rows["chat_rows"],
+            )
+            connection.executemany(
+                "DELETE FROM chat_data WHERE chat_id = ?", rows["chat_deletes"]
+            )
+            connection.executemany(
+                "INSERT OR REPLACE INTO kv_data (key, data) VALUES (?, ?)",
+                rows["kv_rows"],
+            )
+
+    def _restore_dirty(self, rows: Dict[str, list]):
+        # A failed commit must not lose the changes it was carrying; put the
+        # ids back so the next flush retries them.
+        self._dirty_user_ids.update(row[0] for row in rows["user_rows"])
+        self._dirty_user_ids.update(row[0] for row in rows["user_deletes"])
+        self._dirty_chat_ids.update(row[0] for row in rows["chat_rows"])
+        self._dirty_chat_ids.update(row[0] for row in rows["chat_deletes"])
+        self._dirty_kv_keys.update(
+            row[0]
+            for row in rows["kv_rows"]
+            if row[0]
+            in (self._KV_BOT_DATA, self._KV_CALLBACK_DATA, self._KV_CONVERSATIONS)
+        )
+
+    def _write_dirty(self, extra_kv: Optional[Dict[str, Any]] = None):
+        rows = self._collect_dirty(extra_kv)
+        if rows:
+            try:
+                self._commit_rows(rows)
+            except BaseException:
+                self._restore_dirty(rows)
+                raise
+
+    def stage_user_data(self, user_id: int, data: Dict[Any, Any]):
+        if self.user_data is None or data is None:
+            return
+        if self.user_data.get(user_id) != data:
+            self.user_data[user_id] = copy.deepcopy(dict(data))
+
+    def schedule_flush(self):
+        # Write-behind: changes are coalesced and written by a background task,
+        # either after flush_delay seconds or once enough users are pending.
+        pending = len(self._dirty_user_ids) + len(self._dirty_chat_ids)
+        if pending >= self.flush_max_pending and (
+            self._eager_flush_task is None or self._eager_flush_task.done()
+        ):
+            self._eager_flush_task = asyncio.ensure_future(self._guarded_flush())
+        elif self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._delayed_flush())
+
+    async def _guarded_flush(self):
+        try:
+            await self.flush()
+        except Exception as e:
+            print(f"ERROR: Background persistence flush failed: {e}")
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.flush_delay)
+        await self._guarded_flush()
+
+    async def get_user_data(self) -> Dict[int, Dict[Any, Any]]:
+        await self._ensure_loaded()
+        return {user_id: copy.deepcopy(dict(data)) for user_id, data in self.user_data.items()}
+
+    async def get_chat_data(self) -> Dict[int, Dict[Any, Any]]:
+        await self._ensure_loaded()
+        return copy.deepcopy(self.chat_data)
+
+    async def get_bot_data(self) -> Dict[Any, Any]:
+        await self._ensure_loaded()
+        return BotData(copy.deepcopy(self.bot_data))
+
+    async def get_callback_data(self) -> Optional[Any]:
+        await self._ensure_loaded()
+        return copy.deepcopy(self.callback_data)
+
+    async def get_conversations(self, name: str) -> Dict[Any, Any]:
+        await self._ensure_loaded()
+        return copy.deepcopy(self.conversations.get(name, {}))
+
+    async def update_conversation(self, name: str, key: Any, new_state: Optional[object]):
+        await self._ensure_loaded()
+        if self.conversations.setdefault(name, {}).get(key) == new_state:
+            return
+        self.conversations[name][key] = new_state
+        self._dirty_kv_keys.add(self._KV_CONVERSATIONS)
+        self.schedule_flush()
+
+    async def update_user_data(self, user_id: int, data: Dict[Any, Any]):
+        await self._ensure_loaded()
+        if self.user_data.get(user_id) == data:
+            return
+        self.user_data[user_id] = data
+        self.schedule_flush()
+
+    async def update_chat_data(self, chat_id: int, data: Dict[Any, Any]):
+        await self._ensure_loaded()
+        if self.chat_data.get(chat_id) == data:
+            return
+        self.chat_data[chat_id] = data
+        self._dirty_chat_ids.add(chat_id)
+        self.schedule_flush()
+
+    async def update_bot_data(self, data: Dict[Any, Any]):
+        await self._ensure_loaded()
+        if self.bot_data == data:
+            return
+        self.bot_data = data
+        self._dirty_kv_keys.add(self._KV_BOT_DATA)
+        self.schedule_flush()
+
+    async def update_callback_data(self, data: Any):
+        await self._ensure_loaded()
+        if self.callback_data == data:
+            return
+        self.callback_data = data
+        self._dirty_kv_keys.add(self._KV_CALLBACK_DATA)
+        self.schedule_flush()
+
+    async def drop_chat_data(self, chat_id: int):
+        await self._ensure_loaded()
+        self.chat_data.pop(chat_id, None)
+        self._dirty_chat_ids.add(chat_id)
+        self.schedule_flush()
+
+    async def drop_user_data(self, user_id: int):
+        await self._ensure_loaded()
+        self.user_data.pop(user_id, None)
+        self.schedule_flush()
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[Any, Any]):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict[Any, Any]):
+        pass
+
+    async def refresh_bot_data(self, bot_data: Dict[Any, Any]):
+        pass
+
+    async def flush(self):
+        if self._write_lock is None:
+            self._write_lock = asyncio.Lock()
+        async with self._write_lock:
+            rows = self._collect_dirty()
+            if rows:
+                try:
+                    await asyncio.to_thread(self._commit_rows, rows)
+                except BaseException:
+                    self._restore_dirty(rows)
+                    raise
+
+
+PERSISTENCE = SQLitePersistence(
+    PERSISTENCE_DB_PATH,
+    legacy_pickle_path=LEGACY_PICKLE_PERSISTENCE_PATH,
+    flush_delay=PERSISTENCE_FLUSH_DELAY_SECONDS,
+    flush_max_pending=PERSISTENCE_FLUSH_MAX_PENDING,
+    user_registry=USER_REGISTRY,
+)
+
+
+def request_persistence_flush(
+    context: ContextTypes.DEFAULT_TYPE, user_id: Optional[int] = None
+):
+    persistence = context.application.persistence
+    if user_id is not None:
+        persistence.stage_user_data(user_id, context.user_data)
+    persistence.schedule_flush()
+
+
+async def flush_persistence_now(
+    context: ContextTypes.DEFAULT_TYPE, include_bot_data: bool = False
+):
+    persistence = context.application.persistence
+    if include_bot_data:
+        await persistence.update_bot_data(copy.deepcopy(context.bot_data))
+    await persistence.flush()
+
+
+def apply_user_fields(
+    application: Application, user_id: int, fields: Dict[str, Any]
+) -> Dict[str, Any]:
+    # Writes to the persisted record and to the live Application copy, so the
+    # periodic persistence update cannot overwrite the change with stale data.
+    master_ud = application.persistence.user_data.setdefault(
+        user_id, {"_id": user_id}
+    )
+    master_ud.update(fields)
+    live_ud = application.user_data.get(user_id)
+    if live_ud is not None and live_ud is not master_ud:
+        live_ud.update(fields)
+    return master_ud
+
+
+def update_user_fields(
+    context: ContextTypes.DEFAULT_TYPE, user_id: int, fields: Dict[str, Any]
+) -> Dict[str, Any]:
+    return apply_user_fields(context.application, user_id, fields)
+
+
+# --- Premium Expiry ---
+class PremiumExpiryScheduler:
+    # Min-heap of (expiry_ts, user_id) fed by the user registry. Entries are
+    # not removed when premium is extended or revoked; stale ones are skipped
+    # when they reach the top, by comparing with the registry's current expiry.
+    def __init__(self, registry: UserRegistry):
+        self._registry = registry
+        self._heap: List[Tuple[float, int]] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        registry.expiry_listener = self.schedule
+
+    def schedule(self, user_id: int, expiry_ts: float):
+        heapq.heappush(self._heap, (expiry_ts, user_id))
+        if self._wakeup is not None and self._heap[0] == (expiry_ts, user_id):
+            self._wakeup.set()
+
+    def start(self, application: Application):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run(application))
+
+    def stop(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    async def _run(self, application: Application):
+        while True:
+            self._wakeup.clear()
+            now = datetime.datetime.now().timestamp()
+            while self._heap and self._heap[0][0] <= now:
+                expiry_ts, user_id = heapq.heappop(self._heap)
+                if self._registry.premium_expiry(user_id) != expiry_ts:
+                    continue
+                try:
+                    expire_user_premium(application, user_id)
+                except Exception as e:
+                    print(f"ERROR: Failed to expire premium for user {user_id}: {e}")
+            timeout = PREMIUM_EXPIRY_MAX_SLEEP_SECONDS
+            if self._heap:
+                timeout = min(timeout, max(0.0, self._heap[0][0] - now))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+def expire_user_premium(application: Application, user_id: int):
+    record = application.persistence.user_data.get(user_id, {})
+    tier = record.get("premium_tier")
+    apply_user_fields(
+        application,
+        user_id,
+        {
+            "is_premium": False,
+            "premium_expiry_timestamp": None,
+            "premium_tier": (
+                tier
+                if str(tier or "").startswith(("admin_", "revoked_"))
+                else "expired_or_cleaned"
+            ),
+        },
+    )
+    application.persistence.schedule_flush()
+    print(f"Premium expired for user {user_id}.")
+
+
+PREMIUM_EXPIRY_SCHEDULER = PremiumExpiryScheduler(USER_REGISTRY)
+
+
+# --- Utility Functions ---
+def sanitize_filename(filename: str, max_length: int = 60) -> str:
+    sane = re.sub(r'[\\/*?:"<>|]', "_", filename).strip(" .")
+    sane = "".join(c for c in sane if c.isprintable() or c == " ")
+    sane = re.sub(r"\s+", "_", sane)
+    sane = re.sub(r"__+", "_", sane)
+    return sane[:max_length] if sane else "downloaded_media"
+
+
+try:
+    FFMPEG_AVAILABLE = (
+        subprocess.run(
+            ["ffmpeg", "-version"], capture_output=True, text=True, timeout=10
+        ).returncode
+        == 0
+    )
+except FileNotFoundError:
+    FFMPEG_AVAILABLE = False
+except subprocess.TimeoutExpired:
+    FFMPEG_AVAILABLE = False
+    print("WARNING: FFmpeg check timed out.")
+if FFMPEG_AVAILABLE:
+    print("FFmpeg found and working.")
+else:
+    print(
+        "WARNING: FFmpeg check failed or FFmpeg not found. Some features might be affected."
+    )
+
+
+def is_local_bot_api_enabled() -> bool:
+    return bool(LOCAL_BOT_API_BASE_URL)
+
+
+def get_direct_send_limit_mb() -> float:
+    return (
+        LOCAL_BOT_API_UPLOAD_LIMIT_MB
+        if is_local_bot_api_enabled()
+        else PREMIUM_ADMIN_DIRECT_SEND_LIMIT_MB
+    )
+
+
+async def fetch_http_content(
+    session: aiohttp.ClientSession, url: str
+) -> Optional[bytes]:
+    try:
+        async with session.get(url, timeout=30) as response:
+            response.raise_for_status()
+            return await response.read()
+    except Exception as e:
+        print(f"Error fetching {url}: {e}")
+        return None
+
+
+# --- Outbound HTTP ---
+_HTTP_POOL_METRICS: Dict[str, int] = {
+    "requests": 0,
+    "request_errors": 0,
+    "connections_created": 0,
+    "connections_reused": 0,
+    "dns_cache_hits": 0,
+    "dns_cache_misses": 0,
+}
+
+
+def _count_http_event(metric: str):
+    async def _on_event(session, trace_ctx, params):
+        _HTTP_POOL_METRICS[metric] += 1
+
+    return _on_event
+
+
+def create_http_session() -> aiohttp.ClientSession:
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(_count_http_event("requests"))
+    trace_config.on_request_exception.append(_count_http_event("request_errors"))
+    trace_config.on_connection_create_end.append(
+        _count_http_event("connections_created")
+    )
+    trace_config.on_connection_reuseconn.append(_count_http_event("connections_reused"))
+    trace_config.on_dns_cache_hit.append(_count_http_event("dns_cache_hits"))
+    trace_config.on_dns_cache_miss.append(_count_http_event("dns_cache_misses"))
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL_SECONDS,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT_SECONDS,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=HTTP_DEFAULT_TIMEOUT_SECONDS),
+        headers={"User-Agent": USER_AGENT_YTDLP},
+        trace_configs=[trace_config],
+    )
+
+
+def get_http_session(bot_data: Dict[Any, Any]) -> aiohttp.ClientSession:
+    """The shared session from bot_data; recreated if missing or closed."""
+    session = bot_data.get(HTTP_SESSION_KEY)
+    if session is None or session.closed:
+        session = create_http_session()
+        bot_data[HTTP_SESSION_KEY] = session
+    return session
+
+
+async def close_http_session(bot_data: Dict[Any, Any]):
+    session = bot_data.pop(HTTP_SESSION_KEY, None)
+    if session is not None and not session.closed:
+        await session.close()
+
+
+def http_pool_stats(bot_data: Dict[Any, Any]) -> Dict[str, int]:
+    stats = dict(_HTTP_POOL_METRICS)
+    session = bot_data.get(HTTP_SESSION_KEY)
+    if session is not None and not session.closed:
+        connector = session.connector
+        stats["limit"] = connector.limit
+        stats["limit_per_host"] = connector.limit_per_host
+        # aiohttp has no public gauge for these; read the connector's own
+        # bookkeeping for an approximate view.
+        stats["in_use"] = len(getattr(connector, "_acquired", ()))
+        stats["idle"] = sum(len(c) for c in getattr(connector, "_conns", {}).values())
+    return stats
+
+
+async def resolve_redirect_target(
+    session: aiohttp.ClientSession, url: str
+) -> Optional[str]:
+    try:
+        async with session.get(
+            url,
+            allow_redirects=True,
+            max_redirects=10,
+            timeout=aiohttp.ClientTimeout(total=SHORT_LINK_RESOLVE_TIMEOUT_SECONDS),
+        ) as response:
+            return str(response.url)
+    except Exception as e:
+        print(f"Error resolving {url}: {e}")
+        return None
+
+
+# --- URL Canonicalization ---
+_SHORT_LINK_CACHE: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+
+
+def normalize_media_url(url: str) -> str:
+    """Offline canonical form: collapsed mirror hosts, no tracking parameters
+    or fragment, and youtu.be / Shorts links as watch URLs."""
+    url = url.strip()
+    if not url.startswith(("http://", "https://")):
+        url = "https://" + url
+    try:
+        parsed = urlparse(url)
+    except ValueError:
+        return url
+    host = (parsed.hostname or "").lower()
+    host = CANONICAL_HOSTS.get(host, host)
+    path = parsed.path.rstrip("/") or "/"
+    query = parse_qs(parsed.query, keep_blank_values=True)
+    if host == "youtu.be" and len(path) > 1:
+        host, query = "www.youtube.com", dict(query, v=[path.lstrip("/")])
+        path = "/watch"
+    elif host == "www.youtube.com" and path.startswith("/shorts/"):
+        query = dict(query, v=[path.split("/")[2]])
+        path = "/watch"
+    kept = sorted(
+        (key, value)
+        for key, values in query.items()
+        if _keep_query_param(host, key)
+        for value in values
+    )
+    netloc = host if not parsed.port else f"{host}:{parsed.port}"
+    return urlunparse(
+        ((parsed.scheme or "https").lower(), netloc, path, "", urlencode(kept), "")
+    )
+
+
+def _keep_query_param(host: str, key: str) -> bool:
+    allowed = CANONICAL_QUERY_ALLOWLIST.get(host)
+    if allowed is not None:
+        return key in allowed
+    key = key.lower()
+    return key not in TRACKING_QUERY_PARAMS and not key.startswith(
+        TRACKING_QUERY_PREFIXES
+    )
+
+
+def is_short_link(url: str) -> bool:
+    parsed = urlparse(url)
+    host = (parsed.hostname or "").lower()
+    return host in SHORT_LINK_HOSTS or (
+        host == "www.tiktok.com" and parsed.path.startswith("/t/")
+    )
+
+
+async def canonicalize_media_url(url: str, session: aiohttp.ClientSession) -> str:
+    """normalize_media_url plus one-time resolution of short links; each
+    short -> long mapping is cached."""
+    url = normalize_media_url(url)
+    if not is_short_link(url):
+        return url
+    cached = _SHORT_LINK_CACHE.get(url)
+    if cached and time.time() - cached[1] < SHORT_LINK_CACHE_TTL_SECONDS:
+        _SHORT_LINK_CACHE.move_to_end(url)
+        return cached[0]
+    target = await resolve_redirect_target(session, url)
+    if not target:
+        return url
+    resolved = normalize_media_url(target)
+    _SHORT_LINK_CACHE[url] = (resolved, time.time())
+    _SHORT_LINK_CACHE.move_to_end(url)
+    while len(_SHORT_LINK_CACHE) > SHORT_LINK_CACHE_MAX_ENTRIES:
+        _SHORT_LINK_CACHE.popitem(last=False)
+    return resolved
+
+
+# --- Info Dict Cache ---
+_INFO_CACHE_DROPPED_KEYS = (
+    "thumbnails",
+    "subtitles",
+    "automatic_captions",
+    "heatmap",
+    "comments",
+    "chapters",
+    "tags",
+    "categories",
+)
+_SIGNED_URL_EXPIRY_PARAMS = ("expire", "expires", "x-expires")
+_EXTRACTOR_CLASSES: Optional[List[Any]] = None
+
+
+@functools.lru_cache(maxsize=EXTRACTOR_MATCH_CACHE_SIZE)
+def match_extractor(url: str) -> Optional[Any]:
+    """The first non-generic yt-dlp extractor class whose URL pattern matches,
+    without any network I/O.
+
+    A miss walks every extractor pattern, so results are memoised per URL and
+    event-loop callers should run it in a thread.
+    """
+    global _EXTRACTOR_CLASSES
+    if _EXTRACTOR_CLASSES is None:
+        _EXTRACTOR_CLASSES = [
+            ie
+            for ie in yt_dlp.extractor.gen_extractor_classes()
+            if ie.ie_key() != "Generic"
+        ]
+    for ie in _EXTRACTOR_CLASSES:
+        try:
+            if ie.suitable(url):
+                return ie
+        except Exception:
+            continue
+    return None
+
+
+def media_identity_from_url(url: str) -> Optional[str]:
+    """Returns "<extractor key>:<id>" when the URL pattern carries an id."""
+    ie = match_extractor(url)
+    if ie is None:
+        return None
+    try:
+        temp_id = ie.get_temp_id(url)
+    except Exception:
+        return None
+    return f"{ie.ie_key()}:{temp_id}" if temp_id else None
+
+
+def looks_like_playlist_url(url: str) -> bool:
+    if "list" in parse_qs(urlparse(url).query):
+        return True
+    ie = match_extractor(url)
+    return ie is not None and ie.ie_key().endswith(PLAYLIST_EXTRACTOR_SUFFIXES)
+
+
+def _signed_urls_expire_at(info: Dict[str, Any], now_ts: float) -> float:
+    expiries = []
+    for fmt in info.get("formats") or [info]:
+        for format_url in (fmt.get("url"), fmt.get("manifest_url")):
+            if not format_url:
+                continue
+            query = parse_qs(urlparse(format_url).query)
+            for param in _SIGNED_URL_EXPIRY_PARAMS:
+                try:
+                    expiries.append(float(query[param][0]))
+                except (KeyError, IndexError, ValueError):
+                    pass
+    if expiries:
+        return min(expiries) - INFO_CACHE_URL_EXPIRY_MARGIN_SECONDS
+    return now_ts + INFO_CACHE_FORMATS_DEFAULT_TTL_SECONDS
+
+
+class InfoDictCache:
+    # LRU of trimmed, JSON-safe info dicts keyed by "<extractor key>:<id>".
+    # Lookups go through aliases: the normalized request URL and the id that
+    # yt-dlp's URL patterns yield offline. Used from download worker threads.
+    def __init__(self, max_entries: int, ttl_seconds: float, disk_dir: str = ""):
+        self._max_entries = max_entries
+        self._ttl_seconds = ttl_seconds
+        self._disk_dir = disk_dir
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._aliases: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._disk_loaded = not disk_dir
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(
+            self._disk_dir, hashlib.sha1(key.encode()).hexdigest() + ".json"
+        )
+
+    def _load_disk(self):
+        self._disk_loaded = True
+        os.makedirs(self._disk_dir, exist_ok=True)
+        stored = []
+        for name in os.listdir(self._disk_dir):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self._disk_dir, name), encoding="utf-8") as f:
+                    stored.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        for entry in sorted(stored, key=lambda e: e.get("stored_at", 0)):
+            self._insert(entry)
+
+    def _insert(self, entry: Dict[str, Any]):
+        key = entry["key"]
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        for alias in entry.get("aliases", []):
+            self._aliases[alias] = key
+        while len(self._entries) > self._max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for alias in entry.get("aliases", []):
+            if self._aliases.get(alias) == key:
+                del self._aliases[alias]
+        if self._disk_dir:
+            try:
+                os.remove(self._disk_path(key))
+            except OSError:
+                pass
+
+    def _find(self, url: str) -> Optional[Dict[str, Any]]:
+        key = self._aliases.get(normalize_media_url(url))
+        if key is None:
+            identity = media_identity_from_url(url)
+            if identity:
+                key = self._aliases.get(identity, identity)
+        return self._entries.get(key) if key else None
+
+    def get(self, url: str, with_formats: bool = True) -> Optional[Dict[str, Any]]:
+        """Returns a copy of the cached info dict. With with_formats, entries
+        whose signed format URLs have expired count as a miss."""
+        now_ts = time.time()
+        with self._lock:
+            if not self._disk_loaded:
+                self._load_disk()
+            entry = self._find(url)
+            if entry is None:
+                return None
+            if now_ts - entry["stored_at"] > self._ttl_seconds:
+                self._remove(entry["key"])
+                return None
+            if entry["formats_expire_at"] <= now_ts and "formats" in entry["info"]:
+                # Keep the metadata (title, duration, ...) but not dead URLs.
+                del entry["info"]["formats"]
+            if with_formats and "formats" not in entry["info"]:
+                return None
+            self._entries.move_to_end(entry["key"])
+            return copy.deepcopy(entry["info"])
+
+    def put(self, url: str, info: Dict[str, Any]):
+        if info.get("_type", "video") != "video":
+            return
+        if not info.get("extractor_key") or not info.get("id"):
+            return
+        now_ts = time.time()
+        trimmed = yt_dlp.YoutubeDL.sanitize_info(info, remove_private_keys=True)
+        for dropped_key in _INFO_CACHE_DROPPED_KEYS:
+            trimmed.pop(dropped_key, None)
+        trimmed["formats"] = [
+            fmt
+            for fmt in trimmed.get("formats") or []
+            if fmt.get("protocol") != "mhtml"
+        ]
+        if not trimmed["formats"]:
+            trimmed.pop("formats")
+        key = f"{info['extractor_key']}:{info['id']}"
+        aliases = {normalize_media_url(url), key}
+        identity = media_identity_from_url(url)
+        if identity:
+            aliases.add(identity)
+        entry = {
+            "key": key,
+            "aliases": sorted(aliases),
+            "info": trimmed,
+            "stored_at": now_ts,
+            "formats_expire_at": _signed_urls_expire_at(trimmed, now_ts),
+        }
+        with self._lock:
+            if not self._disk_loaded:
+                self._load_disk()
+            self._remove(key)
+            self._insert(entry)
+            if self._disk_dir:
+                try:
+                    with open(self._disk_path(key), "w", encoding="utf-8") as f:
+                        json.dump(entry, f)
+                except OSError as e:
+                    print(f"WARNING: Could not write info cache entry {key}: {e}")
+
+    def drop(self, url: str):
+        with self._lock:
+            entry = self._find(url)
+            if entry is not None:
+                self._remove(entry["key"])
+
+
+INFO_CACHE = InfoDictCache(
+    INFO_CACHE_MAX_ENTRIES, INFO_CACHE_TTL_SECONDS, INFO_CACHE_DIR
+)
+
+
+def extract_media_info(ydl: yt_dlp.YoutubeDL, url: str) -> Optional[Dict[str, Any]]:
+    """extract_info(download=False) through INFO_CACHE; a hit only re-runs
+    format selection locally."""
+    cached_info = INFO_CACHE.get(url)
+    if cached_info:
+        return ydl.process_ie_result(cached_info, download=False)
+    media_info = ydl.extract_info(url, download=False)
+    if media_info:
+        INFO_CACHE.put(url, media_info)
+    return media_info
+
+
+# --- Download Storage ---
+# Every file the bot writes starts with download_media_ytdlp's 8-hex prefix;
+# anything else in a download directory is left alone by the sweep.
+_DOWNLOAD_FILE_PATTERN = re.compile(r"[0-9a-f]{8}_")
+
+
+class DownloadStorage:
+    # Byte budget for the download directories. A download reserves its
+    # estimated size up front, and the reservation follows the resulting file
+    # until it is released after upload, so finished-but-unsent files count
+    # too. reserve() is called from download worker threads.
+    def __init__(self, areas: List[Dict[str, Any]]):
+        # areas: {"dir", "quota", "max_media"}, tried in order.
+        self._areas = areas
+        self._reservations: Dict[str, Dict[str, Any]] = {}
+        self._token_by_path: Dict[str, str] = {}
+        self._cond = threading.Condition()
+        self._sweep_task: Optional[asyncio.Task] = None
+
+    def _used(self, area: Dict[str, Any]) -> int:
+        return sum(
+            r["bytes"] for r in self._reservations.values() if r["area"] is area
+        )
+
+    def _fits(self, area: Dict[str, Any], size: int) -> bool:
+        if size > area["max_media"] or self._used(area) + size > area["quota"]:
+            return False
+        try:
+            free = shutil.disk_usage(area["dir"]).free
+        except OSError:
+            return False
+        return free - size >= DOWNLOAD_MIN_FREE_DISK_BYTES
+
+    def reserve(
+        self,
+        size: Optional[int],
+        timeout: float = DOWNLOAD_RESERVATION_WAIT_SECONDS,
+        prefix: Optional[str] = None,
+    ) -> Optional[Tuple[str, str]]:
+        """Returns (token, directory to download into), or None if no space
+        became available within timeout. Files named with prefix (stream
+        parts, .part files, the merge output) belong to the reservation and
+        are never swept while it is held."""
+        size = size or DOWNLOAD_RESERVATION_DEFAULT_BYTES
+        if not any(size <= min(a["quota"], a["max_media"]) for a in self._areas):
+            return None
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                for area in self._areas:
+                    if self._fits(area, size):
+                        token = uuid4().hex
+                        self._reservations[token] = {
+                            "area": area,
+                            "bytes": size,
+                            "path": None,
+                            "prefix": prefix,
+                            "created_at": time.time(),
+                        }
+                        return token, area["dir"]
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                # Releases notify; the timeout also re-checks free disk space.
+                self._cond.wait(min(remaining, 5))
+
+    def attach(self, token: str, path: str):
+        # Ties the reservation to the downloaded (or to-be-merged) file and
+        # shrinks it to the real size once the file exists.
+        path = os.path.abspath(path)
+        with self._cond:
+            reservation = self._reservations.get(token)
+            if reservation is None:
+                return
+            reservation["path"] = path
+            self._token_by_path[path] = token
+            if os.path.exists(path):
+                reservation["bytes"] = os.path.getsize(path)
+            self._cond.notify_all()
+
+    def release(self, token: Optional[str]):
+        with self._cond:
+            reservation = self._reservations.pop(token, None)
+            if reservation is not None:
+                if reservation["path"]:
+                    self._token_by_path.pop(reservation["path"], None)
+                self._cond.notify_all()
+
+    def release_path(self, path: Optional[str]):
+        if path:
+            self.release(self._token_by_path.get(os.path.abspath(path)))
+
+    def usage(self) -> List[Dict[str, Any]]:
+        with self._cond:
+            return [
+                {
+                    "dir": area["dir"],
+                    "quota": area["quota"],
+                    "used": self._used(area),
+                    "reservations": sum(
+                        1 for r in self._reservations.values() if r["area"] is area
+                    ),
+                }
+                for area in self._areas
+            ]
+
+    def sweep(self, max_age: float) -> Tuple[int, int]:
+        """Deletes untracked bot files older than max_age seconds and drops
+        reservations whose files are all gone. Returns (files removed, bytes
+        freed)."""
+        now = time.time()
+        entries_by_area = []
+        for area in self._areas:
+            try:
+                entries = [
+                    entry
+                    for entry in os.scandir(area["dir"])
+                    if _DOWNLOAD_FILE_PATTERN.match(entry.name)
+                ]
+            except OSError:
+                entries = []
+            entries_by_area.append((area, entries))
+        prefixes_on_disk = {
+            entry.name[:9] for _, entries in entries_by_area for entry in entries
+        }
+        with self._cond:
+            for token, reservation in list(self._reservations.items()):
+                # A pending merge has no output yet but its stream parts exist.
+                if (
+                    reservation["path"]
+                    and not os.path.exists(reservation["path"])
+                    and f"{reservation['prefix']}_" not in prefixes_on_disk
+                    and now - reservation["created_at"] > max_age
+                ):
+                    self._reservations.pop(token)
+                    self._token_by_path.pop(reservation["path"], None)
+            tracked = set(self._token_by_path)
+            held_prefixes = tuple(
+                f"{r['prefix']}_" for r in self._reservations.values() if r["prefix"]
+            )
+            self._cond.notify_all()
+        removed, freed = 0, 0
+        for _, entries in entries_by_area:
+            for entry in entries:
+                if held_prefixes and entry.name.startswith(held_prefixes):
+                    continue
+                try:
+                    if not entry.is_file() or os.path.abspath(entry.path) in tracked:
+                        continue
+                    stat = entry.stat()
+                    if now - stat.st_mtime < max_age:
+                        continue
+                    os.remove(entry.path)
+                except OSError:
+                    continue
+                removed += 1
+                freed += stat.st_size
+        return removed, freed
+
+    def start_sweeper(self):
+        if self._sweep_task is None or self._sweep_task.done():
+            self._sweep_task = asyncio.create_task(self._run_sweeper())
+
+    def stop_sweeper(self):
+        if self._sweep_task is not None and not self._sweep_task.done():
+            self._sweep_task.cancel()
+
+    async def _run_sweeper(self):
+        while True:
+            await asyncio.sleep(DOWNLOAD_SWEEP_INTERVAL_SECONDS)
+            try:
+                removed, freed = await asyncio.to_thread(
+                    self.sweep, DOWNLOAD_ORPHAN_MAX_AGE_SECONDS
+                )
+            except Exception as e:
+                print(f"ERROR: Download directory sweep failed: {e}")
+                continue
+            if removed:
+                print(
+                    f"Swept {removed} orphaned download file(s), {_format_bytes_mb(freed)} freed."
+                )
+
+
+def _download_storage_areas() -> List[Dict[str, Any]]:
+    areas = []
+    if TMPFS_DOWNLOAD_DIR:
+        areas.append(
+            {
+                "dir": TMPFS_DOWNLOAD_DIR,
+                "quota": TMPFS_QUOTA_BYTES,
+                "max_media": TMPFS_MAX_MEDIA_BYTES,
+            }
+        )
+    areas.append(
+        {
+            "dir": DOWNLOAD_DIR,
+            "quota": DOWNLOAD_DIR_QUOTA_BYTES,
+            "max_media": DOWNLOAD_DIR_QUOTA_BYTES,
+        }
+    )
+    return areas
+
+
+DOWNLOAD_STORAGE = DownloadStorage(_download_storage_areas())
+
+
+# --- Core Download Logic ---
+class MediaTooLargeError(yt_dlp.utils.DownloadCancelled):
+    msg = "Media exceeds the size limit"
+
+
+def estimate_media_size(info: Dict[str, Any]) -> Optional[int]:
+    """Estimates the output size in bytes from the formats yt-dlp selected.
+
+    Uses filesize, then filesize_approx, then bitrate x duration per stream.
+    Returns None when any selected stream has no usable metadata.
+    """
+    total = 0
+    for fmt in info.get("requested_formats") or [info]:
+        size = _estimate_format_size(fmt, info.get("duration"))
+        if size is None:
+            return None
+        total += size
+    return total
+
+
+def _estimate_format_size(
+    fmt: Dict[str, Any], duration: Optional[float]
+) -> Optional[int]:
+    size = fmt.get("filesize") or fmt.get("filesize_approx")
+    if not size:
+        tbr = fmt.get("tbr") or ((fmt.get("vbr") or 0) + (fmt.get("abr") or 0))
+        if not tbr or not duration:
+            return None
+        size = tbr * 1000 / 8 * duration
+    return int(size)
+
+
+def plan_formats_for_budget(
+    info: Dict[str, Any], format_choice: str, budget_bytes: int
+) -> Optional[Tuple[str, int]]:
+    """Picks the best format (or video+audio pair) whose estimated size fits.
+
+    Returns (format spec, estimated bytes), or None when nothing with a known
+    size fits. Pairs are only considered when FFmpeg can merge them.
+    """
+    duration = info.get("duration")
+    videos, audios, combined = [], [], []
+    for fmt in info.get("formats") or []:
+        if not fmt.get("format_id") or fmt.get("has_drm"):
+            continue
+        if fmt.get("protocol") == "mhtml":
+            continue
+        size = _estimate_format_size(fmt, duration)
+        if size is None:
+            continue
+        has_video = fmt.get("vcodec") not in (None, "none")
+        has_audio = fmt.get("acodec") not in (None, "none")
+        if has_video and has_audio:
+            combined.append((fmt, size))
+        elif has_video:
+            videos.append((fmt, size))
+        elif has_audio:
+            audios.append((fmt, size))
+
+    def _quality(fmt: Dict[str, Any]) -> Tuple:
+        return (
+            fmt.get("height") or 0,
+            fmt.get("ext") == "mp4",
+            fmt.get("tbr") or 0,
+        )
+
+    candidates = []
+    if format_choice == "audio":
+        for fmt, size in audios + combined:
+            if size <= budget_bytes:
+                candidates.append(
+                    (
+                        (
+                            fmt.get("vcodec") in (None, "none"),
+                            fmt.get("abr") or fmt.get("tbr") or 0,
+                        ),
+                        fmt["format_id"],
+                        size,
+                    )
+                )
+    else:
+        for fmt, size in combined:
+            if size <= budget_bytes:
+                candidates.append((_quality(fmt), fmt["format_id"], size))
+        if FFMPEG_AVAILABLE and audios:
+            audios_by_quality = sorted(
+                audios,
+                key=lambda a: (a[0].get("ext") == "m4a", a[0].get("abr") or 0),
+                reverse=True,
+            )
+            for vfmt, vsize in videos:
+                for afmt, asize in audios_by_quality:
+                    if vsize + asize <= budget_bytes:
+                        candidates.append(
+                            (
+                                _quality(vfmt),
+                                f"{vfmt['format_id']}+{afmt['format_id']}",
+                                vsize + asize,
+                            )
+                        )
+                        break
+    if not candidates:
+        return None
+    _, format_spec, size = max(candidates, key=lambda c: c[0])
+    return format_spec, size
+
+
+def _remove_partial_downloads(output_dir: str, base_filename: str):
+    for f in os.listdir(output_dir):
+        if f.startswith(base_filename):
+            try:
+                os.remove(os.path.join(output_dir, f))
+            except OSError:
+                pass
+
+
+def _resolve_downloaded_path(
+    info: Dict[str, Any], output_dir: str, base_filename: str
+) -> Optional[str]:
+    for entry in info.get("requested_downloads") or []:
+        path = entry.get("filepath") or entry.get("_filename")
+        if path and os.path.exists(path):
+            return path
+    for key in ("filepath", "_filename"):
+        path = info.get(key)
+        if path and os.path.exists(path):
+            return path
+    possible_files = [
+        f
+        for f in os.listdir(output_dir)
+        if f.startswith(base_filename) and not f.endswith((".part", ".ytdl"))
+    ]
+    if possible_files:
+        return os.path.join(output_dir, possible_files[0])
+    return None
+
+
+def _reselect_formats(
+    ydl: yt_dlp.YoutubeDL, info: Dict[str, Any], format_spec: str
+) -> Dict[str, Any]:
+    # process_ie_result re-runs format selection with ydl.format_selector, but
+    # a single-format pick is layered over the old selection, so a stale
+    # requested_formats would still trigger a merge of the previous pair.
+    # Selection is re-run here so requested_formats describes the new plan.
+    ydl.format_selector = ydl.build_format_selector(format_spec)
+    info = dict(info)
+    info.pop("requested_formats", None)
+    return ydl.process_ie_result(info, download=False)
+
+
+def _default_format_spec(format_choice: str) -> str:
+    if format_choice == "audio":
+        return "bestaudio/best"
+    return "bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/bestvideo+bestaudio/best"
+
+
+def download_media_ytdlp(
+    url: str,
+    format_choice: str = "video",
+    user_id: int = 0,
+    progress_hook: Optional[Callable[[Dict[str, Any]], None]] = None,
+    max_filesize_bytes: Optional[int] = None,
+) -> Tuple[bool, str, Optional[str], Optional[Dict[str, Any]]]:
+    # The output directory is chosen by DOWNLOAD_STORAGE once the size is known.
+    unique_prefix = uuid4().hex[:8]
+    ydl_opts = {
+        "quiet": True,
+        "no_warnings": True,
+        # Single-item mode: a watch?v=...&list=... link means the video, and a
+        # pure playlist link is only listed (flat) so it can be refused cheaply.
+        "extract_flat": "in_playlist",
+        "noplaylist": True,
+        "useragent": USER_AGENT_YTDLP,
+        "verbose": False,
+        "retries": MAX_RETRIES_YTDLP,
+        "fragment_retries": MAX_RETRIES_YTDLP,
+        "retry_sleep_functions": {
+            "http": lambda n: RETRY_DELAY_YTDLP,
+            "fragment": lambda n: RETRY_DELAY_YTDLP,
+        },
+        "outtmpl": f"{unique_prefix}_media.%(ext)s",
+    }
+    if format_choice in ("video", "audio"):
+        ydl_opts["format"] = _default_format_spec(format_choice)
+    if format_choice == "video" and FFMPEG_AVAILABLE:
+        ydl_opts["merge_output_format"] = "mp4"
+
+    hook_data = {"actual_path": None}
+    # Bytes per stream, so a video+audio pair is measured as one output.
+    stream_bytes: Dict[str, int] = {}
+
+    def _hook(d):
+        if d["status"] == "finished":
+            hook_data["actual_path"] = d["filename"]
+        if max_filesize_bytes and d["status"] in ("downloading", "finished"):
+            stream_bytes[d.get("filename", "")] = max(
+                d.get("downloaded_bytes") or 0, d.get("total_bytes") or 0
+            )
+            if sum(stream_bytes.values()) > max_filesize_bytes:
+                raise MediaTooLargeError()
+
+    ydl_opts["progress_hooks"] = [_hook]
+    if progress_hook:
+        ydl_opts["progress_hooks"].append(progress_hook)
+
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        # The extractor runs exactly once: the resolved info dict (formats already
+        # selected) is fed back into process_ie_result for the actual download.
+        try:
+            media_info = extract_media_info(ydl, url)
+            if not media_info:
+                return False, "Could not retrieve media information.", None, None
+        except yt_dlp.utils.DownloadError as e:
+            err_msg = str(e).lower()
+            if "unsupported url" in err_msg:
+                return False, "Invalid or unsupported URL.", None, None
+            return False, f"Error fetching media info: {e}", None, None
+        except Exception as e:
+            print(f"Unexpected YTDLP info error for {url} (User: {user_id}): {e}")
+            return False, f"Unexpected error fetching media info: {e}", None, None
+        if media_info.get("_type") in ("playlist", "multi_video"):
+            return (
+                False,
+                "This link is a playlist. Premium users can download it with the Playlist button.",
+                None,
+                None,
+            )
+
+        estimated_size = estimate_media_size(media_info)
+        if max_filesize_bytes:
+            if estimated_size is None or estimated_size > max_filesize_bytes:
+                plan = plan_formats_for_budget(
+                    media_info, format_choice, max_filesize_bytes
+                )
+                if plan:
+                    format_spec, estimated_size = plan
+                    media_info = _reselect_formats(ydl, media_info, format_spec)
+            if estimated_size and estimated_size > max_filesize_bytes:
+                return (
+                    False,
+                    f"Media is too large (~{estimated_size / (1024 * 1024):.0f}MB, "
+                    f"limit {max_filesize_bytes / (1024 * 1024):.0f}MB).",
+                    None,
+                    media_info,
+                )
+
+        reservation_size = estimated_size or max_filesize_bytes
+        if (
+            reservation_size
+            and media_info.get("requested_formats")
+            and FFMPEG_AVAILABLE
+        ):
+            # The separate streams and the merged output exist side by side.
+            reservation_size *= 2
+        reservation = DOWNLOAD_STORAGE.reserve(
+            reservation_size, prefix=unique_prefix
+        )
+        if reservation is None:
+            return (
+                False,
+                "Download storage is full right now. Please try again in a few minutes.",
+                None,
+                media_info,
+            )
+        storage_token, output_dir = reservation
+        try:
+            result = _download_reserved(
+                ydl,
+                media_info,
+                url,
+                output_dir,
+                unique_prefix,
+                user_id,
+                hook_data,
+                max_filesize_bytes,
+            )
+        except BaseException:
+            DOWNLOAD_STORAGE.release(storage_token)
+            raise
+    if result[0] and result[2]:
+        DOWNLOAD_STORAGE.attach(storage_token, result[2])
+    else:
+        DOWNLOAD_STORAGE.release(storage_token)
+    return result
+
+
+def _download_reserved(
+    ydl: yt_dlp.YoutubeDL,
+    media_info: Dict[str, Any],
+    url: str,
+    output_dir: str,
+    unique_prefix: str,
+    user_id: int,
+    hook_data: Dict[str, Any],
+    max_filesize_bytes: Optional[int],
+) -> Tuple[bool, str, Optional[str], Optional[Dict[str, Any]]]:
+    # Runs inside download_media_ytdlp once space for the media is reserved in
+    # output_dir.
+    title = media_info.get("title", "media")
+    base_filename = f"{unique_prefix}_{sanitize_filename(title)}"
+    ydl.params["outtmpl"]["default"] = os.path.join(
+        output_dir, f"{base_filename}.%(ext)s"
+    )
+
+    try:
+        if media_info.get("requested_formats") and FFMPEG_AVAILABLE:
+            # Fetch each stream on its own and leave the mux to the merge
+            # stage, which runs outside the download slot.
+            merge_inputs = []
+            for fmt in media_info["requested_formats"]:
+                part_base = f"{base_filename}.f{fmt['format_id']}"
+                ydl.params["outtmpl"]["default"] = os.path.join(
+                    output_dir, f"{part_base}.%(ext)s"
+                )
+                part_info = ydl.process_ie_result(
+                    _reselect_formats(ydl, media_info, fmt["format_id"]),
+                    download=True,
+                )
+                part_path = _resolve_downloaded_path(
+                    part_info, output_dir, part_base
+                )
+                if not part_path:
+                    _remove_partial_downloads(output_dir, base_filename)
+                    return (
+                        False,
+                        f"Stream {fmt['format_id']} finished but its file is missing.",
+                        None,
+                        media_info,
+                    )
+                merge_inputs.append(part_path)
+            media_info["_merge_inputs"] = merge_inputs
+            return (
+                True,
+                "Streams downloaded, merge pending.",
+                os.path.join(output_dir, f"{base_filename}.mp4"),
+                media_info,
+            )
+        media_info = ydl.process_ie_result(media_info, download=True)
+    except MediaTooLargeError:
+        _remove_partial_downloads(output_dir, base_filename)
+        return (
+            False,
+            f"Media grew past the {max_filesize_bytes / (1024 * 1024):.0f}MB limit and was aborted.",
+            None,
+            media_info,
+        )
+    except yt_dlp.utils.DownloadError as e:
+        print(f"ERROR: YTDLP DownloadError for {url} (User: {user_id}): {e}")
+        # The cached format URLs may have been revoked early; re-extract next time.
+        INFO_CACHE.drop(url)
+        return False, f"Failed to download: {e}", None, media_info
+    except Exception as e:
+        print(f"ERROR: Unexpected YTDLP error for {url} (User: {user_id}): {e}")
+        return (
+            False,
+            f"Unexpected download error: {type(e).__name__}",
+            None,
+            media_info,
+        )
+
+    final_path_to_check = _resolve_downloaded_path(
+        media_info, output_dir, base_filename
+    )
+    if not final_path_to_check:
+        actual_hook_path_val = hook_data["actual_path"]
+        if actual_hook_path_val and os.path.exists(actual_hook_path_val):
+            final_path_to_check = actual_hook_path_val
+    if final_path_to_check:
+        return True, "Download successful.", final_path_to_check, media_info
+    print(
+        f"ERROR: Download finished but final file not confirmed. Base='{base_filename}', Hook='{hook_data['actual_path']}'"
+    )
+    return (
+        False,
+        "Download completed, but final file path not confirmed.",
+        None,
+        media_info,
+    )
+
+
+# --- Playlist Enumeration ---
+PLAYLIST_EXECUTOR = ThreadPoolExecutor(
+    max_workers=PLAYLIST_MAX_CONCURRENT, thread_name_prefix="playlist"
+)
+_ACTIVE_PLAYLISTS: Dict[int, int] = {}
+_PLAYLIST_TASKS: set = set()
+
+
+def enumerate_playlist_entries(
+    url: str,
+    max_items: int,
+    emit: Callable[[Dict[str, Any]], bool],
+) -> Tuple[bool, str]:
+    """Walks the playlist's entries lazily (flat, unprocessed) and hands each
+    {"url", "title"} to emit as soon as the extractor yields it. Stops when
+    emit returns False or after max_items. Runs in a worker thread."""
+    ydl_opts = {
+        "quiet": True,
+        "no_warnings": True,
+        "extract_flat": "in_playlist",
+        "lazy_playlist": True,
+        "playlistend": max_items,
+        "useragent": USER_AGENT_YTDLP,
+    }
+    try:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            info = ydl.extract_info(url, download=False, process=False)
+            if not info or info.get("_type") not in ("playlist", "multi_video"):
+                return False, "This link is not a playlist."
+            emitted = 0
+            for entry in info.get("entries") or []:
+                if not entry:
+                    continue
+                entry_url = entry.get("webpage_url") or entry.get("url")
+                if not entry_url or not entry_url.startswith(("http://", "https://")):
+                    continue
+                emitted += 1
+                if not emit({"url": entry_url, "title": entry.get("title")}):
+                    break
+                if emitted >= max_items:
+                    break
+            return True, info.get("title") or "playlist"
+    except Exception as e:
+        print(f"Playlist enumeration failed for {url}: {e}")
+        return False, f"Could not list the playlist: {e}"
+
+
+# --- Streaming Upload ---
+class _SizedStreamPayload(aiohttp.payload.AsyncIterablePayload):
+    # A known size lets aiohttp send a Content-Length for the whole multipart
+    # body instead of chunked transfer encoding.
+    def __init__(self, value, size: int, *args, **kwargs):
+        super().__init__(value, *args, **kwargs)
+        self._size = size
+
+
+def probe_stream_source(
+    url: str, format_choice: str, max_filesize_bytes: int
+) -> Optional[Dict[str, Any]]:
+    """Returns the info dict if the default selection is one direct HTTP stream
+    within budget, otherwise None so the caller uses the temp-file path."""
+    ydl_opts = {
+        "quiet": True,
+        "no_warnings": True,
+        "extract_flat": "in_playlist",
+        "noplaylist": True,
+        "useragent": USER_AGENT_YTDLP,
+        "format": _default_format_spec(format_choice),
+    }
+    try:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            info = extract_media_info(ydl, url)
+    except Exception as e:
+        print(f"Stream probe failed for {url}: {e}")
+        return None
+    if not info or info.get("_type", "video") != "video":
+        return None
+    if info.get("requested_formats") or info.get("protocol") not in ("http", "https"):
+        return None
+    estimated_size = estimate_media_size(info)
+    if estimated_size and estimated_size > max_filesize_bytes:
+        return None
+    return info
+
+
+async def stream_upload_media(
+    session: aiohttp.ClientSession,
+    bot: Any,
+    chat_id: int,
+    info: Dict[str, Any],
+    format_type: str,
+    caption: str,
+    max_filesize_bytes: int,
+    reply_to_message_id: Optional[int] = None,
+    on_upload_start: Optional[Callable[[int], None]] = None,
+) -> Any:
+    """Pipes the source response into sendVideo/sendAudio through a bounded
+    queue. Raises on any failure; nothing is written to disk."""
+    media_kw = "video" if format_type == "video" else "audio"
+    ext = info.get("ext") or ("mp4" if media_kw == "video" else "m4a")
+    filename = f"{sanitize_filename(info.get('title') or 'media')}.{ext}"
+    buffer: asyncio.Queue = asyncio.Queue(maxsize=STREAMING_UPLOAD_BUFFER_CHUNKS)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+
+    async with session.get(
+        info["url"], headers=info.get("http_headers") or {}, timeout=timeout
+    ) as source:
+        source.raise_for_status()
+        size = source.content_length
+        if not size:
+            raise ValueError("source did not announce a Content-Length")
+        if size > max_filesize_bytes:
+            raise MediaTooLargeError()
+
+        async def _pump():
+            received = 0
+            try:
+                async for chunk in source.content.iter_chunked(
+                    STREAMING_UPLOAD_CHUNK_SIZE
+                ):
+                    received += len(chunk)
+                    if received > size:
+                        raise MediaTooLargeError()
+                    await buffer.put(chunk)
+                if received != size:
+                    raise aiohttp.ClientPayloadError("source ended early")
+                await buffer.put(None)
+            except Exception as e:
+                await buffer.put(e)
+
+        async def _drain():
+            while True:
+                item = await buffer.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+
+        form = aiohttp.FormData()
+        form.add_field("chat_id", str(chat_id))
+        if caption:
+            form.add_field("caption", caption)
+            form.add_field("parse_mode", constants.ParseMode.HTML)
+        if reply_to_message_id:
+            form.add_field("reply_to_message_id", str(reply_to_message_id))
+        form.add_field(
+            media_kw,
+            _SizedStreamPayload(_drain(), size),
+            filename=filename,
+            content_type=source.content_type or "application/octet-stream",
+        )
+        if on_upload_start:
+            on_upload_start(size)
+        pump_task = asyncio.create_task(_pump())
+        try:
+            async with session.post(
+                f"{bot.base_url}/send{media_kw.capitalize()}",
+                data=form,
+                timeout=timeout,
+            ) as response:
+                payload = await response.json(content_type=None)
+        finally:
+            pump_task.cancel()
+            await asyncio.gather(pump_task, return_exceptions=True)
+    if not payload.get("ok"):
+        raise BadRequest(payload.get("description") or "streamed upload rejected")
+    return Message.de_json(payload["result"], bot)
+
+
+# --- Progress Reporting ---
+def _format_bytes_mb(num_bytes: Optional[float]) -> str:
+    return f"{(num_bytes or 0) / (1024 * 1024):.1f}MB"
+
+
+def _format_eta(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "?"
+    mins, secs = divmod(int(seconds), 60)
+    return f"{mins}:{secs:02d}"
+
+
+class ProgressReporter:
+    # Bridges yt-dlp progress hooks (worker thread) into throttled edits of the
+    # status message (event loop).
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        edit_status: Callable[[str], Awaitable[None]],
+        format_type: str,
+    ):
+        self._loop = loop
+        self._edit_status = edit_status
+        self._format_type = format_type
+        self._latest: Optional[Dict[str, Any]] = None
+        self._changed = asyncio.Event()
+        self._last_hook_push = 0.0
+        self._last_reported_percent: Optional[float] = None
+        self._last_reported_phase: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def hook(self, d: Dict[str, Any]):
+        status = d.get("status")
+        now = time.monotonic()
+        if status == "downloading" and now - self._last_hook_push < PROGRESS_HOOK_MIN_INTERVAL_SECONDS:
+            return
+        self._last_hook_push = now
+        snapshot = {
+            "phase": "download" if status == "downloading" else "processing",
+            "downloaded": d.get("downloaded_bytes"),
+            "total": d.get("total_bytes") or d.get("total_bytes_estimate"),
+            "speed": d.get("speed"),
+            "eta": d.get("eta"),
+        }
+        self._loop.call_soon_threadsafe(self._publish, snapshot)
+
+    def _publish(self, snapshot: Dict[str, Any]):
+        self._latest = snapshot
+        self._changed.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def start_upload(self, file_size_bytes: int):
+        self._publish(
+            {"phase": "upload", "total": file_size_bytes, "started": time.monotonic()}
+        )
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def _render(self, snapshot: Dict[str, Any]) -> Optional[str]:
+        phase = snapshot["phase"]
+        if phase == "upload":
+            elapsed = time.monotonic() - snapshot["started"]
+            return f"🚀 Uploading {self._format_type} ({_format_bytes_mb(snapshot['total'])})... {int(elapsed)}s elapsed"
+        if phase == "processing":
+            return f"⚙️ Processing {self._format_type}..."
+        downloaded, total = snapshot["downloaded"], snapshot["total"]
+        parts = [f"⬇️ Downloading {self._format_type}"]
+        percent = None
+        if downloaded and total:
+            percent = min(100.0, downloaded * 100.0 / total)
+            parts[0] += f": {percent:.0f}% ({_format_bytes_mb(downloaded)}/{_format_bytes_mb(total)})"
+        elif downloaded:
+            parts[0] += f": {_format_bytes_mb(downloaded)}"
+        if snapshot["speed"]:
+            parts.append(f"{_format_bytes_mb(snapshot['speed'])}/s")
+        if snapshot["eta"] is not None:
+            parts.append(f"ETA {_format_eta(snapshot['eta'])}")
+        if (
+            percent is not None
+            and phase == self._last_reported_phase
+            and self._last_reported_percent is not None
+            and abs(percent - self._last_reported_percent) < PROGRESS_MIN_PERCENT_STEP
+        ):
+            return None
+        self._last_reported_percent = percent
+        return " • ".join(parts)
+
+    async def _run(self):
+        last_edit = 0.0
+        last_text = None
+        while True:
+            if self._latest is None or self._latest["phase"] != "upload":
+                await self._changed.wait()
+            wait_for = PROGRESS_EDIT_INTERVAL_SECONDS - (time.monotonic() - last_edit)
+            if wait_for > 0:
+                await asyncio.sleep(wait_for)
+            self._changed.clear()
+            snapshot = self._latest
+            text = self._render(snapshot) if snapshot else None
+            if not text or text == last_text:
+                continue
+            self._last_reported_phase = snapshot["phase"]
+            last_text = text
+            last_edit = time.monotonic()
+            try:
+                await self._edit_status(text)
+            except Exception as e:
+                print(f"WARNING: Progress update failed: {e}")
+
+
+# --- Download Scheduler ---
+class DownloadScheduler:
+    # Roles are served in this order; within a role, jobs are first come first served.
+    ROLE_PRIORITY = (ROLE_ADMIN, ROLE_PREMIUM, ROLE_STANDARD)
+
+    def __init__(self, max_workers: int, per_user_limits: Dict[str, int]):
+        self.max_workers = max_workers
+        self.per_user_limits = per_user_limits
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="download"
+        )
+        self._queues: Dict[str, deque] = {role: deque() for role in self.ROLE_PRIORITY}
+        self._running_total = 0
+        self._running_per_user: Dict[int, int] = {}
+
+    def _user_has_free_slot(self, ticket: Dict[str, Any]) -> bool:
+        limit = self.per_user_limits.get(ticket["role"], 1)
+        return self._running_per_user.get(ticket["user_id"], 0) < limit
+
+    def _dispatch(self):
+        while self._running_total < self.max_workers:
+            next_ticket = None
+            for role in self.ROLE_PRIORITY:
+                for ticket in self._queues[role]:
+                    if self._user_has_free_slot(ticket):
+                        next_ticket = ticket
+                        break
+                if next_ticket:
+                    self._queues[role].remove(next_ticket)
+                    break
+            if not next_ticket:
+                return
+            self._running_total += 1
+            user_id = next_ticket["user_id"]
+            self._running_per_user[user_id] = self._running_per_user.get(user_id, 0) + 1
+            next_ticket["started"].set_result(True)
+
+    def _release(self, user_id: int):
+        self._running_total -= 1
+        remaining = self._running_per_user.get(user_id, 1) - 1
+        if remaining > 0:
+            self._running_per_user[user_id] = remaining
+        else:
+            self._running_per_user.pop(user_id, None)
+        self._dispatch()
+
+    def queue_position(self, ticket: Dict[str, Any]) -> int:
+        position = 0
+        for role in self.ROLE_PRIORITY:
+            queue = self._queues[role]
+            if role == ticket["role"]:
+                return position + queue.index(ticket) + 1 if ticket in queue else 0
+            position += len(queue)
+        return 0
+
+    def stats(self) -> Dict[str, int]:
+        stats = {f"queued_{role}": len(self._queues[role]) for role in self.ROLE_PRIORITY}
+        stats["running"] = self._running_total
+        return stats
+
+    async def _acquire(
+        self,
+        user_id: int,
+        role: str,
+        on_queue_update: Optional[Callable[[int], Awaitable[None]]],
+    ):
+        # Waits for a slot; the caller must _release(user_id) once done with it.
+        loop = asyncio.get_running_loop()
+        if role not in self._queues:
+            role = ROLE_STANDARD
+        ticket = {"user_id": user_id, "role": role, "started": loop.create_future()}
+        self._queues[role].append(ticket)
+        self._dispatch()
+        last_reported_position = None
+        try:
+            while not ticket["started"].done():
+                position = self.queue_position(ticket)
+                if on_queue_update and position != last_reported_position:
+                    await on_queue_update(position)
+                    last_reported_position = position
+                try:
+                    await asyncio.wait_for(
+                        asyncio.shield(ticket["started"]),
+                        timeout=QUEUE_POSITION_REFRESH_SECONDS,
+                    )
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            if ticket["started"].done():
+                self._release(user_id)
+            elif ticket in self._queues[role]:
+                self._queues[role].remove(ticket)
+            raise
+        if on_queue_update and last_reported_position:
+            try:
+                await on_queue_update(0)
+            except Exception as e:
+                print(f"WARNING: Queue status update failed for user {user_id}: {e}")
+            except BaseException:
+                # Cancelled after the slot was granted but before the job ran.
+                self._release(user_id)
+                raise
 
+    async def run(
+        self,
+        user_id: int,
+        role: str,
+        func: Callable[..., Any],
+        *args,
+        on_queue_update: Optional[Callable[[int], Awaitable[None]]] = None,
+    ) -> Any:
+        await self._acquire(user_id, role, on_queue_update)
+        loop = asyncio.get_running_loop()
+        job_future = loop.run_in_executor(self._executor, functools.partial(func, *args))
+        # The slot is held until the worker thread actually finishes, even if the
+        # awaiting handler is cancelled in the meantime.
+        job_future.add_done_callback(lambda _: self._release(user_id))
+        return await job_future
 
-# Premium Tiers (Telegram Stars)
-PREMIUM_PRICES = {
-    "3_days": {
-        "stars": 50,
-        "days": 3,
-        "title": "Premium (3 Days)",
-        "description": "3 days of unlimited downloads",
-    },
-    "30_days": {
-        "stars": 250,
-        "days": 30,
-        "title": "Premium (30 Days)",
-        "description": "30 days of unlimited downloads",
-    },
-    "365_days": {
-        "stars": 1500,
-        "days": 365,
-        "title": "Premium (1 Year)",
-        "description": "1 year of unlimited downloads",
-    },
-}
+    async def run_async(
+        self,
+        user_id: int,
+        role: str,
+        func: Callable[..., Awaitable[Any]],
+        *args,
+        on_queue_update: Optional[Callable[[int], Awaitable[None]]] = None,
+    ) -> Any:
+        """Like run, for jobs that do their I/O on the event loop (streamed
+        uploads); the slot is held until the coroutine returns."""
+        await self._acquire(user_id, role, on_queue_update)
+        try:
+            return await func(*args)
+        finally:
+            self._release(user_id)
 
-# Persistence Keys
-CHANNEL_SUBSCRIPTION_CONFIG_KEY = "channel_subscription_config"
-BANNED_USERS_KEY = "banned_user_ids"
 
-# yt-dlp Constants
-MAX_RETRIES_YTDLP = 3
-RETRY_DELAY_YTDLP = 5
-USER_AGENT_YTDLP = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+DOWNLOAD_SCHEDULER = DownloadScheduler(
+    MAX_CONCURRENT_DOWNLOADS, MAX_CONCURRENT_DOWNLOADS_PER_USER
+)
 
-# Other Constants
-URL_REGEX = r"(?:(?:https?|ftp):\/\/)?(?:\S+(?::\S*)?@)?(?:(?!10(?:\.\d{1,3}){3})(?!127(?:\.\d{1,3}){3})(?!169\.254(?:\.\d{1,3}){2})(?!192\.168(?:\.\d{1,3}){2})(?!172\.(?:1[6-9]|2\d|3[0-1])(?:\.\d{1,3}){2})(?:[1-9]\d?|1\d\d|2[01]\d|22[0-3])(?:\.(?:1?\d{1,2}|2[0-4]\d|25[0-5])){2}(?:\.(?:[1-9]\d?|1\d\d|2[0-4]\d|25[0-4]))|(?:(?:[a-z\u00a1-\uffff0-9]+-?)*[a-z\u00a1-\uffff0-9]+)(?:\.(?:[a-z\u00a1-\uffff0-9]+-?)*[a-z\u00a1-\uffff0-9]+)*(?:\.(?:[a-z\u00a1-\uffff]{2,})))(?::\d{2,5})?(?:\/[^\s]*)?"
-TIKTOK_HOSTNAMES = ["tiktok.com", "www.tiktok.com", "vm.tiktok.com"]
 
-# Persistence Setup
-PERSISTENCE = PicklePersistence(filepath="bot_persistence.pickle")
+# --- Post-processing ---
+MERGE_EXECUTOR = ThreadPoolExecutor(
+    max_workers=MAX_CONCURRENT_MERGES, thread_name_prefix="merge"
+)
 
+# Tried in order: pure stream copy, then copying video while re-encoding only
+# the audio, and a full re-encode as the last resort.
+_MERGE_STRATEGIES = (
+    ("stream copy", ["-c", "copy"]),
+    ("audio re-encode", ["-c:v", "copy", "-c:a", "aac", "-b:a", "192k"]),
+    (
+        "full re-encode",
+        "-c:v libx264 -preset veryfast -crf 23 -c:a aac -b:a 192k".split()
+        + ["-threads", str(max(1, (os.cpu_count() or 1) // MAX_CONCURRENT_MERGES))],
+    ),
+)
 
-# --- Utility Functions ---
-def sanitize_filename(filename: str, max_length: int = 60) -> str:
-    sane = re.sub(r'[\\/*?:"<>|]', "_", filename).strip(" .")
-    sane = "".join(c for c in sane if c.isprintable() or c == " ")
-    sane = re.sub(r"\s+", "_", sane)
-    sane = re.sub(r"__+", "_", sane)
-    return sane[:max_length] if sane else "downloaded_media"
 
+def merge_media_streams(
+    input_paths: List[str], output_path: str
+) -> Tuple[bool, str, float]:
+    """Muxes separately downloaded streams into one MP4.
 
-try:
-    FFMPEG_AVAILABLE = (
-        subprocess.run(
-            ["ffmpeg", "-version"], capture_output=True, text=True, timeout=10
-        ).returncode
-        == 0
+    Returns (success, strategy used or error, wall time in seconds).
+    """
+    started = time.monotonic()
+    inputs, maps = [], []
+    for index, path in enumerate(input_paths):
+        inputs += ["-i", path]
+        maps += ["-map", str(index)]
+    last_error = "no merge strategy succeeded"
+    for strategy, codec_args in _MERGE_STRATEGIES:
+        cmd = (
+            ["ffmpeg", "-y", "-loglevel", "error"]
+            + inputs
+            + maps
+            + codec_args
+            + ["-movflags", "+faststart", output_path]
+        )
+        try:
+            result = subprocess.run(
+                cmd,
+                capture_output=True,
+                text=True,
+                timeout=FFMPEG_MERGE_TIMEOUT_SECONDS,
+            )
+        except subprocess.TimeoutExpired:
+            last_error = f"ffmpeg timed out after {FFMPEG_MERGE_TIMEOUT_SECONDS}s"
+            break
+        if result.returncode == 0 and os.path.exists(output_path):
+            for path in input_paths:
+                remove_downloaded_file(path)
+            return True, strategy, time.monotonic() - started
+        last_error = (result.stderr or "").strip()[-300:] or (
+            f"ffmpeg exited with {result.returncode}"
+        )
+        # The next strategy writes the same output, so its space stays reserved.
+        remove_downloaded_file(output_path, keep_reservation=True)
+    remove_downloaded_file(output_path)
+    for path in input_paths:
+        remove_downloaded_file(path)
+    return False, last_error, time.monotonic() - started
+
+
+async def run_download_job(
+    user_id: int,
+    role: str,
+    url: str,
+    format_type: str,
+    progress_hook: Optional[Callable[[Dict[str, Any]], None]] = None,
+    max_filesize_bytes: Optional[int] = None,
+    on_queue_update: Optional[Callable[[int], Awaitable[None]]] = None,
+) -> Tuple[bool, str, Optional[str], Optional[Dict[str, Any]]]:
+    """Download stage on DOWNLOAD_SCHEDULER, then the merge stage (if the
+    selection was a video+audio pair) on MERGE_EXECUTOR."""
+    success, message, file_path, media_info = await DOWNLOAD_SCHEDULER.run(
+        user_id,
+        role,
+        download_media_ytdlp,
+        url,
+        format_type,
+        user_id,
+        progress_hook,
+        max_filesize_bytes,
+        on_queue_update=on_queue_update,
+    )
+    merge_inputs = media_info.pop("_merge_inputs", None) if media_info else None
+    if not success or not merge_inputs:
+        return success, message, file_path, media_info
+    if progress_hook:
+        progress_hook({"status": "finished"})
+    merged, detail, elapsed = await asyncio.get_running_loop().run_in_executor(
+        MERGE_EXECUTOR, merge_media_streams, merge_inputs, file_path
     )
-except FileNotFoundError:
-    FFMPEG_AVAILABLE = False
-except subprocess.TimeoutExpired:
-    FFMPEG_AVAILABLE = False
-    print("WARNING: FFmpeg check timed out.")
-if FFMPEG_AVAILABLE:
-    print("FFmpeg found and working.")
-else:
     print(
-        "WARNING: FFmpeg check failed or FFmpeg not found. Some features might be affected."
+        f"Merge for {url} (User: {user_id}): {'ok' if merged else 'failed'}, {detail}, {elapsed:.2f}s"
     )
+    if not merged:
+        return False, f"Merging video and audio failed: {detail}", None, media_info
+    media_info["merge_strategy"] = detail
+    media_info["merge_seconds"] = round(elapsed, 2)
+    return True, "Download successful.", file_path, media_info
 
 
-async def fetch_http_content(
-    session: aiohttp.ClientSession, url: str
-) -> Optional[bytes]:
-    try:
-        async with session.get(url, timeout=30) as response:
-            response.raise_for_status()
-            return await response.read()
-    except Exception as e:
-        print(f"Error fetching {url}: {e}")
-        return None
+# --- In-flight Download Coalescing ---
+# Concurrent requests for the same media/format share a single download job.
+_INFLIGHT_DOWNLOADS: Dict[str, Dict[str, Any]] = {}
+# Streamed uploads go straight to one chat, so concurrent requests for the same
+# key wait for the stream to finish and then send its cached file_id.
+_INFLIGHT_STREAMS: Dict[str, asyncio.Event] = {}
 
 
-# --- Core Download Logic ---
-def download_media_ytdlp(
-    url: str, output_dir: str, format_choice: str = "video", user_id: int = 0
-) -> Tuple[bool, str, Optional[str], Optional[Dict[str, Any]]]:
-    os.makedirs(output_dir, exist_ok=True)
-    unique_prefix = uuid4().hex[:8]
-    ydl_initial_info_opts = {
-        "quiet": True,
-        "no_warnings": True,
-        "simulate": True,
-        "extract_flat": False,
-        "useragent": USER_AGENT_YTDLP,
-        "skip_download": True,
-        "verbose": False,
-    }
-    try:
-        with yt_dlp.YoutubeDL(ydl_initial_info_opts) as ydl_info_fetch:
-            media_info = ydl_info_fetch.extract_info(url, download=False)
-        if not media_info:
-            return False, "Could not retrieve media information.", None, None
-    except yt_dlp.utils.DownloadError as e:
-        err_msg = str(e).lower()
-        if "unsupported url" in err_msg:
-            return False, "Invalid or unsupported URL.", None, None
-        return False, f"Error fetching media info: {e}", None, None
-    except Exception as e:
-        print(f"Unexpected YTDLP info error for {url} (User: {user_id}): {e}")
-        return False, f"Unexpected error fetching media info: {e}", None, None
+def remove_downloaded_file(file_path: Optional[str], keep_reservation: bool = False):
+    if file_path and os.path.exists(file_path):
+        try:
+            os.remove(file_path)
+        except OSError as e_os:
+            print(f"ERROR: Failed to delete temp file {file_path}: {e_os}")
+    if not keep_reservation:
+        DOWNLOAD_STORAGE.release_path(file_path)
 
-    title = media_info.get("title", "media")
-    sanitized_title = sanitize_filename(title)
-    base_filename = f"{unique_prefix}_{sanitized_title}"
-    ydl_download_opts = {
-        "quiet": True,
-        "no_warnings": True,
-        "useragent": USER_AGENT_YTDLP,
-        "retries": MAX_RETRIES_YTDLP,
-        "fragment_retries": MAX_RETRIES_YTDLP,
-        "retry_sleep_functions": {
-            "http": lambda n: RETRY_DELAY_YTDLP,
-            "fragment": lambda n: RETRY_DELAY_YTDLP,
-        },
-        "outtmpl": os.path.join(output_dir, f"{base_filename}.%(ext)s"),
-    }
-    if format_choice == "video":
-        ydl_download_opts["format"] = (
-            "bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/bestvideo+bestaudio/best"
+
+def _discard_orphaned_download(task: "asyncio.Future"):
+    if task.cancelled() or task.exception():
+        return
+    result = task.result()
+    if isinstance(result, tuple) and len(result) > 2:
+        remove_downloaded_file(result[2])
+
+
+def join_inflight_download(
+    key: str, start_job: Callable[[], Awaitable[Any]]
+) -> Dict[str, Any]:
+    inflight = _INFLIGHT_DOWNLOADS.get(key)
+    if inflight is None:
+        inflight = {
+            "task": asyncio.ensure_future(start_job()),
+            "participants": 0,
+            "send_lock": asyncio.Lock(),
+        }
+        _INFLIGHT_DOWNLOADS[key] = inflight
+    inflight["participants"] += 1
+    return inflight
+
+
+def leave_inflight_download(key: str) -> bool:
+    inflight = _INFLIGHT_DOWNLOADS.get(key)
+    if inflight is None:
+        return True
+    inflight["participants"] -= 1
+    if inflight["participants"] > 0:
+        return False
+    _INFLIGHT_DOWNLOADS.pop(key, None)
+    if not inflight["task"].done():
+        inflight["task"].add_done_callback(_discard_orphaned_download)
+    return True
+
+
+# --- Sent Media Cache ---
+def sent_media_cache_keys(
+    url: str, format_type: str, media_info: Optional[Dict[str, Any]] = None
+) -> List[str]:
+    keys = [f"url:{normalize_media_url(url)}:{format_type}"]
+    if media_info and media_info.get("extractor_key") and media_info.get("id"):
+        keys.append(
+            f"id:{media_info['extractor_key']}:{media_info['id']}:{format_type}"
         )
-        if FFMPEG_AVAILABLE:
-            ydl_download_opts["merge_output_format"] = "mp4"
-    elif format_choice == "audio":
-        ydl_download_opts["format"] = "bestaudio/best"
+    return keys
 
-    predicted_path = None
-    try:
-        temp_sim_opts = ydl_download_opts.copy()
-        temp_sim_opts.update(
-            {"simulate": True, "skip_download": True, "quiet": True, "verbose": False}
-        )
-        with yt_dlp.YoutubeDL(temp_sim_opts) as ydl_sim:
-            sim_info = ydl_sim.extract_info(url, download=False)
-            if sim_info and sim_info.get("requested_downloads"):
-                predicted_path = sim_info["requested_downloads"][0]["filepath"]
-            elif sim_info and sim_info.get("filename"):
-                predicted_path = sim_info["filename"]
-            else:
-                ext = media_info.get(
-                    "ext", "mp4" if format_choice == "video" else "m4a"
+
+class SentMediaCache:
+    # Telegram file_ids of media already sent, keyed by sent_media_cache_keys,
+    # so a repeat request is answered without downloading again. Entries live
+    # in their own table of the persistence database and in an in-memory LRU
+    # that lookups read from; each write changes one row.
+    def __init__(self, filepath: str, ttl: float, max_entries: int):
+        self.filepath = filepath
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.filepath, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS sent_media ("
+                "cache_key TEXT PRIMARY KEY, file_id TEXT NOT NULL, "
+                "media_kw TEXT NOT NULL, caption TEXT, file_size INTEGER, "
+                "cached_at REAL NOT NULL)"
+            )
+        return self._connection
+
+    def _write(self, upserts: List[Tuple], deletes: List[Tuple]):
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO sent_media (cache_key, file_id, media_kw, "
+                    "caption, file_size, cached_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    upserts,
                 )
-                predicted_path = os.path.join(output_dir, f"{base_filename}.{ext}")
-    except Exception as e_sim:
-        print(
-            f"WARNING: Filename prediction via simulation failed: {e_sim}. Using fallback."
+                connection.executemany(
+                    "DELETE FROM sent_media WHERE cache_key = ?", deletes
+                )
+
+    def _load(self, legacy: Optional[Dict[str, Dict[str, Any]]]):
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute(
+                    "DELETE FROM sent_media WHERE cached_at < ?",
+                    (time.time() - self.ttl,),
+                )
+            rows = connection.execute(
+                "SELECT cache_key, file_id, media_kw, caption, file_size, cached_at "
+                "FROM sent_media ORDER BY cached_at"
+            ).fetchall()
+        entries = OrderedDict(
+            (
+                key,
+                {
+                    "file_id": file_id,
+                    "media_kw": media_kw,
+                    "caption": caption,
+                    "file_size": file_size or 0,
+                    "cached_at": cached_at,
+                },
+            )
+            for key, file_id, media_kw, caption, file_size, cached_at in rows
         )
-        ext = media_info.get("ext", "mp4" if format_choice == "video" else "m4a")
-        predicted_path = os.path.join(output_dir, f"{base_filename}.{ext}")
+        if legacy:
+            # Entries kept in bot_data by earlier versions.
+            upserts = []
+            fresh_after = time.time() - self.ttl
+            for key, entry in legacy.items():
+                if (
+                    key not in entries
+                    and entry.get("file_id")
+                    and entry.get("cached_at", 0) >= fresh_after
+                ):
+                    entries[key] = entry
+                    upserts.append(self._row(key, entry))
+            self._write(upserts, [])
+        self._entries = entries
+        self._trim()
 
-    hook_data = {"actual_path": None}
+    async def load(self, legacy: Optional[Dict[str, Dict[str, Any]]] = None):
+        await asyncio.to_thread(self._load, legacy)
 
-    def _hook(d):
-        if d["status"] == "finished":
-            hook_data["actual_path"] = d["filename"]
+    @staticmethod
+    def _row(key: str, entry: Dict[str, Any]) -> Tuple:
+        return (
+            key,
+            entry["file_id"],
+            entry["media_kw"],
+            entry.get("caption"),
+            entry.get("file_size", 0),
+            entry.get("cached_at", time.time()),
+        )
 
-    ydl_download_opts.update(
-        {"progress_hooks": [_hook], "quiet": False, "verbose": False}
+    def _trim(self) -> List[Tuple]:
+        evicted = []
+        while len(self._entries) > self.max_entries:
+            key, _ = self._entries.popitem(last=False)
+            evicted.append((key,))
+        return evicted
+
+    def get(self, keys: List[str]) -> Optional[Dict[str, Any]]:
+        now_ts = time.time()
+        for key in keys:
+            entry = self._entries.get(key)
+            if not entry:
+                continue
+            if now_ts - entry.get("cached_at", 0) > self.ttl:
+                # The row itself is purged on the next load.
+                self._entries.pop(key, None)
+                continue
+            self._entries.move_to_end(key)
+            return entry
+        return None
+
+    async def store(self, keys: List[str], entry: Dict[str, Any]):
+        # Memory is updated before the first await, so a concurrent lookup for
+        # the same link already sees the new file_id.
+        entry = dict(entry, cached_at=time.time())
+        for key in keys:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+        evicted = self._trim()
+        await asyncio.to_thread(
+            self._write, [self._row(key, entry) for key in keys], evicted
+        )
+
+    async def drop(self, keys: List[str]):
+        for key in keys:
+            self._entries.pop(key, None)
+        await asyncio.to_thread(self._write, [], [(key,) for key in keys])
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+SENT_MEDIA_CACHE = SentMediaCache(
+    PERSISTENCE_DB_PATH, SENT_MEDIA_CACHE_TTL_SECONDS, SENT_MEDIA_CACHE_MAX_ENTRIES
+)
+
+
+async def load_sent_media_cache(application: Application):
+    # Older versions kept the cache in bot_data, where it was copied and
+    # re-pickled on every persistence cycle; it is moved to its table once.
+    await SENT_MEDIA_CACHE.load(application.bot_data.pop(SENT_MEDIA_CACHE_KEY, None))
+
+
+def cache_entry_from_sent_message(
+    sent_message: Any, media_kw: str, caption: str
+) -> Optional[Dict[str, Any]]:
+    for kind in (media_kw, "document"):
+        attachment = getattr(sent_message, kind, None)
+        if attachment is not None:
+            return {
+                "file_id": attachment.file_id,
+                "media_kw": kind,
+                "caption": caption,
+                "file_size": attachment.file_size or 0,
+            }
+    return None
+
+
+async def send_cached_media(
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: int,
+    entry: Dict[str, Any],
+    reply_to_message_id: Optional[int] = None,
+) -> Any:
+    media_kw = entry["media_kw"]
+    send_action = getattr(context.bot, f"send_{media_kw}")
+    return await send_action(
+        chat_id=chat_id,
+        **{media_kw: entry["file_id"]},
+        caption=entry.get("caption") or None,
+        parse_mode=constants.ParseMode.HTML,
+        reply_to_message_id=reply_to_message_id,
     )
 
-    try:
-        with yt_dlp.YoutubeDL(ydl_download_opts) as ydl:
-            ydl.download([url])
-        final_path_to_check = None
-        actual_hook_path_val = hook_data["actual_path"]
-        if actual_hook_path_val and os.path.exists(actual_hook_path_val):
-            final_path_to_check = actual_hook_path_val
-        elif predicted_path and os.path.exists(predicted_path):
-            final_path_to_check = predicted_path
-        else:
-            possible_files = [
-                f for f in os.listdir(output_dir) if f.startswith(base_filename)
-            ]
-            if possible_files:
-                final_path_to_check = os.path.join(output_dir, possible_files[0])
-        if final_path_to_check and os.path.exists(final_path_to_check):
-            return True, "Download successful.", final_path_to_check, media_info
-        print(
-            f"ERROR: Download finished but final file not confirmed. Predicted='{predicted_path}', Hook='{actual_hook_path_val}'"
+
+# --- Download Job Journal ---
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_UPLOADING = "uploading"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_PENDING_STATES = (JOB_QUEUED, JOB_RUNNING, JOB_UPLOADING)
+
+
+class DownloadJobStore:
+    # Durable record of download jobs, kept in its own table of the persistence
+    # database. Each state change is committed before the job moves on, so a
+    # restart knows which jobs to replay and which were already sent. Batch
+    # links and playlist entries share a group_id and have no status message
+    # of their own; replayed, each is sent as a single link.
+    _COLUMNS = (
+        "job_id",
+        "user_id",
+        "chat_id",
+        "url",
+        "format_type",
+        "role",
+        "status_message_id",
+        "reply_to_message_id",
+        "daily_slot_taken",
+        "group_id",
+        "state",
+        "attempts",
+        "file_id",
+        "error",
+        "created_at",
+        "updated_at",
+    )
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.filepath, check_same_thread=False)
+            self._connection.row_factory = sqlite3.Row
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.executescript(
+                "CREATE TABLE IF NOT EXISTS download_jobs ("
+                "job_id TEXT PRIMARY KEY, user_id INTEGER NOT NULL, chat_id INTEGER NOT NULL, "
+                "url TEXT NOT NULL, format_type TEXT NOT NULL, role TEXT NOT NULL, "
+                "status_message_id INTEGER, reply_to_message_id INTEGER, "
+                "daily_slot_taken INTEGER NOT NULL DEFAULT 0, group_id TEXT, "
+                "state TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, file_id TEXT, error TEXT, "
+                "created_at REAL NOT NULL, updated_at REAL NOT NULL);"
+                "CREATE INDEX IF NOT EXISTS download_jobs_state ON download_jobs (state);"
+            )
+            columns = {
+                row["name"]
+                for row in self._connection.execute("PRAGMA table_info(download_jobs)")
+            }
+            if "group_id" not in columns:
+                self._connection.execute(
+                    "ALTER TABLE download_jobs ADD COLUMN group_id TEXT"
+                )
+        return self._connection
+
+    def _execute(self, sql: str, params: tuple = ()) -> List[Dict[str, Any]]:
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                rows = connection.execute(sql, params).fetchall()
+        return [dict(row) for row in rows]
+
+    async def create(self, **fields) -> Dict[str, Any]:
+        now = time.time()
+        job = dict.fromkeys(self._COLUMNS)
+        job.update(fields)
+        job.update(
+            job_id=uuid4().hex,
+            state=JOB_QUEUED,
+            attempts=0,
+            created_at=now,
+            updated_at=now,
         )
-        return (
-            False,
-            "Download completed, but final file path not confirmed.",
-            None,
-            media_info,
+        await asyncio.to_thread(
+            self._execute,
+            f"INSERT INTO download_jobs ({', '.join(self._COLUMNS)}) "
+            f"VALUES ({', '.join('?' * len(self._COLUMNS))})",
+            tuple(job[column] for column in self._COLUMNS),
+        )
+        return job
+
+    async def update(self, job: Dict[str, Any], state: str, **fields):
+        if state == JOB_RUNNING:
+            job["attempts"] += 1
+        job.update(fields, state=state, updated_at=time.time())
+        await asyncio.to_thread(
+            self._execute,
+            "UPDATE download_jobs SET state = ?, attempts = ?, file_id = ?, error = ?, "
+            "updated_at = ? WHERE job_id = ?",
+            (
+                job["state"],
+                job["attempts"],
+                job["file_id"],
+                job["error"],
+                job["updated_at"],
+                job["job_id"],
+            ),
+        )
+
+    async def pending(self) -> List[Dict[str, Any]]:
+        return await asyncio.to_thread(
+            self._execute,
+            "SELECT * FROM download_jobs WHERE state IN (?, ?, ?) ORDER BY created_at",
+            JOB_PENDING_STATES,
+        )
+
+    async def prune(self, finished_before: float):
+        await asyncio.to_thread(
+            self._execute,
+            "DELETE FROM download_jobs WHERE state IN (?, ?) AND updated_at < ?",
+            (JOB_DONE, JOB_FAILED, finished_before),
         )
-    except yt_dlp.utils.DownloadError as e:
-        print(f"ERROR: YTDLP DownloadError for {url} (User: {user_id}): {e}")
-        return False, f"Failed to download: {e}", None, media_info
-    except Exception as e:
-        print(f"ERROR: Unexpected YTDLP error for {url} (User: {user_id}): {e}")
-        return False, f"Unexpected download error: {type(e).__name__}", None, media_info
+
+
+DOWNLOAD_JOBS = DownloadJobStore(PERSISTENCE_DB_PATH)
+_RESUMED_DOWNLOAD_TASKS: set = set()
 
 
 # --- User & Role Management ---
@@ -263,58 +2962,19 @@ def get_user_role(
     user_id_to_check: int,
     context: ContextTypes.DEFAULT_TYPE,
     current_effective_user: Optional[User],
-    for_display: bool = False,
 ) -> str:
-    if user_id_to_check in context.bot_data.get(BANNED_USERS_KEY, set()):
-        return ROLE_BANNED
-
-    ud: Dict[str, Any]
-    is_current_user_context = False
-
+    # A single lookup in the user registry. Premium downgrades happen when the
+    # expiry passes (PREMIUM_EXPIRY_SCHEDULER), not here.
     if current_effective_user and user_id_to_check == current_effective_user.id:
-        master_ud = context.application.persistence.user_data.get(user_id_to_check, {})
-        premium_fields = ["is_premium", "premium_expiry_timestamp", "premium_tier"]
-        for field in premium_fields:
-            if field in master_ud:
-                context.user_data[field] = master_ud[field]
-            else:
-                context.user_data.pop(field, None)
-        context.user_data.setdefault("_id", user_id_to_check)
-        ud = context.user_data
-        is_current_user_context = True
-    else:
-        ud = context.application.persistence.user_data.get(user_id_to_check, {})
-
-    if user_id_to_check in ADMIN_IDS:
-        return ROLE_ADMIN
-
-    premium_expiry_ts = ud.get("premium_expiry_timestamp")
-    is_premium_flag = ud.get("is_premium", False)
-    is_currently_premium = (
-        is_premium_flag
-        and premium_expiry_ts
-        and premium_expiry_ts > datetime.datetime.now().timestamp()
-    )
-
-    if is_currently_premium:
-        return ROLE_PREMIUM
-
-    if not for_display and is_current_user_context:
-        if ud.get("is_premium") or ud.get("premium_expiry_timestamp") is not None:
-            ud.update(
-                {
-                    "is_premium": False,
-                    "premium_expiry_timestamp": None,
-                    "premium_tier": (
-                        ud.get("premium_tier")
-                        if str(ud.get("premium_tier", "")).startswith(
-                            ("admin_", "revoked_")
-                        )
-                        else "expired_or_cleaned"
-                    ),
-                }
+        BROADCAST_STORE.discard_unreachable(user_id_to_check)
+        if "_id" not in context.user_data:
+            # A live entry created after startup; seed it once from the persisted
+            # record (e.g. premium granted before the user's first message).
+            context.user_data.update(
+                context.application.persistence.user_data.get(user_id_to_check, {})
             )
-    return ROLE_STANDARD
+            context.user_data["_id"] = user_id_to_check
+    return USER_REGISTRY.role_of(user_id_to_check)
 
 
 def check_and_update_daily_limit(
@@ -357,7 +3017,39 @@ async def set_channel_config(
         "enabled": enabled,
         "channels": channels,
     }
-    await context.application.persistence.flush()
+    invalidate_channel_membership_cache()
+    await flush_persistence_now(context, include_bot_data=True)
+
+
+# (user_id, channel) -> (is_member, expires_at monotonic)
+_CHANNEL_MEMBERSHIP_CACHE: Dict[Tuple[int, str], Tuple[bool, float]] = {}
+
+
+def invalidate_channel_membership_cache():
+    _CHANNEL_MEMBERSHIP_CACHE.clear()
+
+
+async def _is_user_in_channel_cached(
+    user_id: int, channel_identifier: str, context: ContextTypes.DEFAULT_TYPE
+) -> bool:
+    cache_key = (user_id, channel_identifier)
+    now = time.monotonic()
+    cached = _CHANNEL_MEMBERSHIP_CACHE.get(cache_key)
+    if cached and cached[1] > now:
+        return cached[0]
+    is_member = await _is_user_in_channel(user_id, channel_identifier, context)
+    if len(_CHANNEL_MEMBERSHIP_CACHE) >= CHANNEL_MEMBERSHIP_CACHE_MAX_ENTRIES:
+        for key in [k for k, v in _CHANNEL_MEMBERSHIP_CACHE.items() if v[1] <= now]:
+            del _CHANNEL_MEMBERSHIP_CACHE[key]
+        if len(_CHANNEL_MEMBERSHIP_CACHE) >= CHANNEL_MEMBERSHIP_CACHE_MAX_ENTRIES:
+            _CHANNEL_MEMBERSHIP_CACHE.clear()
+    ttl = (
+        CHANNEL_MEMBERSHIP_POSITIVE_TTL_SECONDS
+        if is_member
+        else CHANNEL_MEMBERSHIP_NEGATIVE_TTL_SECONDS
+    )
+    _CHANNEL_MEMBERSHIP_CACHE[cache_key] = (is_member, now + ttl)
+    return is_member
 
 
 async def check_channel_join(
@@ -366,17 +3058,21 @@ async def check_channel_join(
     config = await get_channel_config(context)
     if not config.get("enabled") or not config.get("channels"):
         return True, None
+    channels = list(config["channels"])
+    results = await asyncio.gather(
+        *(
+            _is_user_in_channel_cached(user_id, str(ch_id_str), context)
+            for ch_id_str in channels
+        ),
+        return_exceptions=True,
+    )
     missing_channels = []
-    for ch_id_str in config["channels"]:
-        try:
-            ch_to_check = (
-                str(ch_id_str) if not str(ch_id_str).startswith("@") else ch_id_str
-            )
-            if not await _is_user_in_channel(user_id, ch_to_check, context):
-                missing_channels.append(ch_id_str)
-        except Exception as e:
-            print(f"WARNING: Error processing channel {ch_id_str} for join check: {e}")
+    for ch_id_str, result in zip(channels, results):
+        if isinstance(result, Exception):
+            print(f"WARNING: Error processing channel {ch_id_str} for join check: {result}")
             missing_channels.append(f"{ch_id_str} (config error?)")
+        elif not result:
+            missing_channels.append(ch_id_str)
     return (
         (False, f"Please join: {', '.join(missing_channels)}")
         if missing_channels
@@ -413,9 +3109,8 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if not user:
         return
-    context.user_data.setdefault("_id", user.id)
     role_name = get_user_role(user.id, context, user).capitalize()
-    await context.application.persistence.flush()
+    request_persistence_flush(context, user.id)
     welcome_msg = (
         f"👋 Hello {user.mention_html()}!\n\n"
         "I'm your media downloader bot. Send me a link from supported platforms, and I'll fetch it for you!\n\n"
@@ -430,9 +3125,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     effective_user = update.effective_user
     if not effective_user:
         return
-    user_role_for_display = get_user_role(
-        effective_user.id, context, effective_user, for_display=True
-    )
+    user_role_for_display = get_user_role(effective_user.id, context, effective_user)
     base_help = (
         "🌟 **Welcome to the Media Downloader Bot!** 🌟\n\n"
         "Here's how I can help you:\n"
@@ -485,7 +3178,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "  /togglechannelcheck - Enable/disable mandatory channel join.\n"
             "  /setrequiredchannels `[@ch1 ID2...]` or `none` - Set channels.\n"
             "  /stats - View bot usage statistics.\n"
-            "  /viewusers - List users with details.\n"
+            "  /viewusers `[role] [after_id]` - Page through users with details.\n"
         )
     await update.message.reply_html(final_help_msg)
 
@@ -496,7 +3189,7 @@ async def myrole_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     user_id = user.id
     role_actual = get_user_role(user_id, context, user)
-    await context.application.persistence.flush()
+    request_persistence_flush(context, user_id)
     display_role = role_actual.capitalize()
     is_premium_active = False
     ud = context.user_data
@@ -566,62 +3259,177 @@ async def premium_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
-def is_tiktok_url(url_string: str) -> bool:
-    try:
-        parsed_url = urlparse(url_string.lower())
-        return parsed_url.hostname in TIKTOK_HOSTNAMES
-    except Exception:
-        return False
-
-
-async def process_url_from_message(
-    url: str, update: Update, context: ContextTypes.DEFAULT_TYPE
+def is_tiktok_url(url_string: str) -> bool:
+    try:
+        parsed_url = urlparse(url_string.lower())
+        return parsed_url.hostname in TIKTOK_HOSTNAMES
+    except Exception:
+        return False
+
+
+async def process_url_from_message(
+    url: str, update: Update, context: ContextTypes.DEFAULT_TYPE
+):
+    user = update.effective_user
+    if not user:
+        return
+    user_id = user.id
+    role = get_user_role(user_id, context, user)
+    request_persistence_flush(context, user_id)
+    if role == ROLE_BANNED:
+        await update.message.reply_text("You are banned from using this bot.")
+        return
+    allow_all = role in (ROLE_ADMIN, ROLE_PREMIUM)
+    if role == ROLE_STANDARD and not allow_all:
+        can_download, reason = await _can_standard_user_download(user_id, url, context)
+        if not can_download:
+            await update.message.reply_html(reason or "Download not allowed")
+            return
+    token = add_pending_request(user_id, [url], update.message.message_id)
+    buttons = [[InlineKeyboardButton("🎬 Video", callback_data=f"dl_video:{token}")]]
+    if allow_all:
+        buttons[0].append(
+            InlineKeyboardButton(
+                "🎵 Audio (Original)", callback_data=f"dl_audio:{token}"
+            )
+        )
+        if await asyncio.to_thread(looks_like_playlist_url, url):
+            buttons.append(
+                [
+                    InlineKeyboardButton(
+                        "📃 Playlist: Video",
+                        callback_data=f"dl_playlist_video:{token}",
+                    ),
+                    InlineKeyboardButton(
+                        "📃 Playlist: Audio",
+                        callback_data=f"dl_playlist_audio:{token}",
+                    ),
+                ]
+            )
+    message_text = "Choose your desired format:"
+    if role == ROLE_STANDARD and not allow_all:
+        message_text = (
+            "Choose your desired format (TikTok video only for standard users):"
+        )
+    await update.message.reply_text(
+        message_text,
+        reply_markup=InlineKeyboardMarkup(buttons),
+        reply_to_message_id=update.message.message_id,
+        parse_mode=constants.ParseMode.HTML,
+    )
+
+
+async def process_batch_from_message(
+    urls: List[str], update: Update, context: ContextTypes.DEFAULT_TYPE
 ):
+    # Several links in one message: one role/channel check and one keyboard.
     user = update.effective_user
     if not user:
         return
     user_id = user.id
     role = get_user_role(user_id, context, user)
-    await context.application.persistence.flush()
+    request_persistence_flush(context, user_id)
     if role == ROLE_BANNED:
         await update.message.reply_text("You are banned from using this bot.")
         return
-    is_admin_check = user_id in ADMIN_IDS
-    is_premium_active_check = False
-    if context.user_data.get("is_premium"):
-        exp_ts = context.user_data.get("premium_expiry_timestamp")
-        if exp_ts and exp_ts > datetime.datetime.now().timestamp():
-            is_premium_active_check = True
-    allow_all = is_admin_check or is_premium_active_check
+    allow_all = role in (ROLE_ADMIN, ROLE_PREMIUM)
+    skipped_note = ""
     if role == ROLE_STANDARD and not allow_all:
-        can_download, reason = await _can_standard_user_download(user_id, url, context)
-        if not can_download:
-            await update.message.reply_html(reason or "Download not allowed")
+        joined, ch_msg = await check_channel_join(user_id, context)
+        if not joined:
+            await update.message.reply_html(
+                ch_msg or "Please join our channel(s) to continue."
+            )
             return
-    context.user_data.update(
-        {
-            "current_url_to_download": url,
-            "last_message_id_for_url": update.message.message_id,
-        }
-    )
-    buttons = [[InlineKeyboardButton("🎬 Video", callback_data="dl_video")]]
+        supported_urls = [u for u in urls if is_tiktok_url(u)]
+        if not supported_urls:
+            await update.message.reply_html(
+                "Standard users can only download from TikTok. /premium for all supported sources."
+            )
+            return
+        if len(supported_urls) < len(urls):
+            skipped_note = f"\n({len(urls) - len(supported_urls)} non-TikTok link(s) skipped, /premium for all sources.)"
+        urls = supported_urls
+    if len(urls) == 1:
+        await process_url_from_message(urls[0], update, context)
+        return
+    token = add_pending_request(user_id, urls, update.message.message_id)
+    buttons = [
+        [
+            InlineKeyboardButton(
+                f"🎬 Video ×{len(urls)}", callback_data=f"dl_batch_video:{token}"
+            )
+        ]
+    ]
     if allow_all:
         buttons[0].append(
-            InlineKeyboardButton("🎵 Audio (Original)", callback_data="dl_audio")
-        )
-    message_text = "Choose your desired format:"
-    if role == ROLE_STANDARD and not allow_all:
-        message_text = (
-            "Choose your desired format (TikTok video only for standard users):"
+            InlineKeyboardButton(
+                f"🎵 Audio ×{len(urls)}", callback_data=f"dl_batch_audio:{token}"
+            )
         )
     await update.message.reply_text(
-        message_text,
+        f"Found {len(urls)} links. Choose your desired format:{skipped_note}",
         reply_markup=InlineKeyboardMarkup(buttons),
         reply_to_message_id=update.message.message_id,
-        parse_mode=constants.ParseMode.HTML,
     )
 
 
+# --- Pending Requests ---
+# Keyboard messages waiting for a format choice, oldest first. Each message has
+# its own entry, so a user can have several links pending at once.
+_PENDING_REQUESTS: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+# Per-message state that used to live in user_data; dropped on startup.
+LEGACY_PENDING_USER_DATA_KEYS = (
+    "current_url_to_download",
+    "current_batch_urls",
+    "last_message_id_for_url",
+)
+
+
+def add_pending_request(
+    user_id: int, urls: List[str], reply_to_message_id: Optional[int]
+) -> str:
+    now = time.monotonic()
+    while _PENDING_REQUESTS:
+        oldest = next(iter(_PENDING_REQUESTS.values()))
+        if (
+            len(_PENDING_REQUESTS) < PENDING_REQUEST_MAX_ENTRIES
+            and now - oldest["created_at"] < PENDING_REQUEST_TTL_SECONDS
+        ):
+            break
+        _PENDING_REQUESTS.popitem(last=False)
+    token = uuid4().hex[:PENDING_REQUEST_TOKEN_LENGTH]
+    _PENDING_REQUESTS[token] = {
+        "user_id": user_id,
+        "urls": urls,
+        "reply_to_message_id": reply_to_message_id,
+        "created_at": now,
+    }
+    return token
+
+
+def take_pending_request(token: str, user_id: int) -> Optional[Dict[str, Any]]:
+    # One-shot: the keyboard is replaced by a status message once tapped.
+    entry = _PENDING_REQUESTS.get(token)
+    if entry is None or entry["user_id"] != user_id:
+        return None
+    del _PENDING_REQUESTS[token]
+    if time.monotonic() - entry["created_at"] > PENDING_REQUEST_TTL_SECONDS:
+        return None
+    return entry
+
+
+def drop_legacy_pending_user_data(application: Application):
+    removed = 0
+    for user_data in (application.user_data, application.persistence.user_data):
+        for ud in user_data.values():
+            for key in LEGACY_PENDING_USER_DATA_KEYS:
+                if ud.pop(key, None) is not None:
+                    removed += 1
+    if removed:
+        application.persistence.schedule_flush()
+
+
 async def _can_standard_user_download(
     user_id: int, url: str, context: ContextTypes.DEFAULT_TYPE
 ) -> Tuple[bool, Optional[str]]:
@@ -661,10 +3469,15 @@ async def handle_url_message(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 "Please send a valid media link to download."
             )
         return
-    url_to_process = found_urls[0].strip()
-    if not url_to_process.startswith(("http://", "https://")):
-        url_to_process = "https://" + url_to_process
-    await process_url_from_message(url_to_process, update, context)
+    session = get_http_session(context.bot_data)
+    canonical_urls = await asyncio.gather(
+        *(canonicalize_media_url(u, session) for u in found_urls[: MAX_BATCH_URLS * 2])
+    )
+    urls_to_process = list(dict.fromkeys(canonical_urls))[:MAX_BATCH_URLS]
+    if len(urls_to_process) > 1:
+        await process_batch_from_message(urls_to_process, update, context)
+    else:
+        await process_url_from_message(urls_to_process[0], update, context)
 
 
 def format_media_caption(
@@ -696,10 +3509,10 @@ async def download_format_callback(update: Update, context: ContextTypes.DEFAULT
     user = query.from_user
     if not user:
         return
-    choice = query.data
+    choice, _, token = query.data.partition(":")
     format_type = "video" if choice == "dl_video" else "audio"
-    url = context.user_data.get("current_url_to_download")
-    if not url:
+    pending = take_pending_request(token, user.id)
+    if not pending:
         try:
             await query.edit_message_text(
                 "Error: URL context lost. Please send the link again."
@@ -710,9 +3523,10 @@ async def download_format_callback(update: Update, context: ContextTypes.DEFAULT
                 "Error: URL context lost. Please send the link again.",
             )
         return
+    url = pending["urls"][0]
     user_id = user.id
     role = get_user_role(user_id, context, user)
-    await context.application.persistence.flush()
+    request_persistence_flush(context, user_id)
     if role == ROLE_BANNED:
         try:
             await query.edit_message_text(
@@ -721,14 +3535,7 @@ async def download_format_callback(update: Update, context: ContextTypes.DEFAULT
         except TelegramError:
             pass
             return
-    is_admin = user_id in ADMIN_IDS
-    is_premium_active = False
-    if context.user_data.get("is_premium"):
-        exp_ts = context.user_data.get("premium_expiry_timestamp")
-        if exp_ts and exp_ts > datetime.datetime.now().timestamp():
-            is_premium_active = True
-    can_download_audio = is_admin or is_premium_active
-    is_standard_non_privileged = role == ROLE_STANDARD and not can_download_audio
+    is_standard_non_privileged = role == ROLE_STANDARD
     standard_user_limit_decremented_this_attempt = False
     if is_standard_non_privileged:
         if format_type == "audio":
@@ -748,33 +3555,251 @@ async def download_format_callback(update: Update, context: ContextTypes.DEFAULT
                 pass
                 return
         standard_user_limit_decremented_this_attempt = True
-        await context.application.persistence.flush()
+        request_persistence_flush(context, user_id)
 
+    job = await DOWNLOAD_JOBS.create(
+        user_id=user_id,
+        chat_id=query.message.chat_id,
+        url=url,
+        format_type=format_type,
+        role=role,
+        status_message_id=query.message.message_id,
+        reply_to_message_id=pending["reply_to_message_id"],
+        daily_slot_taken=int(standard_user_limit_decremented_this_attempt),
+    )
+    await run_persistent_download_job(context, job)
+
+
+async def run_persistent_download_job(
+    context: ContextTypes.DEFAULT_TYPE, job: Dict[str, Any]
+):
+    """Download and send one journaled job, recording each state change in
+    DOWNLOAD_JOBS. Used by the format callback and by the startup replay."""
+    user_id = job["user_id"]
+    chat_id = job["chat_id"]
+    url = job["url"]
+    format_type = job["format_type"]
+    scheduler_role = job["role"]
+    is_standard_non_privileged = scheduler_role == ROLE_STANDARD
+    standard_user_limit_decremented_this_attempt = bool(job["daily_slot_taken"])
+    orig_msg_id_for_reply = job["reply_to_message_id"]
     status_message_text = f"⏳ Preparing to download {format_type}..."
-    try:
-        await query.edit_message_text(text=status_message_text)
-    except TelegramError as e:
-        print(f"Error editing message in download_format_callback: {e}")
+
+    async def _edit_status(text: str):
+        if job["status_message_id"] is None:
+            return
+        try:
+            await context.bot.edit_message_text(
+                text=text, chat_id=chat_id, message_id=job["status_message_id"]
+            )
+        except TelegramError:
+            pass
+
+    async def _report(text: str):
+        # Final outcomes fall back to a new message if the status is gone.
+        if job["status_message_id"] is not None:
+            try:
+                await context.bot.edit_message_text(
+                    text=text, chat_id=chat_id, message_id=job["status_message_id"]
+                )
+                return
+            except TelegramError:
+                pass
+        await context.bot.send_message(
+            chat_id=chat_id, text=text, reply_to_message_id=orig_msg_id_for_reply
+        )
+
+    async def _delete_status():
+        if job["status_message_id"] is None:
+            return
+        try:
+            await context.bot.delete_message(chat_id, job["status_message_id"])
+        except TelegramError:
+            pass
+
+    async def _fail(error: str, text: str):
+        if job["file_id"] is not None:
+            # Delivered already; whatever failed afterwards is not the user's.
+            print(f"WARNING: Job {job['job_id']} failed after sending: {error}")
+            await DOWNLOAD_JOBS.update(job, JOB_DONE)
+            return
+        await DOWNLOAD_JOBS.update(job, JOB_FAILED, error=error)
+        try:
+            await _report(text)
+        except TelegramError:
+            pass
+        if standard_user_limit_decremented_this_attempt:
+            revert_daily_limit_decrement(context)
+
+    if job["file_id"] is not None:
+        # The file was sent before the bot stopped; never send it twice.
+        await DOWNLOAD_JOBS.update(job, JOB_DONE)
+        return
+    await _edit_status(status_message_text)
 
     file_path_final = None
     media_info_from_ytdlp = None
-    download_successful_flag = False
-    orig_msg_id_for_reply = context.user_data.get("last_message_id_for_url")
+
+    async def _report_queue_position(position: int):
+        await _edit_status(
+            f"🕒 Queued for download ({format_type}). Position in line: {position}"
+            if position
+            else status_message_text
+        )
+
+    current_user_size_limit = (
+        STANDARD_USER_FILE_SIZE_LIMIT_MB
+        if is_standard_non_privileged
+        else get_direct_send_limit_mb()
+    )
+    cache_keys = sent_media_cache_keys(url, format_type)
+    # Jobs are only shared between users with the same size budget, since
+    # the budget decides whether the download is aborted.
+    inflight_key = f"{cache_keys[0]}:{current_user_size_limit:.0f}"
+    joined_inflight = False
+
+    progress = ProgressReporter(asyncio.get_running_loop(), _edit_status, format_type)
+
+    async def _record_sent(file_id: Optional[str]):
+        # Written as soon as Telegram accepted the file, before the cache and
+        # the done state, so a restart in between never sends it again. An
+        # empty string marks a send whose file_id could not be read.
+        await DOWNLOAD_JOBS.update(job, JOB_UPLOADING, file_id=file_id or "")
+
+    async def _send_from_cache() -> bool:
+        cached_media = SENT_MEDIA_CACHE.get(cache_keys)
+        if not cached_media or cached_media.get("file_size", 0) > (
+            current_user_size_limit * 1024 * 1024
+        ):
+            return False
+        try:
+            await DOWNLOAD_JOBS.update(job, JOB_UPLOADING)
+            await send_cached_media(
+                context, chat_id, cached_media, orig_msg_id_for_reply
+            )
+        except TelegramError as e:
+            print(f"WARNING: Cached file_id for {url} rejected, downloading: {e}")
+            await SENT_MEDIA_CACHE.drop(cache_keys)
+            return False
+        await _record_sent(cached_media["file_id"])
+        await DOWNLOAD_JOBS.update(job, JOB_DONE)
+        await _delete_status()
+        return True
+
+    stream_done: Optional[asyncio.Event] = None
+
+    def _finish_stream():
+        nonlocal stream_done
+        if stream_done is not None:
+            _INFLIGHT_STREAMS.pop(inflight_key, None)
+            stream_done.set()
+            stream_done = None
 
     try:
-        success, message, file_path_final, media_info_from_ytdlp = (
-            await asyncio.to_thread(
-                download_media_ytdlp, url, DOWNLOAD_DIR, format_type, user_id
+        await DOWNLOAD_JOBS.update(job, JOB_RUNNING)
+        if await _send_from_cache():
+            return
+
+        streaming_elsewhere = _INFLIGHT_STREAMS.get(inflight_key)
+        if streaming_elsewhere is not None:
+            # Another request is streaming this link; reuse its file_id.
+            await _edit_status(
+                f"⏳ This link is already being sent, waiting for it ({format_type})..."
+            )
+            await streaming_elsewhere.wait()
+            if await _send_from_cache():
+                return
+
+        if (
+            STREAMING_UPLOAD_ENABLED
+            and not is_local_bot_api_enabled()
+            and inflight_key not in _INFLIGHT_DOWNLOADS
+            and inflight_key not in _INFLIGHT_STREAMS
+        ):
+            stream_done = asyncio.Event()
+            _INFLIGHT_STREAMS[inflight_key] = stream_done
+            async def _probe_and_stream() -> Tuple[Any, Any]:
+                # Probe and transfer share one scheduler slot, so streamed
+                # uploads count against the same total and per-user limits.
+                stream_info = await asyncio.to_thread(
+                    probe_stream_source,
+                    url,
+                    format_type,
+                    int(current_user_size_limit * 1024 * 1024),
+                )
+                if not stream_info:
+                    return None, None
+                await DOWNLOAD_JOBS.update(job, JOB_UPLOADING)
+                try:
+                    sent_message = await stream_upload_media(
+                        get_http_session(context.bot_data),
+                        context.bot,
+                        chat_id,
+                        stream_info,
+                        format_type,
+                        format_media_caption(stream_info, url),
+                        int(current_user_size_limit * 1024 * 1024),
+                        orig_msg_id_for_reply,
+                        lambda size: asyncio.ensure_future(
+                            _edit_status(
+                                f"🚀 Streaming {format_type} ({_format_bytes_mb(size)})..."
+                            )
+                        ),
+                    )
+                except Exception as e:
+                    print(f"Streaming upload failed for {url}, using temp file: {e}")
+                    return stream_info, None
+                return stream_info, sent_message
+
+            stream_info, sent_message = await DOWNLOAD_SCHEDULER.run_async(
+                user_id,
+                scheduler_role,
+                _probe_and_stream,
+                on_queue_update=_report_queue_position,
+            )
+            if sent_message is not None:
+                caption = format_media_caption(stream_info, url)
+                media_kw = "video" if format_type == "video" else "audio"
+                cache_entry = cache_entry_from_sent_message(
+                    sent_message, media_kw, caption
+                )
+                await _record_sent(cache_entry["file_id"] if cache_entry else None)
+                if cache_entry:
+                    await SENT_MEDIA_CACHE.store(
+                        sent_media_cache_keys(url, format_type, stream_info),
+                        cache_entry,
+                    )
+                await DOWNLOAD_JOBS.update(job, JOB_DONE)
+                await _delete_status()
+                return
+
+        # Waiters on a failed stream wake up to find (and join) this download.
+        _finish_stream()
+        inflight = join_inflight_download(
+            inflight_key,
+            lambda: run_download_job(
+                user_id,
+                scheduler_role,
+                url,
+                format_type,
+                progress.hook,
+                int(current_user_size_limit * 1024 * 1024),
+                on_queue_update=_report_queue_position,
+            ),
+        )
+        joined_inflight = True
+        progress.start()
+        if inflight["participants"] > 1:
+            await _edit_status(
+                f"⏳ This link is already being downloaded, waiting for it ({format_type})..."
             )
+        success, message, file_path_final, media_info_from_ytdlp = (
+            await asyncio.shield(inflight["task"])
         )
+        await progress.stop()
         if success and file_path_final and os.path.exists(file_path_final):
             file_size_mb = os.path.getsize(file_path_final) / (1024 * 1024)
             caption = format_media_caption(media_info_from_ytdlp, url)
-            current_user_size_limit = (
-                STANDARD_USER_FILE_SIZE_LIMIT_MB
-                if is_standard_non_privileged
-                else PREMIUM_ADMIN_DIRECT_SEND_LIMIT_MB
-            )
             if file_size_mb > current_user_size_limit:
                 size_err_msg = (
                     f"✅ Downloaded: {os.path.basename(file_path_final)}\n"
@@ -783,17 +3808,8 @@ async def download_format_callback(update: Update, context: ContextTypes.DEFAULT
                 if is_standard_non_privileged:
                     size_err_msg += "\nUpgrade to /premium for larger files."
                 else:
-                    size_err_msg += "\n(Telegram's practical limit for direct bot uploads is ~50MB)."
-                try:
-                    await query.edit_message_text(size_err_msg)
-                except TelegramError:
-                    await context.bot.send_message(
-                        chat_id=query.message.chat_id,
-                        text=size_err_msg,
-                        reply_to_message_id=orig_msg_id_for_reply,
-                    )
-                if standard_user_limit_decremented_this_attempt:
-                    revert_daily_limit_decrement(context)
+                    size_err_msg += f"\n(The bot's current upload limit is ~{get_direct_send_limit_mb():.0f}MB)."
+                await _fail("file too large", size_err_msg)
             else:
                 send_action = (
                     context.bot.send_video
@@ -802,79 +3818,649 @@ async def download_format_callback(update: Update, context: ContextTypes.DEFAULT
                 )
                 media_kw = "video" if format_type == "video" else "audio"
                 try:
-                    try:
-                        await query.edit_message_text(
-                            f"🚀 Uploading {format_type} ({file_size_mb:.2f}MB)..."
-                        )
-                    except TelegramError:
-                        pass
-                    with open(file_path_final, "rb") as f:
-                        await send_action(
-                            chat_id=query.message.chat_id,
-                            **{media_kw: f},
-                            caption=caption,
-                            parse_mode=constants.ParseMode.HTML,
-                            reply_to_message_id=orig_msg_id_for_reply,
-                        )
-                    try:
-                        await query.message.delete()
-                    except TelegramError:
-                        pass
-                    download_successful_flag = True
+                    # Only one participant uploads; the others reuse its file_id.
+                    async with inflight["send_lock"]:
+                        await DOWNLOAD_JOBS.update(job, JOB_UPLOADING)
+                        shared_media = SENT_MEDIA_CACHE.get(cache_keys)
+                        if shared_media:
+                            await send_cached_media(
+                                context,
+                                chat_id,
+                                shared_media,
+                                orig_msg_id_for_reply,
+                            )
+                            await _record_sent(shared_media["file_id"])
+                        else:
+                            await _edit_status(
+                                f"🚀 Uploading {format_type} ({file_size_mb:.2f}MB)..."
+                            )
+                            progress.start_upload(os.path.getsize(file_path_final))
+                            progress.start()
+                            try:
+                                if is_local_bot_api_enabled():
+                                    # The local server reads the file from disk itself.
+                                    sent_message = await send_action(
+                                        chat_id=chat_id,
+                                        **{media_kw: Path(file_path_final)},
+                                        caption=caption,
+                                        parse_mode=constants.ParseMode.HTML,
+                                        reply_to_message_id=orig_msg_id_for_reply,
+                                    )
+                                else:
+                                    with open(file_path_final, "rb") as f:
+                                        sent_message = await send_action(
+                                            chat_id=chat_id,
+                                            **{media_kw: f},
+                                            caption=caption,
+                                            parse_mode=constants.ParseMode.HTML,
+                                            reply_to_message_id=orig_msg_id_for_reply,
+                                        )
+                            finally:
+                                await progress.stop()
+                            cache_entry = cache_entry_from_sent_message(
+                                sent_message, media_kw, caption
+                            )
+                            await _record_sent(
+                                cache_entry["file_id"] if cache_entry else None
+                            )
+                            if cache_entry:
+                                await SENT_MEDIA_CACHE.store(
+                                    sent_media_cache_keys(
+                                        url, format_type, media_info_from_ytdlp
+                                    ),
+                                    cache_entry,
+                                )
+                    await DOWNLOAD_JOBS.update(job, JOB_DONE)
+                    await _delete_status()
                 except TelegramError as te:
                     err_txt = f"Error sending file: {te}."
                     if (
                         "request entity too large" in str(te).lower()
                         or "file is too big" in str(te).lower()
                     ):
-                        err_txt = f"File ({file_size_mb:.2f}MB) is too large for Telegram direct upload by bots (limit ~50MB)."
-                    try:
-                        await query.edit_message_text(err_txt)
-                    except TelegramError:
-                        await context.bot.send_message(
-                            chat_id=query.message.chat_id,
-                            text=err_txt,
-                            reply_to_message_id=orig_msg_id_for_reply,
-                        )
-                    if standard_user_limit_decremented_this_attempt:
-                        revert_daily_limit_decrement(context)
+                        err_txt = f"File ({file_size_mb:.2f}MB) is too large for Telegram direct upload by bots (limit ~{get_direct_send_limit_mb():.0f}MB)."
+                    await _fail(str(te), err_txt)
+        else:
+            await _fail(message, f"❌ Download failed: {message}")
+    except Exception as e:
+        print(f"ERROR: Error in download callback {url} (User: {user_id}): {e}")
+        if job["state"] != JOB_DONE:
+            await _fail(
+                f"{type(e).__name__}: {e}",
+                f"An unexpected error occurred: {type(e).__name__}.",
+            )
+    finally:
+        # A cancelled job (shutdown) keeps its state and is replayed on startup.
+        _finish_stream()
+        await progress.stop()
+        if not joined_inflight or leave_inflight_download(inflight_key):
+            remove_downloaded_file(file_path_final)
+        request_persistence_flush(context, user_id)
+
+
+async def resume_download_jobs(application: Application):
+    # Replays jobs left queued/running/uploading by a restart or crash.
+    await DOWNLOAD_JOBS.prune(time.time() - DOWNLOAD_JOB_HISTORY_SECONDS)
+    notified_groups: set = set()
+    for job in await DOWNLOAD_JOBS.pending():
+        context = application.context_types.context(
+            application, chat_id=job["chat_id"], user_id=job["user_id"]
+        )
+        too_old = time.time() - job["created_at"] > DOWNLOAD_JOB_REPLAY_MAX_AGE_SECONDS
+        if too_old or job["attempts"] >= DOWNLOAD_JOB_MAX_ATTEMPTS:
+            await DOWNLOAD_JOBS.update(job, JOB_FAILED, error="not resumed")
+            if job["daily_slot_taken"]:
+                revert_daily_limit_decrement(context)
+                request_persistence_flush(context, job["user_id"])
+            if job["group_id"]:
+                if job["group_id"] in notified_groups:
+                    continue
+                notified_groups.add(job["group_id"])
+            try:
+                await application.bot.send_message(
+                    job["chat_id"],
+                    "⚠️ Your download was interrupted by a restart. Please send the link again.",
+                    reply_to_message_id=job["reply_to_message_id"],
+                )
+            except TelegramError:
+                pass
+            continue
+        print(f"Resuming download job {job['job_id']} ({job['state']}) for user {job['user_id']}.")
+        task = asyncio.create_task(run_persistent_download_job(context, job))
+        _RESUMED_DOWNLOAD_TASKS.add(task)
+        task.add_done_callback(_RESUMED_DOWNLOAD_TASKS.discard)
+
+
+async def _fetch_batch_item(
+    context: ContextTypes.DEFAULT_TYPE,
+    url: str,
+    format_type: str,
+    user_id: int,
+    scheduler_role: str,
+    size_limit_mb: float,
+) -> Dict[str, Any]:
+    size_limit_bytes = int(size_limit_mb * 1024 * 1024)
+    cache_keys = sent_media_cache_keys(url, format_type)
+    item: Dict[str, Any] = {"url": url}
+    cached_media = SENT_MEDIA_CACHE.get(cache_keys)
+    if cached_media and cached_media.get("file_size", 0) <= size_limit_bytes:
+        item["cached"] = cached_media
+        return item
+    item["inflight_key"] = f"{cache_keys[0]}:{size_limit_mb:.0f}"
+    inflight = join_inflight_download(
+        item["inflight_key"],
+        lambda: run_download_job(
+            user_id, scheduler_role, url, format_type, None, size_limit_bytes
+        ),
+    )
+    try:
+        success, message, file_path, media_info = await asyncio.shield(
+            inflight["task"]
+        )
+    except asyncio.CancelledError:
+        # The shared job keeps running; the last participant out discards it.
+        leave_inflight_download(item.pop("inflight_key"))
+        raise
+    except Exception as e:
+        print(f"ERROR: Batch download {url} (User: {user_id}) failed: {e}")
+        item["error"] = f"unexpected error: {type(e).__name__}"
+        return item
+    item.update(path=file_path, info=media_info)
+    if not success or not file_path or not os.path.exists(file_path):
+        item["error"] = message
+    elif os.path.getsize(file_path) > size_limit_bytes:
+        item["error"] = f"larger than your {size_limit_mb:.0f}MB limit"
+    else:
+        item["caption"] = format_media_caption(media_info, url)
+    return item
+
+
+async def _store_batch_item_cache(
+    item: Dict[str, Any],
+    sent_message: Any,
+    media_kw: str,
+):
+    cache_entry = cache_entry_from_sent_message(
+        sent_message, media_kw, item.get("caption", "")
+    )
+    if cache_entry:
+        await SENT_MEDIA_CACHE.store(
+            sent_media_cache_keys(item["url"], media_kw, item.get("info")),
+            cache_entry,
+        )
+
+
+async def _journal_batch_item_sent(
+    item: Dict[str, Any], sent_message: Any, media_kw: str
+):
+    # Marked done as soon as Telegram has the file, before anything else, so
+    # a restart never delivers the item twice.
+    job = item.get("job")
+    if job is None:
+        return
+    if "cached" in item:
+        file_id = item["cached"]["file_id"]
+    else:
+        cache_entry = cache_entry_from_sent_message(
+            sent_message, media_kw, item.get("caption", "")
+        )
+        file_id = cache_entry["file_id"] if cache_entry else None
+    await DOWNLOAD_JOBS.update(job, JOB_DONE, file_id=file_id or "")
+
+
+async def _send_batch_item(
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: int,
+    item: Dict[str, Any],
+    media_kw: str,
+    reply_to_message_id: Optional[int],
+):
+    if "cached" in item:
+        sent_message = await send_cached_media(
+            context, chat_id, item["cached"], reply_to_message_id
+        )
+        await _journal_batch_item_sent(item, sent_message, media_kw)
+        return
+    send_action = getattr(context.bot, f"send_{media_kw}")
+    if is_local_bot_api_enabled():
+        sent_message = await send_action(
+            chat_id=chat_id,
+            **{media_kw: Path(item["path"])},
+            caption=item["caption"],
+            parse_mode=constants.ParseMode.HTML,
+            reply_to_message_id=reply_to_message_id,
+        )
+    else:
+        with open(item["path"], "rb") as f:
+            sent_message = await send_action(
+                chat_id=chat_id,
+                **{media_kw: f},
+                caption=item["caption"],
+                parse_mode=constants.ParseMode.HTML,
+                reply_to_message_id=reply_to_message_id,
+            )
+    await _journal_batch_item_sent(item, sent_message, media_kw)
+    await _store_batch_item_cache(item, sent_message, media_kw)
+
+
+async def _send_batch_album(
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: int,
+    items: List[Dict[str, Any]],
+    media_kw: str,
+    reply_to_message_id: Optional[int],
+):
+    input_media_cls = InputMediaVideo if media_kw == "video" else InputMediaAudio
+    with ExitStack() as stack:
+        media = []
+        for item in items:
+            if "cached" in item:
+                source = item["cached"]["file_id"]
+                caption = item["cached"].get("caption")
+            elif is_local_bot_api_enabled():
+                source, caption = Path(item["path"]), item["caption"]
+            else:
+                source = stack.enter_context(open(item["path"], "rb"))
+                caption = item["caption"]
+            media.append(
+                input_media_cls(
+                    media=source,
+                    caption=caption or None,
+                    parse_mode=constants.ParseMode.HTML,
+                )
+            )
+        sent_messages = await context.bot.send_media_group(
+            chat_id=chat_id, media=media, reply_to_message_id=reply_to_message_id
+        )
+    for item, sent_message in zip(items, sent_messages):
+        await _journal_batch_item_sent(item, sent_message, media_kw)
+    for item, sent_message in zip(items, sent_messages):
+        if "cached" not in item:
+            await _store_batch_item_cache(item, sent_message, media_kw)
+
+
+async def send_batch_results(
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: int,
+    items: List[Dict[str, Any]],
+    media_kw: str,
+    reply_to_message_id: Optional[int],
+) -> int:
+    """Sends ready items as albums of up to MAX_BATCH_URLS, keeping each
+    album's upload within the direct send limit. Returns the number sent."""
+    upload_budget = get_direct_send_limit_mb() * 1024 * 1024
+    albums: List[List[Dict[str, Any]]] = []
+    singles: List[Dict[str, Any]] = []
+    album_bytes = 0
+    for item in items:
+        if "cached" in item and item["cached"]["media_kw"] != media_kw:
+            singles.append(item)  # e.g. sent as a document before
+            continue
+        item_bytes = 0 if "cached" in item else os.path.getsize(item["path"])
+        over_budget = (
+            not is_local_bot_api_enabled() and album_bytes + item_bytes > upload_budget
+        )
+        if not albums or len(albums[-1]) >= MAX_BATCH_URLS or over_budget:
+            albums.append([])
+            album_bytes = 0
+        albums[-1].append(item)
+        album_bytes += item_bytes
+    sent_count = 0
+    for album in albums:
+        if len(album) == 1:
+            singles.extend(album)
+            continue
+        try:
+            await _send_batch_album(
+                context, chat_id, album, media_kw, reply_to_message_id
+            )
+            sent_count += len(album)
+        except TelegramError as e:
+            print(f"WARNING: Album send failed, sending items one by one: {e}")
+            singles.extend(album)
+    for item in singles:
+        try:
+            await _send_batch_item(
+                context, chat_id, item, media_kw, reply_to_message_id
+            )
+            sent_count += 1
+        except TelegramError as e:
+            item["error"] = f"send failed: {e}"
+    return sent_count
+
+
+async def download_batch_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    user = query.from_user
+    if not user:
+        return
+    choice, _, token = query.data.partition(":")
+    format_type = "video" if choice == "dl_batch_video" else "audio"
+    pending = take_pending_request(token, user.id)
+    if not pending:
+        try:
+            await query.edit_message_text(
+                "Error: URL context lost. Please send the links again."
+            )
+        except TelegramError:
+            pass
+        return
+    user_id = user.id
+    role = get_user_role(user_id, context, user)
+    request_persistence_flush(context, user_id)
+    if role == ROLE_BANNED:
+        try:
+            await query.edit_message_text(
+                "You are currently banned from using this service."
+            )
+        except TelegramError:
+            pass
+        return
+    is_standard_non_privileged = role == ROLE_STANDARD
+    urls = pending["urls"]
+    orig_msg_id_for_reply = pending["reply_to_message_id"]
+    limit_note = ""
+    daily_slots_taken = 0
+    if is_standard_non_privileged:
+        if format_type == "audio":
+            try:
+                await query.edit_message_text(
+                    "Standard users can only download videos. /premium for audio!"
+                )
+            except TelegramError:
+                pass
+            return
+        while daily_slots_taken < len(urls) and check_and_update_daily_limit(
+            user_id, context
+        ):
+            daily_slots_taken += 1
+        if not daily_slots_taken:
+            try:
+                await query.edit_message_text(
+                    f"Daily download limit ({STANDARD_USER_DAILY_DOWNLOADS}) reached. /premium for more!"
+                )
+            except TelegramError:
+                pass
+            return
+        if daily_slots_taken < len(urls):
+            limit_note = f"\n{len(urls) - daily_slots_taken} link(s) skipped: daily limit reached."
+            urls = urls[:daily_slots_taken]
+        request_persistence_flush(context, user_id)
+
+    scheduler_role = role
+    size_limit_mb = (
+        STANDARD_USER_FILE_SIZE_LIMIT_MB
+        if is_standard_non_privileged
+        else get_direct_send_limit_mb()
+    )
+    # Journaled so a restart replays the unsent links and refunds their slots.
+    group_id = uuid4().hex
+    jobs = [
+        await DOWNLOAD_JOBS.create(
+            user_id=user_id,
+            chat_id=query.message.chat_id,
+            url=url,
+            format_type=format_type,
+            role=scheduler_role,
+            reply_to_message_id=orig_msg_id_for_reply,
+            daily_slot_taken=int(is_standard_non_privileged),
+            group_id=group_id,
+        )
+        for url in urls
+    ]
+    done = 0
+
+    async def _edit_status(text: str):
+        try:
+            await query.edit_message_text(text=text)
+        except TelegramError:
+            pass
+
+    async def _fetch_and_count(url: str) -> Dict[str, Any]:
+        nonlocal done
+        try:
+            return await _fetch_batch_item(
+                context, url, format_type, user_id, scheduler_role, size_limit_mb
+            )
+        except Exception as e:
+            print(f"ERROR: Batch item {url} (User: {user_id}) failed: {e}")
+            return {"url": url, "error": f"unexpected error: {type(e).__name__}"}
+        finally:
+            done += 1
+            await _edit_status(
+                f"⏳ Downloading {len(urls)} links ({format_type})... {done}/{len(urls)} done"
+            )
+
+    await _edit_status(f"⏳ Downloading {len(urls)} links ({format_type})...")
+    items: List[Dict[str, Any]] = []
+    try:
+        # The scheduler's per-user limit decides how many of these run at once.
+        items = await asyncio.gather(*(_fetch_and_count(url) for url in urls))
+        for job, item in zip(jobs, items):
+            item["job"] = job
+            if "error" in item:
+                await DOWNLOAD_JOBS.update(job, JOB_FAILED, error=item["error"])
+        ready = [item for item in items if "error" not in item]
+        if ready:
+            await _edit_status(f"🚀 Sending {len(ready)} {format_type}(s)...")
+            await send_batch_results(
+                context,
+                query.message.chat_id,
+                ready,
+                format_type,
+                orig_msg_id_for_reply,
+            )
+        for job, item in zip(jobs, items):
+            # Sent items were marked done as they went out; these failed to send.
+            if "error" in item and job["state"] != JOB_FAILED:
+                await DOWNLOAD_JOBS.update(job, JOB_FAILED, error=item["error"])
+        failed = [item for item in items if "error" in item]
+        if is_standard_non_privileged:
+            for _ in failed:
+                revert_daily_limit_decrement(context)
+        if failed or limit_note:
+            summary = f"✅ Sent {len(items) - len(failed)}/{len(items)} links."
+            for item in failed:
+                summary += f"\n❌ {item['url']}: {item['error']}"
+            await _edit_status(summary + limit_note)
         else:
-            fail_msg = f"❌ Download failed: {message}"
             try:
-                await query.edit_message_text(fail_msg)
+                await query.message.delete()
             except TelegramError:
-                await context.bot.send_message(
-                    chat_id=query.message.chat_id,
-                    text=fail_msg,
-                    reply_to_message_id=orig_msg_id_for_reply,
-                )
-            if standard_user_limit_decremented_this_attempt:
-                revert_daily_limit_decrement(context)
-    except Exception as e:
-        print(f"ERROR: Error in download callback {url} (User: {user_id}): {e}")
-        err_msg_unexpected = f"An unexpected error occurred: {type(e).__name__}."
+                pass
+    finally:
+        for item in items:
+            inflight_key = item.get("inflight_key")
+            if inflight_key and leave_inflight_download(inflight_key):
+                remove_downloaded_file(item.get("path"))
+        request_persistence_flush(context, user_id)
+
+
+async def download_playlist_callback(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+):
+    query = update.callback_query
+    await query.answer()
+    user = query.from_user
+    if not user:
+        return
+    choice, _, token = query.data.partition(":")
+    format_type = "video" if choice == "dl_playlist_video" else "audio"
+    if _ACTIVE_PLAYLISTS.get(user.id, 0) >= PLAYLIST_MAX_ACTIVE_PER_USER:
+        # The pending link is kept, so the button works again once the
+        # running playlist has finished.
         try:
-            await query.edit_message_text(err_msg_unexpected)
+            await query.message.reply_text(
+                "You already have a playlist downloading. Please wait for it to finish."
+            )
         except TelegramError:
-            await context.bot.send_message(
-                chat_id=query.message.chat_id,
-                text=err_msg_unexpected,
+            pass
+        return
+    # Claimed before the next await, since callbacks for one user can overlap.
+    # The playlist runs as a tracked background task so the update finishes
+    # right away.
+    _ACTIVE_PLAYLISTS[user.id] = _ACTIVE_PLAYLISTS.get(user.id, 0) + 1
+    task = asyncio.create_task(
+        _run_playlist_callback(query, context, user, token, format_type)
+    )
+    _PLAYLIST_TASKS.add(task)
+    task.add_done_callback(_PLAYLIST_TASKS.discard)
+    task.add_done_callback(functools.partial(_finish_playlist_task, user.id))
+
+
+def _finish_playlist_task(user_id: int, task: asyncio.Task):
+    if _ACTIVE_PLAYLISTS.get(user_id, 0) > 1:
+        _ACTIVE_PLAYLISTS[user_id] -= 1
+    else:
+        _ACTIVE_PLAYLISTS.pop(user_id, None)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"ERROR: Playlist task for user {user_id} failed: {task.exception()}")
+
+
+async def _run_playlist_callback(
+    query: Any,
+    context: ContextTypes.DEFAULT_TYPE,
+    user: User,
+    token: str,
+    format_type: str,
+):
+    pending = take_pending_request(token, user.id)
+    if not pending:
+        try:
+            await query.edit_message_text(
+                "Error: URL context lost. Please send the link again."
+            )
+        except TelegramError:
+            pass
+        return
+    user_id = user.id
+    role = get_user_role(user_id, context, user)
+    request_persistence_flush(context, user_id)
+    if role not in (ROLE_ADMIN, ROLE_PREMIUM):
+        try:
+            await query.edit_message_text("Playlist downloads are a /premium feature.")
+        except TelegramError:
+            pass
+        return
+    scheduler_role = ROLE_ADMIN if user_id in ADMIN_IDS else ROLE_PREMIUM
+    max_items = PLAYLIST_MAX_ITEMS[scheduler_role]
+    size_limit_mb = get_direct_send_limit_mb()
+    url = pending["urls"][0]
+    orig_msg_id_for_reply = pending["reply_to_message_id"]
+    chat_id = query.message.chat_id
+    loop = asyncio.get_running_loop()
+    # Bounded hand-off from the enumeration thread; the thread blocks while
+    # PLAYLIST_PREFETCH_ITEMS entries are waiting, so memory stays flat.
+    entries: asyncio.Queue = asyncio.Queue(maxsize=PLAYLIST_PREFETCH_ITEMS)
+    stop_enumeration = threading.Event()
+    counters = {"listed": 0, "sent": 0, "failed": 0}
+    last_status_edit = 0.0
+
+    def _emit(entry: Optional[Dict[str, Any]]) -> bool:
+        while not stop_enumeration.is_set():
+            put_future = asyncio.run_coroutine_threadsafe(entries.put(entry), loop)
+            try:
+                put_future.result(timeout=1)
+                return True
+            except FutureTimeoutError:
+                if not put_future.cancel():
+                    # The put completed between the timeout and cancel().
+                    return True
+        return False
+
+    def _enumerate() -> Tuple[bool, str]:
+        try:
+            return enumerate_playlist_entries(url, max_items, _emit)
+        finally:
+            _emit(None)
+
+    async def _edit_status(text: str, force: bool = False):
+        nonlocal last_status_edit
+        since_last_edit = time.monotonic() - last_status_edit
+        if not force and since_last_edit < PROGRESS_EDIT_INTERVAL_SECONDS:
+            return
+        last_status_edit = time.monotonic()
+        try:
+            await query.edit_message_text(text=text)
+        except TelegramError:
+            pass
+
+    def _status_text(prefix: str) -> str:
+        return (
+            f"{prefix} {counters['sent']} sent, {counters['failed']} failed, "
+            f"{counters['listed']} listed (max {max_items})."
+        )
+
+    async def _deliver(entry: Dict[str, Any], job: Dict[str, Any]):
+        item: Dict[str, Any] = {}
+        try:
+            item = await _fetch_batch_item(
+                context,
+                entry["url"],
+                format_type,
+                user_id,
+                scheduler_role,
+                size_limit_mb,
+            )
+            if "error" in item:
+                raise RuntimeError(item["error"])
+            item["job"] = job
+            await _send_batch_item(
+                context, chat_id, item, format_type, orig_msg_id_for_reply
+            )
+            counters["sent"] += 1
+        except Exception as e:
+            counters["failed"] += 1
+            print(f"Playlist item {entry['url']} (User: {user_id}) failed: {e}")
+            if job["state"] != JOB_DONE:
+                await DOWNLOAD_JOBS.update(job, JOB_FAILED, error=str(e))
+        finally:
+            inflight_key = item.get("inflight_key")
+            if inflight_key and leave_inflight_download(inflight_key):
+                remove_downloaded_file(item.get("path"))
+            await _edit_status(_status_text(f"📃 Playlist ({format_type}):"))
+
+    await _edit_status(f"📃 Listing playlist ({format_type})...", force=True)
+    playlist_group_id = uuid4().hex
+    enumeration = loop.run_in_executor(PLAYLIST_EXECUTOR, _enumerate)
+    pending: set = set()
+    slots = asyncio.Semaphore(PLAYLIST_PREFETCH_ITEMS)
+    try:
+        while True:
+            entry = await entries.get()
+            if entry is None:
+                break
+            counters["listed"] += 1
+            await slots.acquire()
+            # Listed entries are journaled; the rest of the playlist is not
+            # enumerated again after a restart.
+            job = await DOWNLOAD_JOBS.create(
+                user_id=user_id,
+                chat_id=chat_id,
+                url=entry["url"],
+                format_type=format_type,
+                role=scheduler_role,
                 reply_to_message_id=orig_msg_id_for_reply,
+                daily_slot_taken=0,
+                group_id=playlist_group_id,
             )
-        if (
-            standard_user_limit_decremented_this_attempt
-            and not download_successful_flag
-        ):
-            revert_daily_limit_decrement(context)
+            task = asyncio.create_task(_deliver(entry, job))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+            task.add_done_callback(lambda _: slots.release())
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        listed_ok, detail = await enumeration
+        if not listed_ok and not counters["listed"]:
+            await _edit_status(f"❌ {detail}", force=True)
+        else:
+            await _edit_status(_status_text(f"✅ Playlist \"{detail}\" done:"), force=True)
     finally:
-        context.user_data.pop("current_url_to_download", None)
-        context.user_data.pop("last_message_id_for_url", None)
-        if file_path_final and os.path.exists(file_path_final):
-            try:
-                os.remove(file_path_final)
-            except OSError as e_os:
-                print(f"ERROR: Failed to delete temp file {file_path_final}: {e_os}")
-        await context.application.persistence.flush()
+        stop_enumeration.set()
+        for task in pending:
+            task.cancel()
+        request_persistence_flush(context, user_id)
 
 
 async def premium_tier_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -965,7 +4551,6 @@ async def successful_payment_callback(
         ud = context.application.persistence.user_data.setdefault(
             user_id, {"_id": user_id}
         )
-        ud["is_premium"] = True
         current_expiry_ts = ud.get("premium_expiry_timestamp", 0.0)
         if current_expiry_ts is None:
             current_expiry_ts = 0.0
@@ -975,11 +4560,18 @@ async def successful_payment_callback(
             if current_expiry_ts > now_ts
             else datetime.datetime.now()
         )
-        ud["premium_expiry_timestamp"] = (
-            start_date_for_new_premium + datetime.timedelta(days=days)
-        ).timestamp()
-        ud["premium_tier"] = tier_key
-        await context.application.persistence.flush()
+        ud = update_user_fields(
+            context,
+            user_id,
+            {
+                "is_premium": True,
+                "premium_expiry_timestamp": (
+                    start_date_for_new_premium + datetime.timedelta(days=days)
+                ).timestamp(),
+                "premium_tier": tier_key,
+            },
+        )
+        await flush_persistence_now(context)
         await update.message.reply_text(
             f"🎉 Thank you! Your Premium ({PREMIUM_PRICES[tier_key]['title']}) is now active for {days} days!"
         )
@@ -1022,7 +4614,6 @@ async def set_user_premium_impl(update: Update, context: ContextTypes.DEFAULT_TY
     target_ud = context.application.persistence.user_data.setdefault(
         target_user_id, {"_id": target_user_id}
     )
-    target_ud["is_premium"] = True
     current_expiry_ts = target_ud.get("premium_expiry_timestamp", 0.0)
     if current_expiry_ts is None:
         current_expiry_ts = 0.0
@@ -1032,11 +4623,18 @@ async def set_user_premium_impl(update: Update, context: ContextTypes.DEFAULT_TY
         if current_expiry_ts > now_ts
         else datetime.datetime.now()
     )
-    target_ud["premium_expiry_timestamp"] = (
-        start_date_for_new_premium + datetime.timedelta(days=days)
-    ).timestamp()
-    target_ud["premium_tier"] = f"admin_grant_{days}d"
-    await context.application.persistence.flush()
+    target_ud = update_user_fields(
+        context,
+        target_user_id,
+        {
+            "is_premium": True,
+            "premium_expiry_timestamp": (
+                start_date_for_new_premium + datetime.timedelta(days=days)
+            ).timestamp(),
+            "premium_tier": f"admin_grant_{days}d",
+        },
+    )
+    await flush_persistence_now(context)
     expiry_dt_str = datetime.datetime.fromtimestamp(
         target_ud["premium_expiry_timestamp"]
     ).strftime("%Y-%m-%d %H:%M:%S UTC")
@@ -1074,10 +4672,16 @@ async def remove_user_premium_impl(update: Update, context: ContextTypes.DEFAULT
             f"User {target_user_id} is not currently premium or has no premium data."
         )
         return
-    target_ud["is_premium"] = False
-    target_ud["premium_expiry_timestamp"] = None
-    target_ud["premium_tier"] = "admin_revoked"
-    await context.application.persistence.flush()
+    update_user_fields(
+        context,
+        target_user_id,
+        {
+            "is_premium": False,
+            "premium_expiry_timestamp": None,
+            "premium_tier": "admin_revoked",
+        },
+    )
+    await flush_persistence_now(context)
     await update.message.reply_text(
         f"✅ Premium status for user {target_user_id} has been revoked."
     )
@@ -1111,16 +4715,18 @@ async def ban_user_impl(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"User {target_user_id} is already banned.")
         return
     banned_users_set.add(target_user_id)
+    USER_REGISTRY.set_banned(target_user_id, True)
     if target_user_id in context.application.persistence.user_data:
-        target_ud = context.application.persistence.user_data[target_user_id]
-        target_ud.update(
+        update_user_fields(
+            context,
+            target_user_id,
             {
                 "is_premium": False,
                 "premium_expiry_timestamp": None,
                 "premium_tier": "revoked_banned",
-            }
+            },
         )
-    await context.application.persistence.flush()
+    await flush_persistence_now(context, include_bot_data=True)
     await update.message.reply_text(
         f"🚫 User {target_user_id} has been banned and their premium (if any) revoked."
     )
@@ -1135,7 +4741,8 @@ async def unban_user_impl(update: Update, context: ContextTypes.DEFAULT_TYPE):
     banned_users_set = context.bot_data.setdefault(BANNED_USERS_KEY, set())
     if target_user_id in banned_users_set:
         banned_users_set.remove(target_user_id)
-        await context.application.persistence.flush()
+        USER_REGISTRY.set_banned(target_user_id, False)
+        await flush_persistence_now(context, include_bot_data=True)
         await update.message.reply_text(f"✅ User {target_user_id} has been unbanned.")
     else:
         await update.message.reply_text(
@@ -1143,51 +4750,319 @@ async def unban_user_impl(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 
+# --- Broadcast Engine ---
+class TokenBucket:
+    # Global send budget shared by all broadcast workers. Flood-control errors
+    # pause every worker and lower the rate, which then slowly recovers.
+    def __init__(self, rate: float, min_rate: float):
+        self.max_rate = rate
+        self.min_rate = min_rate
+        self.rate = rate
+        self._tokens = rate
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+
+    def _refill(self, now: float):
+        self._tokens = min(self.rate, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def penalize(self, retry_after_seconds: float):
+        self._paused_until = max(
+            self._paused_until, time.monotonic() + retry_after_seconds
+        )
+        self._tokens = 0
+        self.rate = max(self.min_rate, self.rate * 0.7)
+
+    def reward(self):
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + 0.05)
+
+
+class BroadcastStore:
+    # The running broadcast's checkpoint and the ids of users who blocked the
+    # bot, kept in their own tables of the persistence database. A checkpoint
+    # rewrites one state row and inserts only the newly unreachable ids, so its
+    # cost does not grow with the user base the way re-pickling bot_data did.
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.state: Optional[Dict[str, Any]] = None
+        self.unreachable: set = set()
+        self._new_unreachable: set = set()
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.filepath, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.executescript(
+                "CREATE TABLE IF NOT EXISTS broadcast_state ("
+                "id INTEGER PRIMARY KEY CHECK (id = 1), data TEXT NOT NULL);"
+                "CREATE TABLE IF NOT EXISTS unreachable_users ("
+                "user_id INTEGER PRIMARY KEY);"
+            )
+        return self._connection
+
+    def _write(self, state_json: Optional[str], added: List[Tuple[int]]):
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                if state_json is None:
+                    connection.execute("DELETE FROM broadcast_state")
+                else:
+                    connection.execute(
+                        "INSERT OR REPLACE INTO broadcast_state (id, data) VALUES (1, ?)",
+                        (state_json,),
+                    )
+                connection.executemany(
+                    "INSERT OR IGNORE INTO unreachable_users (user_id) VALUES (?)",
+                    added,
+                )
+
+    def _load(self, legacy_state: Optional[Dict[str, Any]], legacy_unreachable):
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute(
+                "SELECT data FROM broadcast_state WHERE id = 1"
+            ).fetchone()
+            unreachable = {
+                user_id
+                for (user_id,) in connection.execute(
+                    "SELECT user_id FROM unreachable_users"
+                )
+            }
+        self.state = json.loads(row[0]) if row else None
+        self.unreachable = unreachable
+        if legacy_state is not None or legacy_unreachable:
+            # Both lived in bot_data in earlier versions.
+            if self.state is None and legacy_state is not None:
+                self.state = legacy_state
+            added = set(legacy_unreachable or ()) - self.unreachable
+            self.unreachable |= added
+            self._write(
+                json.dumps(self.state) if self.state is not None else None,
+                [(user_id,) for user_id in added],
+            )
+
+    async def load(
+        self, legacy_state: Optional[Dict[str, Any]] = None, legacy_unreachable=None
+    ):
+        await asyncio.to_thread(self._load, legacy_state, legacy_unreachable)
+
+    def mark_unreachable(self, user_id: int):
+        self.unreachable.add(user_id)
+        self._new_unreachable.add(user_id)
+
+    def discard_unreachable(self, user_id: int):
+        # Called on every interaction, so only a user who was actually marked
+        # costs a (single-row) write.
+        if user_id not in self.unreachable:
+            return
+        self.unreachable.discard(user_id)
+        self._new_unreachable.discard(user_id)
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute(
+                    "DELETE FROM unreachable_users WHERE user_id = ?", (user_id,)
+                )
+
+    async def checkpoint(self):
+        added = [(user_id,) for user_id in self._new_unreachable]
+        self._new_unreachable.clear()
+        state_json = json.dumps(self.state) if self.state is not None else None
+        try:
+            await asyncio.to_thread(self._write, state_json, added)
+        except BaseException:
+            self._new_unreachable.update(user_id for (user_id,) in added)
+            raise
+
+
+BROADCAST_STORE = BroadcastStore(PERSISTENCE_DB_PATH)
+_BROADCAST_TASK: Optional["asyncio.Task"] = None
+
+
+async def load_broadcast_store(application: Application):
+    await BROADCAST_STORE.load(
+        application.bot_data.pop(BROADCAST_STATE_KEY, None),
+        application.bot_data.pop(UNREACHABLE_USERS_KEY, None),
+    )
+
+
+def is_broadcast_running() -> bool:
+    return _BROADCAST_TASK is not None and not _BROADCAST_TASK.done()
+
+
+def start_broadcast_task(application: Application):
+    global _BROADCAST_TASK
+    if is_broadcast_running() or BROADCAST_STORE.state is None:
+        return
+    _BROADCAST_TASK = asyncio.create_task(run_broadcast(application))
+
+
+def stop_broadcast_task():
+    if is_broadcast_running():
+        _BROADCAST_TASK.cancel()
+
+
+async def _send_broadcast_to_user(
+    application: Application,
+    state: Dict[str, Any],
+    user_id: int,
+    bucket: TokenBucket,
+) -> str:
+    for _ in range(BROADCAST_MAX_ATTEMPTS_PER_USER):
+        await bucket.acquire()
+        try:
+            await application.bot.copy_message(
+                chat_id=user_id,
+                from_chat_id=state["from_chat_id"],
+                message_id=state["message_id"],
+            )
+            bucket.reward()
+            return "sent"
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            if isinstance(retry_after, datetime.timedelta):
+                retry_after = retry_after.total_seconds()
+            print(f"WARNING: Broadcast hit flood control, pausing {retry_after}s.")
+            bucket.penalize(float(retry_after) + 0.5)
+        except Forbidden:
+            return "unreachable"
+        except BadRequest as e:
+            if "chat not found" in str(e).lower():
+                return "unreachable"
+            print(f"WARNING: Broadcast failed for user {user_id}: {e}")
+            return "failed"
+        except TelegramError as e:
+            print(f"WARNING: Broadcast failed for user {user_id}: {e}")
+            return "failed"
+    return "failed"
+
+
+async def run_broadcast(application: Application):
+    state = BROADCAST_STORE.state
+    banned_users = application.bot_data.get(BANNED_USERS_KEY, set())
+    unreachable_users = BROADCAST_STORE.unreachable
+    # Recipients are processed in ascending user id order; the checkpoint is the
+    # highest id below which every recipient has been handled.
+    recipients = [
+        uid
+        for uid in USER_REGISTRY.user_ids_after(state["watermark"])
+        if uid not in banned_users and uid not in unreachable_users
+    ]
+    state["total"] = state.get("processed", 0) + len(recipients)
+    bucket = TokenBucket(BROADCAST_MAX_MESSAGES_PER_SECOND, BROADCAST_MIN_MESSAGES_PER_SECOND)
+    queue: asyncio.Queue = asyncio.Queue(maxsize=BROADCAST_CONCURRENCY * 2)
+    dispatched: deque = deque()
+    finished: set = set()
+    last_status_update = time.monotonic()
+
+    async def _update_status(text: str):
+        try:
+            await application.bot.edit_message_text(
+                text,
+                chat_id=state["status_chat_id"],
+                message_id=state["status_message_id"],
+            )
+        except TelegramError:
+            pass
+
+    async def _worker():
+        nonlocal last_status_update
+        while True:
+            user_id = await queue.get()
+            try:
+                outcome = await _send_broadcast_to_user(application, state, user_id, bucket)
+                if outcome == "sent":
+                    state["sent"] += 1
+                else:
+                    state["failed"] += 1
+                    if outcome == "unreachable":
+                        BROADCAST_STORE.mark_unreachable(user_id)
+                state["processed"] += 1
+                finished.add(user_id)
+                while dispatched and dispatched[0] in finished:
+                    finished.discard(dispatched[0])
+                    state["watermark"] = dispatched.popleft()
+                if state["processed"] % BROADCAST_CHECKPOINT_EVERY == 0:
+                    try:
+                        await BROADCAST_STORE.checkpoint()
+                    except Exception as e:
+                        print(f"ERROR: Failed to checkpoint broadcast progress: {e}")
+                if time.monotonic() - last_status_update >= BROADCAST_STATUS_UPDATE_SECONDS:
+                    last_status_update = time.monotonic()
+                    await _update_status(
+                        f"📢 Broadcasting... Sent: {state['sent']}, Failed/Skipped: {state['failed']} "
+                        f"(Processed {state['processed']}/{state['total']}, {bucket.rate:.0f} msg/s)"
+                    )
+            finally:
+                queue.task_done()
+
+    workers = [asyncio.create_task(_worker()) for _ in range(BROADCAST_CONCURRENCY)]
+    try:
+        for user_id in recipients:
+            dispatched.append(user_id)
+            await queue.put(user_id)
+        await queue.join()
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        await BROADCAST_STORE.checkpoint()
+    BROADCAST_STORE.state = None
+    await BROADCAST_STORE.checkpoint()
+    await _update_status(
+        f"Broadcast finished. ✅ Sent: {state['sent']}, ❌ Failed/Skipped: {state['failed']} "
+        f"out of {state['total']} potential recipients. "
+        f"({len(unreachable_users)} unreachable users are now skipped.)"
+    )
+
+
 async def broadcast_impl(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message.reply_to_message:
         await update.message.reply_text(
             "Please reply to the message you want to broadcast."
         )
         return
+    if is_broadcast_running() or BROADCAST_STORE.state is not None:
+        await update.message.reply_text(
+            "A broadcast is already in progress. Please wait for it to finish."
+        )
+        return
     message_to_broadcast = update.message.reply_to_message
-    all_user_ids_with_data = list(context.application.persistence.user_data.keys())
-    if not all_user_ids_with_data:
+    recipient_count = len(context.application.persistence.user_data)
+    if not recipient_count:
         await update.message.reply_text("No users with data to broadcast to.")
         return
     status_msg = await update.message.reply_text(
-        f"📢 Broadcasting to {len(all_user_ids_with_data)} users... This may take a while."
-    )
-    sent_count, failed_count = 0, 0
-    banned_users = context.bot_data.get(BANNED_USERS_KEY, set())
-    for i, user_id in enumerate(all_user_ids_with_data):
-        if user_id in banned_users:
-            continue
-        try:
-            await context.bot.copy_message(
-                chat_id=user_id,
-                from_chat_id=message_to_broadcast.chat_id,
-                message_id=message_to_broadcast.message_id,
-            )
-            sent_count += 1
-        except Forbidden:
-            failed_count += 1
-            print(
-                f"WARNING: Broadcast failed for user {user_id}: Bot blocked or user deactivated."
-            )
-        except TelegramError as e:
-            failed_count += 1
-            print(f"WARNING: Broadcast failed for user {user_id}: {e}")
-        if (i + 1) % 20 == 0:
-            try:
-                await status_msg.edit_text(
-                    f"📢 Broadcasting... Sent: {sent_count}, Failed/Skipped: {failed_count} (Processed {i+1}/{len(all_user_ids_with_data)})"
-                )
-            except TelegramError:
-                pass
-            await asyncio.sleep(1)
-    await status_msg.edit_text(
-        f"Broadcast finished. ✅ Sent: {sent_count}, ❌ Failed/Skipped: {failed_count} out of {len(all_user_ids_with_data)} potential recipients."
+        f"📢 Broadcasting to up to {recipient_count} users... This may take a while."
     )
+    BROADCAST_STORE.state = {
+        "from_chat_id": message_to_broadcast.chat_id,
+        "message_id": message_to_broadcast.message_id,
+        "status_chat_id": status_msg.chat_id,
+        "status_message_id": status_msg.message_id,
+        "watermark": float("-inf"),
+        "sent": 0,
+        "failed": 0,
+        "processed": 0,
+    }
+    await BROADCAST_STORE.checkpoint()
+    start_broadcast_task(context.application)
 
 
 async def toggle_channel_check_impl(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1253,154 +5128,133 @@ async def set_required_channels_impl(
 
 
 async def stats_impl(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    all_user_data_items = list(context.application.persistence.user_data.items())
-    roles_count = {
-        ROLE_ADMIN: 0,
-        ROLE_PREMIUM: 0,
-        ROLE_STANDARD: 0,
-        ROLE_BANNED: 0,
-        "Admin (Premium)": 0,
-    }
-    total_users_with_data = len(all_user_data_items)
-    users_who_had_premium = 0
-    for user_id_key, data_val in all_user_data_items:
-        actual_role = get_user_role(
-            user_id_key, context, current_effective_user=None, for_display=True
-        )
-        is_premium_active_for_stat = False
-        if data_val.get("is_premium"):
-            exp_ts = data_val.get("premium_expiry_timestamp")
-            if exp_ts and exp_ts > datetime.datetime.now().timestamp():
-                is_premium_active_for_stat = True
-        if actual_role == ROLE_ADMIN:
-            if is_premium_active_for_stat:
-                roles_count["Admin (Premium)"] += 1
-            else:
-                roles_count[ROLE_ADMIN] += 1
-        elif actual_role == ROLE_PREMIUM:
-            roles_count[ROLE_PREMIUM] += 1
-        elif actual_role == ROLE_STANDARD:
-            roles_count[ROLE_STANDARD] += 1
-            if data_val.get("premium_tier") and data_val.get("premium_tier") not in [
-                "admin_revoked",
-                "revoked_banned",
-                "expired_or_unknown",
-                "expired_or_cleaned",
-            ]:
-                users_who_had_premium += 1
-    banned_user_count_direct = len(context.bot_data.get(BANNED_USERS_KEY, set()))
-    roles_count[ROLE_BANNED] = banned_user_count_direct
-    interacted_admin_count = sum(
-        1 for uid_key, _ in all_user_data_items if uid_key in ADMIN_IDS
-    )
+    counts = USER_REGISTRY.counts()
     channel_cfg = await get_channel_config(context)
     stats_lines = [
         "📊 **Bot Usage Statistics** 📊",
-        f"  - Total Users with Data: {total_users_with_data}",
-        f"  - Configured Admins (in ADMIN_IDS): {len(ADMIN_IDS)} (Interacted: {interacted_admin_count})",
+        f"  - Total Users with Data: {counts['total']}",
+        f"  - Configured Admins (in ADMIN_IDS): {len(ADMIN_IDS)} (Interacted: {counts['admins_interacted']})",
         f"  - Roles Breakdown:",
-        f"    - Admin: {roles_count[ROLE_ADMIN]}",
-        f"    - Admin (Premium): {roles_count['Admin (Premium)']}",
-        f"    - Premium Users: {roles_count[ROLE_PREMIUM]}",
-        f"    - Standard Users: {roles_count[ROLE_STANDARD]} (of which ~{users_who_had_premium} previously had premium)",
-        f"    - Banned Users: {roles_count[ROLE_BANNED]}",
+        f"    - Admin: {counts[ROLE_ADMIN]}",
+        f"    - Admin (Premium): {counts['admin_premium']}",
+        f"    - Premium Users: {counts[ROLE_PREMIUM]}",
+        f"    - Standard Users: {counts[ROLE_STANDARD]} (of which ~{counts['had_premium']} previously had premium)",
+        f"    - Banned Users: {counts[ROLE_BANNED]}",
         f"\n📢 **Channel Subscription:** {'ENABLED' if channel_cfg.get('enabled') else 'DISABLED'}",
         f"  - Required Channels: {', '.join(channel_cfg.get('channels', [])) or 'None'}",
     ]
+    http_stats = http_pool_stats(context.bot_data)
+    stats_lines += [
+        "\n🌐 **Outbound HTTP Pool:**",
+        f"  - Requests: {http_stats['requests']} (errors: {http_stats['request_errors']})",
+        f"  - Connections: {http_stats['connections_created']} opened, {http_stats['connections_reused']} reused",
+        f"  - In use / idle: {http_stats.get('in_use', 0)} / {http_stats.get('idle', 0)} (limit {http_stats.get('limit', HTTP_POOL_LIMIT)}, {http_stats.get('limit_per_host', HTTP_POOL_LIMIT_PER_HOST)} per host)",
+        f"  - DNS cache: {http_stats['dns_cache_hits']} hits, {http_stats['dns_cache_misses']} misses",
+        "\n💾 **Download Storage:**",
+    ]
+    stats_lines += [
+        f"  - {area['dir']}: {_format_bytes_mb(area['used'])} of {_format_bytes_mb(area['quota'])} reserved ({area['reservations']} file(s))"
+        for area in DOWNLOAD_STORAGE.usage()
+    ]
     await update.message.reply_html("\n".join(stats_lines))
 
 
-async def view_users_impl(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    all_user_data_items = list(context.application.persistence.user_data.items())
-    if not all_user_data_items:
-        await update.message.reply_text("No user data found.")
-        return
-    user_details_list = [
-        "👥 **User Details List (Max 50 users displayed per message):**"
-    ]
-    output_message_count = 0
-    MAX_USERS_PER_MESSAGE = 50
-    for i, (user_id, data) in enumerate(all_user_data_items):
-        display_role_str = "Unknown"
-        is_banned = user_id in context.bot_data.get(BANNED_USERS_KEY, set())
-        is_admin = user_id in ADMIN_IDS
-        is_premium_active = False
-        premium_expiry_ts = data.get("premium_expiry_timestamp")
-        if (
-            data.get("is_premium")
-            and premium_expiry_ts
-            and premium_expiry_ts > datetime.datetime.now().timestamp()
-        ):
-            is_premium_active = True
-        if is_banned:
-            display_role_str = "Banned"
-        elif is_admin:
-            display_role_str = "Admin"
-            if is_premium_active:
-                display_role_str += " (Premium)"
-        elif is_premium_active:
-            display_role_str = "Premium"
-        else:
-            display_role_str = "Standard"
-        user_line = [f"\n👤 ID: <code>{user_id}</code>", f"   Role: {display_role_str}"]
+def format_user_details(user_id: int, data: Dict[str, Any], is_banned: bool) -> str:
+    is_admin = user_id in ADMIN_IDS
+    is_premium_active = False
+    premium_expiry_ts = data.get("premium_expiry_timestamp")
+    if (
+        data.get("is_premium")
+        and premium_expiry_ts
+        and premium_expiry_ts > datetime.datetime.now().timestamp()
+    ):
+        is_premium_active = True
+    if is_banned:
+        display_role_str = "Banned"
+    elif is_admin:
+        display_role_str = "Admin"
         if is_premium_active:
+            display_role_str += " (Premium)"
+    elif is_premium_active:
+        display_role_str = "Premium"
+    else:
+        display_role_str = "Standard"
+    user_line = [f"\n👤 ID: <code>{user_id}</code>", f"   Role: {display_role_str}"]
+    if is_premium_active:
+        user_line.append(f"   Tier: Active Premium ({data.get('premium_tier', 'N/A')})")
+    elif data.get("premium_tier"):
+        user_line.append(f"   Tier: {data.get('premium_tier')}")
+    if premium_expiry_ts:
+        expiry_dt = datetime.datetime.fromtimestamp(premium_expiry_ts)
+        now_dt = datetime.datetime.now()
+        if expiry_dt > now_dt:
+            remaining = expiry_dt - now_dt
+            days, rem_secs = divmod(remaining.total_seconds(), 86400)
+            hours, rem_secs = divmod(rem_secs, 3600)
+            minutes = rem_secs // 60
             user_line.append(
-                f"   Tier: Active Premium ({data.get('premium_tier', 'N/A')})"
-            )
-        elif data.get("premium_tier"):
-            user_line.append(f"   Tier: {data.get('premium_tier')}")
-        if premium_expiry_ts:
-            expiry_dt = datetime.datetime.fromtimestamp(premium_expiry_ts)
-            now_dt = datetime.datetime.now()
-            if expiry_dt > now_dt:
-                remaining = expiry_dt - now_dt
-                days, rem_secs = divmod(remaining.total_seconds(), 86400)
-                hours, rem_secs = divmod(rem_secs, 3600)
-                minutes = rem_secs // 60
-                user_line.append(
-                    f"   **Premium Ends:** {expiry_dt.strftime('%Y-%m-%d %H:%M')} UTC ({int(days)}d {int(hours)}h {int(minutes)}m left)"
-                )
-            else:
-                user_line.append(
-                    f"   **Premium Expired:** {expiry_dt.strftime('%Y-%m-%d %H:%M')} UTC"
-                )
-        if display_role_str == "Standard" and not is_admin:
-            today_iso = datetime.date.today().isoformat()
-            last_dl_date = data.get("last_download_date")
-            downloads_today = (
-                data.get("daily_downloads_count", 0) if last_dl_date == today_iso else 0
+                f"   <b>Premium Ends:</b> {expiry_dt.strftime('%Y-%m-%d %H:%M')} UTC ({int(days)}d {int(hours)}h {int(minutes)}m left)"
             )
+        else:
             user_line.append(
-                f"   **Downloads Today:** {downloads_today}/{STANDARD_USER_DAILY_DOWNLOADS}"
+                f"   <b>Premium Expired:</b> {expiry_dt.strftime('%Y-%m-%d %H:%M')} UTC"
             )
-        user_details_list.append("\n".join(user_line))
-        if (i + 1) % MAX_USERS_PER_MESSAGE == 0 or (i + 1) == len(all_user_data_items):
-            try:
-                await update.message.reply_html(
-                    "\n".join(user_details_list), disable_web_page_preview=True
-                )
-                output_message_count += 1
-            except TelegramError as e:
-                await update.message.reply_text(f"Error sending user list part: {e}")
-                break
-            user_details_list = (
-                [f"... (continued - part {output_message_count+1}) ..."]
-                if (i + 1) < len(all_user_data_items)
-                else []
+    if display_role_str == "Standard":
+        today_iso = datetime.date.today().isoformat()
+        downloads_today = (
+            data.get("daily_downloads_count", 0)
+            if data.get("last_download_date") == today_iso
+            else 0
+        )
+        user_line.append(
+            f"   <b>Downloads Today:</b> {downloads_today}/{STANDARD_USER_DAILY_DOWNLOADS}"
+        )
+    return "\n".join(user_line)
+
+
+async def view_users_impl(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /viewusers [all|admin|premium|standard|banned] [after_user_id]
+    args = list(context.args or [])
+    role_name = "all"
+    if args and args[0].lower() in VIEW_USERS_ROLE_FILTERS:
+        role_name = args.pop(0).lower()
+    after_user_id = None
+    if args:
+        try:
+            after_user_id = int(args[0])
+        except ValueError:
+            await update.message.reply_text(
+                "Usage: /viewusers `[all|admin|premium|standard|banned] [after_user_id]`"
             )
-            if (i + 1) < len(all_user_data_items):
-                await asyncio.sleep(0.5)
-    if (
-        not output_message_count
-        and len(user_details_list) <= 1
-        and (not all_user_data_items or user_details_list[0].startswith("👥"))
-    ):
-        if not all_user_data_items:
-            await update.message.reply_text("No user data found.")
-        elif output_message_count == 0 and len(user_details_list) > 1:
-            await update.message.reply_html(
-                "\n".join(user_details_list), disable_web_page_preview=True
+            return
+    user_ids, next_cursor = USER_REGISTRY.page(
+        VIEW_USERS_ROLE_FILTERS[role_name], after_user_id, VIEW_USERS_PAGE_SIZE
+    )
+    if not user_ids:
+        await update.message.reply_text(
+            "No user data found."
+            if after_user_id is None
+            else "No more users for this filter."
+        )
+        return
+    user_data_store = context.application.persistence.user_data
+    banned_ids = context.bot_data.get(BANNED_USERS_KEY, set())
+    header = f"👥 <b>Users ({role_name})</b>"
+    if after_user_id is not None:
+        header += f" after <code>{after_user_id}</code>"
+    lines = [header + ":"]
+    for user_id in user_ids:
+        lines.append(
+            format_user_details(
+                user_id, user_data_store.get(user_id, {}), user_id in banned_ids
             )
+        )
+    if next_cursor is not None:
+        lines.append(f"\nNext page: <code>/viewusers {role_name} {next_cursor}</code>")
+    try:
+        await update.message.reply_html("\n".join(lines), disable_web_page_preview=True)
+    except TelegramError as e:
+        await update.message.reply_text(f"Error sending user list: {e}")
 
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1431,6 +5285,76 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
             )
 
 
+async def run_webhook_server(application: Application):
+    async def handle_update(request: web.Request) -> web.Response:
+        if not hmac.compare_digest(
+            request.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode(),
+            WEBHOOK_SECRET_TOKEN.encode(),
+        ):
+            return web.Response(status=403)
+        try:
+            payload = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        await application.update_queue.put(Update.de_json(payload, application.bot))
+        return web.Response()
+
+    async def handle_health(request: web.Request) -> web.Response:
+        return web.json_response(
+            {
+                "status": "ok",
+                "pending_updates": application.update_queue.qsize(),
+                "http_pool": http_pool_stats(application.bot_data),
+            }
+        )
+
+    web_app = web.Application()
+    web_app.router.add_post(WEBHOOK_PATH, handle_update)
+    web_app.router.add_get("/healthz", handle_health)
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    # Mirrors Application.run_polling's lifecycle, with aiohttp feeding the update queue.
+    # Everything after post_init sits inside the try, so a failing set_webhook or
+    # bind still stops the background tasks post_init started.
+    runner = None
+    try:
+        async with application:
+            try:
+                if application.post_init:
+                    await application.post_init(application)
+                await application.bot.set_webhook(
+                    url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                    secret_token=WEBHOOK_SECRET_TOKEN,
+                    max_connections=WEBHOOK_MAX_CONNECTIONS,
+                    allowed_updates=ALLOWED_UPDATES,
+                )
+                await application.start()
+                runner = web.AppRunner(web_app)
+                await runner.setup()
+                await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+                print(
+                    f"Webhook server listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}"
+                )
+                await stop_event.wait()
+            finally:
+                if runner is not None:
+                    await runner.cleanup()
+                if application.running:
+                    await application.stop()
+                if application.post_stop:
+                    await application.post_stop(application)
+    finally:
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
 def main():
     global BOT_TOKEN
     if (
@@ -1442,19 +5366,37 @@ def main():
             "CRITICAL: BOT_TOKEN is not set or looks invalid! Please check your BOT_TOKEN. Exiting."
         )
         sys.exit(1)
-    if not os.path.exists(DOWNLOAD_DIR):
-        os.makedirs(DOWNLOAD_DIR)
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    if TMPFS_DOWNLOAD_DIR:
+        os.makedirs(TMPFS_DOWNLOAD_DIR, exist_ok=True)
+    # Nothing is downloading yet, so every bot file left in the directories is
+    # an orphan; interrupted jobs are downloaded again by the job journal.
+    removed, freed = DOWNLOAD_STORAGE.sweep(max_age=0)
+    if removed:
+        print(
+            f"Removed {removed} leftover download file(s), {_format_bytes_mb(freed)} freed."
+        )
     app_defaults = Defaults(parse_mode=constants.ParseMode.HTML)
-    application = (
+    application_builder = (
         Application.builder()
         .token(BOT_TOKEN)
         .persistence(PERSISTENCE)
+        .context_types(ContextTypes(bot_data=BotData))
         .defaults(app_defaults)
         .read_timeout(30)
         .connect_timeout(30)
         .write_timeout(30)
-        .build()
     )
+    if is_local_bot_api_enabled():
+        application_builder = (
+            application_builder.base_url(LOCAL_BOT_API_BASE_URL)
+            .base_file_url(LOCAL_BOT_API_BASE_FILE_URL or LOCAL_BOT_API_BASE_URL)
+            .local_mode(True)
+        )
+        print(
+            f"Using local Bot API server at {LOCAL_BOT_API_BASE_URL} (upload limit {LOCAL_BOT_API_UPLOAD_LIMIT_MB:.0f}MB)."
+        )
+    application = application_builder.build()
     user_commands_list = [
         BotCommand("start", "🌟 Start Bot & View Status"),
         BotCommand("help", "ℹ️ Get Help & Command List"),
@@ -1519,7 +5461,23 @@ def main():
         ),
         MessageHandler(filters.TEXT & ~filters.COMMAND, handle_url_message),
         MessageHandler(filters.CAPTION & ~filters.COMMAND, handle_url_message),
-        CallbackQueryHandler(download_format_callback, pattern=r"^dl_(video|audio)$"),
+        # Downloads run as their own tasks (block=False) so one user's job
+        # never holds up other updates; DOWNLOAD_SCHEDULER does the queueing.
+        CallbackQueryHandler(
+            download_format_callback,
+            pattern=r"^dl_(video|audio)(:|$)",
+            block=False,
+        ),
+        CallbackQueryHandler(
+            download_batch_callback,
+            pattern=r"^dl_batch_(video|audio)(:|$)",
+            block=False,
+        ),
+        CallbackQueryHandler(
+            download_playlist_callback,
+            pattern=r"^dl_playlist_(video|audio)(:|$)",
+            block=False,
+        ),
         CallbackQueryHandler(premium_tier_callback, pattern=r"^BUY_PREMIUM_"),
         PreCheckoutQueryHandler(precheckout_callback),
         MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_callback),
@@ -1528,9 +5486,10 @@ def main():
     application.add_error_handler(error_handler)
 
     async def post_initialization(app_instance: Application):
-        try:
-           
-            await app_instance.bot.set_my_commands(user_commands_list)
+        # Each step is guarded on its own and the Telegram API calls run last,
+        # so a failing set_my_commands cannot keep premium expiry, the storage
+        # sweeper or job replay from starting.
+        def _ensure_bot_data_defaults():
             if BANNED_USERS_KEY not in app_instance.bot_data:
                 app_instance.bot_data[BANNED_USERS_KEY] = set()
             if CHANNEL_SUBSCRIPTION_CONFIG_KEY not in app_instance.bot_data:
@@ -1538,18 +5497,65 @@ def main():
                     "enabled": False,
                     "channels": [],
                 }
-            await app_instance.update_persistence()
+            drop_legacy_pending_user_data(app_instance)
+
+        def _resume_broadcast():
+            if BROADCAST_STORE.state is not None:
+                print("Resuming interrupted broadcast from its last checkpoint.")
+                start_broadcast_task(app_instance)
+
+        async def _announce_commands():
+            await app_instance.bot.set_my_commands(user_commands_list)
             bot_me = await app_instance.bot.get_me()
             print(
                 f"Bot commands set ({len(user_commands_list)} user commands). Bot @{bot_me.username} (ID: {bot_me.id}) started successfully!"
             )
-        except Exception as e:
-            print(f"ERROR: Error during post_initialization: {e}")
-            traceback.print_exc()
+
+        startup_steps = (
+            (
+                "premium expiry scheduler",
+                lambda: PREMIUM_EXPIRY_SCHEDULER.start(app_instance),
+            ),
+            ("download storage sweeper", DOWNLOAD_STORAGE.start_sweeper),
+            ("HTTP session", lambda: get_http_session(app_instance.bot_data)),
+            ("bot data defaults", _ensure_bot_data_defaults),
+            ("sent media cache", lambda: load_sent_media_cache(app_instance)),
+            ("broadcast state", lambda: load_broadcast_store(app_instance)),
+            ("persistence update", app_instance.update_persistence),
+            ("download job replay", lambda: resume_download_jobs(app_instance)),
+            ("broadcast resume", _resume_broadcast),
+            ("bot commands", _announce_commands),
+        )
+        for step_name, step in startup_steps:
+            try:
+                result = step()
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as e:
+                print(f"ERROR: post_initialization step '{step_name}' failed: {e}")
+                traceback.print_exc()
+
+    async def post_stop(app_instance: Application):
+        stop_broadcast_task()
+        PREMIUM_EXPIRY_SCHEDULER.stop()
+        DOWNLOAD_STORAGE.stop_sweeper()
+
+    async def post_shutdown(app_instance: Application):
+        await close_http_session(app_instance.bot_data)
 
     application.post_init = post_initialization
+    application.post_stop = post_stop
+    application.post_shutdown = post_shutdown
     print("Bot is starting up...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_ENABLED:
+        if not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", WEBHOOK_SECRET_TOKEN or ""):
+            print(
+                "CRITICAL: WEBHOOK_SECRET_TOKEN must be set (1-256 chars of A-Z, a-z, 0-9, _ and -) when WEBHOOK_ENABLED is True. Exiting."
+            )
+            sys.exit(1)
+        asyncio.run(run_webhook_server(application))
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 
 if __name__ == "__main__":